@@ -7,6 +7,7 @@
 from dotenv import load_dotenv
 
 from app.db.base import Base
+from app.db.online_migrations import checkpoints
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -24,6 +25,12 @@
 # target_metadata = None
 target_metadata = Base.metadata
 
+
+def include_name(name, type_, parent_names) -> bool:
+    """Leave the progress of the backfills out of the autogenerated revisions."""
+    return not (type_ == "table" and name == checkpoints.name)
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -87,7 +94,9 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
         )
 
         with context.begin_transaction():
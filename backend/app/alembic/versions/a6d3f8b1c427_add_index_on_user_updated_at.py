@@ -0,0 +1,28 @@
+"""Add index on user updated_at
+
+The search index of each worker reads the users updated since its last sync.
+The index is built in place, without blocking the writes.
+
+Revision ID: a6d3f8b1c427
+Revises: f1c9a4e7b350
+Create Date: 2026-10-18 18:02:37.415806
+
+"""
+from typing import Sequence, Union
+
+from app.db.online_migrations import alter_online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d3f8b1c427'
+down_revision: Union[str, None] = 'f1c9a4e7b350'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    alter_online('user', 'ADD INDEX ix_user_updated_at (updated_at)')
+
+
+def downgrade() -> None:
+    alter_online('user', 'DROP INDEX ix_user_updated_at')
@@ -0,0 +1,31 @@
+"""Backfill user updated_at
+
+Revision ID: b3d9f6e2a871
+Revises: e7b4a2c9f015
+Create Date: 2026-10-18 16:02:41.208113
+
+"""
+from typing import Sequence, Union
+
+from app.db.online_migrations import backfill
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3d9f6e2a871'
+down_revision: Union[str, None] = 'e7b4a2c9f015'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing rows get the migration time (UTC) as their last modification
+    backfill(
+        'user',
+        {'updated_at': 'UTC_TIMESTAMP()'},
+        where='updated_at IS NULL',
+        name='user_updated_at',
+    )
+
+
+def downgrade() -> None:
+    pass
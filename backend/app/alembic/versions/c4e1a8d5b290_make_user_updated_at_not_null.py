@@ -0,0 +1,25 @@
+"""Make user updated_at not null
+
+Revision ID: c4e1a8d5b290
+Revises: b3d9f6e2a871
+Create Date: 2026-10-18 16:05:12.774390
+
+"""
+from typing import Sequence, Union
+
+from app.db.online_migrations import alter_online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e1a8d5b290'
+down_revision: Union[str, None] = 'b3d9f6e2a871'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    alter_online('user', 'MODIFY updated_at DATETIME NOT NULL')
+
+
+def downgrade() -> None:
+    alter_online('user', 'MODIFY updated_at DATETIME NULL')
@@ -0,0 +1,40 @@
+"""Add binary uid to user table
+
+Expand step of the change of user.uid from 32 hex digits to BINARY(16):
+uid_bin is added, and kept equal to UNHEX(uid) by triggers for the rows that
+the application writes meanwhile.
+
+Revision ID: d5a7c3e9b142
+Revises: c4e1a8d5b290
+Create Date: 2026-10-18 17:11:26.530861
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from app.db.online_migrations import alter_online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a7c3e9b142'
+down_revision: Union[str, None] = 'c4e1a8d5b290'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    alter_online(
+        'user', 'ADD COLUMN uid_bin BINARY(16) NULL', algorithm='INSTANT', lock=None
+    )
+    for event in ('INSERT', 'UPDATE'):
+        op.execute(
+            f"CREATE TRIGGER user_uid_bin_{event.lower()} BEFORE {event} ON user "
+            "FOR EACH ROW SET NEW.uid_bin = UNHEX(NEW.uid)"
+        )
+
+
+def downgrade() -> None:
+    for event in ('INSERT', 'UPDATE'):
+        op.execute(f"DROP TRIGGER user_uid_bin_{event.lower()}")
+    alter_online('user', 'DROP COLUMN uid_bin')
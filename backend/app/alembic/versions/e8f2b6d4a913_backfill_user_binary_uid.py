@@ -0,0 +1,40 @@
+"""Backfill user binary uid
+
+Fills in uid_bin for the existing rows, then makes it NOT NULL and unique:
+both online, the application still reads and writes uid.
+
+Revision ID: e8f2b6d4a913
+Revises: d5a7c3e9b142
+Create Date: 2026-10-18 17:14:03.118472
+
+"""
+from typing import Sequence, Union
+
+from app.db.online_migrations import alter_online, backfill
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8f2b6d4a913'
+down_revision: Union[str, None] = 'd5a7c3e9b142'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    backfill(
+        'user',
+        {'uid_bin': 'UNHEX(uid)'},
+        where='uid_bin IS NULL',
+        name='user_uid_bin',
+    )
+    alter_online(
+        'user',
+        'MODIFY uid_bin BINARY(16) NOT NULL',
+        'ADD UNIQUE INDEX ix_user_uid_bin (uid_bin)',
+    )
+
+
+def downgrade() -> None:
+    alter_online(
+        'user', 'DROP INDEX ix_user_uid_bin', 'MODIFY uid_bin BINARY(16) NULL'
+    )
@@ -0,0 +1,66 @@
+"""Store user uid as binary
+
+Contract step: uid_bin replaces uid. Both ALTERs only change the table
+metadata. Deploy this revision with the application storing uid as
+BINARY(16) (app.db.types.BinaryUUID): the previous one no longer works after
+it.
+
+Revision ID: f1c9a4e7b350
+Revises: e8f2b6d4a913
+Create Date: 2026-10-18 17:16:45.902113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from app.db.online_migrations import alter_online, backfill
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1c9a4e7b350'
+down_revision: Union[str, None] = 'e8f2b6d4a913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    for event in ('INSERT', 'UPDATE'):
+        op.execute(f"DROP TRIGGER user_uid_bin_{event.lower()}")
+    alter_online(
+        'user', 'DROP INDEX ix_user_uid', 'RENAME INDEX ix_user_uid_bin TO ix_user_uid'
+    )
+    alter_online(
+        'user',
+        'DROP COLUMN uid',
+        'RENAME COLUMN uid_bin TO uid',
+        algorithm='INSTANT',
+        lock=None,
+    )
+
+
+def downgrade() -> None:
+    alter_online(
+        'user',
+        'RENAME COLUMN uid TO uid_bin',
+        'ADD COLUMN uid VARCHAR(32) NULL',
+        algorithm='INSTANT',
+        lock=None,
+    )
+    backfill(
+        'user',
+        {'uid': 'LOWER(HEX(uid_bin))'},
+        where='uid IS NULL',
+        name='user_uid_hex',
+    )
+    alter_online(
+        'user',
+        'MODIFY uid VARCHAR(32) NOT NULL',
+        'RENAME INDEX ix_user_uid TO ix_user_uid_bin',
+        'ADD UNIQUE INDEX ix_user_uid (uid)',
+    )
+    for event in ('INSERT', 'UPDATE'):
+        op.execute(
+            f"CREATE TRIGGER user_uid_bin_{event.lower()} BEFORE {event} ON user "
+            "FOR EACH ROW SET NEW.uid_bin = UNHEX(NEW.uid)"
+        )
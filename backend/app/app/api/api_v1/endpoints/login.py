@@ -1,13 +1,14 @@
 from datetime import timedelta
 from typing import Any, Annotated
 
-from fastapi import APIRouter, Body, Depends, HTTPException, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud, models, schemas
 from app.api import deps
 from app.core import security
+from app.core.hashing import HashingPoolBusyError
 from app.config import settings
 from app.utils import (
     generate_password_reset_token,
@@ -20,20 +21,32 @@
 
 @router.post("/login/access-token", response_model=schemas.Token)
 async def login_access_token(
-    db: Session = Depends(deps.get_db), form_data: OAuth2PasswordRequestForm = Depends()
+    request: Request,
+    db: AsyncSession = Depends(deps.get_db),
+    form_data: OAuth2PasswordRequestForm = Depends(),
 ) -> schemas.Token:
     """
     OAuth2 compatible token login, get an access token for future requests
     """
-    user = await crud.user.authenticate(
-        db, email=form_data.username, password=form_data.password
-    )
+    await deps.check_rate_limit(request, form_data.username)
+    try:
+        user = await crud.user.authenticate(
+            db, email=form_data.username, password=form_data.password
+        )
+    except HashingPoolBusyError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry later.",
+            headers={"Retry-After": "1"},
+        )
     if not user:
+        await deps.record_failed_attempt(request, form_data.username)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Incorrect email or password"
         )
-    elif not crud.user.is_active(user):
+    await deps.record_successful_attempt(request, form_data.username)
+    if not crud.user.is_active(user):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Inactive user"
@@ -58,7 +71,9 @@ def test_token(
 
 
 @router.post("/password-recovery/{email}", response_model=schemas.Msg)
-async def recover_password(email: str, db: Session = Depends(deps.get_db)) -> Any:
+async def recover_password(
+    email: str, db: AsyncSession = Depends(deps.get_db)
+) -> Any:
     """
     Password Recovery
     """
@@ -70,23 +85,32 @@ async def recover_password(email: str, db: Session = Depends(deps.get_db)) -> An
             detail="The user with this username does not exist in the system.",
         )
     password_reset_token = generate_password_reset_token(email=email)
-    token = send_reset_password_email(
-        email_to=user.email, email=email, token=password_reset_token
-    )
+    try:
+        token = await send_reset_password_email(
+            db, email_to=user.email, email=email, token=password_reset_token
+        )
+    except crud.CrudError:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal database server error."
+        )
     return {"msg": f"Password recovery email sent: {token}"}
 
 
 @router.post("/reset-password/", response_model=schemas.Msg)
 async def reset_password(
+    request: Request,
     token: Annotated[str, Body()],
     new_password: Annotated[str, Body()],
-    db: Session = Depends(deps.get_db),
+    db: AsyncSession = Depends(deps.get_db),
 ) -> Any:
     """
     Reset password
     """
     email = verify_password_reset_token(token)
+    await deps.check_rate_limit(request, email)
     if not email:
+        await deps.record_failed_attempt(request)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid token"
@@ -104,6 +128,17 @@ async def reset_password(
         )
     try:
         await crud.user.change_password(db, user_db=user, new_password=new_password)
+    except HashingPoolBusyError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry later.",
+            headers={"Retry-After": "1"},
+        )
+    except crud.CrudStaleDataError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The user changed meanwhile, please retry.",
+        )
     except (crud.CrudError, Exception) as exc:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -3,17 +3,34 @@
 # 
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
-from typing import Any
+import asyncio
+from typing import Any, AsyncIterator, Callable, Literal
 from uuid import uuid4
 
 from argon2 import PasswordHasher
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, Request, Response, status
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import ValidationError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud, models, schemas
 from app.api import deps
+from app.config import settings
+from app.core.etag import etag_matches, latest, make_etag, not_modified, validators
+from app.core.hashing import HashingPoolBusyError
+from app.core.records import (
+    CSV_MEDIA_TYPES,
+    NDJSON_MEDIA_TYPES,
+    RecordError,
+    aiter_csv,
+    aiter_ndjson,
+    aiter_records,
+)
+from app.core.search import search_cache, words
+from app.core.security import import_hashing_pool
+from app.core.serialization import ORJSONResponse, serialize
+from app.db.locks import named_lock
 from schemas import UserInDB
 
 # from crud.base import CrudError
@@ -21,23 +38,114 @@
 
 router = APIRouter()
 
+# Fields of the user resource, all of them are columns of the user table
+USER_FIELDS = tuple(schemas.User.model_fields)
+# Columns the ETag and Last-Modified of users are computed from. The fields are
+# part of the ETag: a new representation of the users invalidates the old tags.
+VALIDATOR_COLUMNS = ("id", "version", "updated_at")
+
+# A bulk import keeps every core busy hashing: one at a time, across the
+# workers and the servers (a MySQL named lock)
+IMPORT_LOCK = "user_import"
+
+
+def _parse_fields(fields: str | None) -> tuple[str, ...]:
+    """Columns named by a comma-separated ``fields`` query parameter, every user
+    field if it is empty."""
+    if not fields:
+        return USER_FIELDS
+    columns = tuple(field.strip() for field in fields.split(","))
+    unknown = set(columns) - set(USER_FIELDS)
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}",
+        )
+    return columns
+
 
 @router.get(
     "/",
     status_code=status.HTTP_200_OK,
     response_model=list[schemas.User],
+    response_class=ORJSONResponse,
 )
 async def read_users(
-    db: Session = Depends(deps.get_db),
+    request: Request,
+    db: AsyncSession = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    after: str | None = None,
+    order_by: Literal["id", "username", "email"] = "id",
+    fields: str | None = None,
     # current_user: models.User = Depends(deps.get_current_active_superuser),
-) -> list[schemas.User]:
+) -> Response:
     """
     Retrieve users.
+
+    Pages are walked with the opaque cursor returned in the X-Next-Cursor header:
+    pass it back as `after` to get the next page. `skip` (offset) is still
+    supported but gets slower as it grows.
+
+    `fields` restricts the users to a comma-separated list of fields. The
+    `order_by` field (and the id) are always returned when paging with a cursor.
+
+    A page has an ETag: send it back in If-None-Match to get a 304 if none of
+    its users changed.
     """
-    users = await crud.user.get_multi(db, skip=skip, limit=limit)
-    return users
+    columns = _parse_fields(fields)
+    if skip and after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="skip and after cannot be used together.",
+        )
+
+    async def read_page(columns: tuple[str, ...]):
+        if skip:
+            rows = await crud.user.get_multi_rows(
+                db, columns=columns, skip=skip, limit=limit
+            )
+            return rows, None
+        try:
+            return await crud.user.get_page_rows(
+                db, columns=columns, after=after, limit=limit, order_by=order_by
+            )
+        except crud.CrudPaginationError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(exc),
+            )
+
+    def page_headers(rows, next_cursor) -> dict[str, str]:
+        etag = make_etag(
+            USER_FIELDS,
+            request.url.query,
+            *(f"{row['id']}.{row['version']}" for row in rows),
+        )
+        headers = validators(etag, latest(row["updated_at"] for row in rows))
+        if next_cursor is not None:
+            headers["X-Next-Cursor"] = next_cursor
+        return headers
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Check the versions of the page before reading the users
+        headers = page_headers(*await read_page(VALIDATOR_COLUMNS))
+        if etag_matches(if_none_match, headers["ETag"]):
+            return not_modified(headers)
+
+    extra = tuple(column for column in VALIDATOR_COLUMNS if column not in columns)
+    rows, next_cursor = await read_page(columns + extra)
+    headers = page_headers(rows, next_cursor)
+    # Drop the columns read for the validators only (a cursor page always has
+    # the id and the sort key)
+    unrequested = set(extra) - ({"id", order_by} if not skip else set())
+    if unrequested:
+        for row in rows:
+            for column in unrequested:
+                del row[column]
+    # Rows are already shaped as the response: no validation pass is needed
+    return ORJSONResponse(rows, headers=headers)
 
 
 @router.post(
@@ -47,22 +155,29 @@ async def read_users(
 )
 async def create_user(
     *,
-    db: Session = Depends(deps.get_db),
+    db: AsyncSession = Depends(deps.get_db),
     user_in: schemas.UserCreate,
     # current_user: models.User = Depends(deps.get_current_active_superuser),
 ) -> models.User:
     """
     Create new user.
     """
-    same_email = await crud.user.get_by_email(db, email=user_in.email)
-    same_username = await crud.user.get_by_username(db, username=user_in.username)
-    if same_email or same_username:
+    # The unique indexes catch duplicates, in the same round-trip as the INSERT
+    # and without the race of a check-then-insert
+    try:
+        user = await crud.user.create(db, obj_in=user_in)
+    except crud.CrudIntegrityError as exc:
+        field = exc.field or "email or username"
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
-            detail="The user with this username already exists in the system.",
+            detail=f"The user with this {field} already exists in the system.",
+        )
+    except HashingPoolBusyError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry later.",
+            headers={"Retry-After": "1"},
         )
-    try:
-        user = await crud.user.create(db, obj_in=user_in)
     except crud.CrudError:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -82,20 +197,312 @@ async def create_user(
     return user
 
 
-@router.get("/{user_id}", response_model=schemas.User)
+@router.patch(
+    "/",
+    status_code=status.HTTP_200_OK,
+)
+async def update_users(
+    *,
+    db: AsyncSession = Depends(deps.get_db),
+    batch_in: schemas.UserBatchUpdate,
+    current_user: models.User = Depends(deps.get_current_active_superuser),
+) -> dict[str, int]:
+    """
+    Apply the same change to many users, superuser only.
+
+    The change (activation, superuser flag, access type) is applied to every
+    listed user in a single statement. Returns the number of users matched.
+    """
+    values = batch_in.model_dump(exclude={"ids"}, exclude_none=True)
+    if not values:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Nothing to update.",
+        )
+    try:
+        updated = await crud.user.update_many(db, ids=batch_in.ids, values=values)
+    except crud.CrudError:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal database server error.",
+        )
+    return {"updated": updated}
+
+
+async def _import_chunk(
+    db: AsyncSession,
+    chunk: list[tuple[int, dict[str, Any] | RecordError]],
+    results: list[dict[str, Any]],
+) -> None:
+    """Validate, deduplicate, hash and insert a chunk of imported records."""
+    candidates: list[tuple[int, schemas.UserCreate]] = []
+    emails, usernames = set(), set()
+    for line, record in chunk:
+        if isinstance(record, RecordError):
+            results.append({"line": line, "status": "invalid", "detail": str(record)})
+            continue
+        try:
+            user_in = schemas.UserCreate.model_validate(record)
+        except ValidationError as exc:
+            detail = "; ".join(
+                f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                for error in exc.errors()
+            )
+            results.append({"line": line, "status": "invalid", "detail": detail})
+            continue
+        if user_in.email in emails or user_in.username in usernames:
+            results.append(
+                {"line": line, "status": "duplicate", "detail": "Duplicated in import"}
+            )
+            continue
+        emails.add(user_in.email)
+        usernames.add(user_in.username)
+        candidates.append((line, user_in))
+
+    taken_emails, taken_usernames = await crud.user.find_taken(
+        db, emails=emails, usernames=usernames
+    )
+    to_create = []
+    for line, user_in in candidates:
+        if user_in.email in taken_emails or user_in.username in taken_usernames:
+            results.append(
+                {"line": line, "status": "duplicate", "detail": "Already exists"}
+            )
+        else:
+            to_create.append((line, user_in))
+
+    hashed_passwords = await asyncio.gather(
+        *(
+            import_hashing_pool.hash(user_in.password.get_secret_value())
+            for _, user_in in to_create
+        )
+    )
+    rows = [
+        {**user_in.model_dump(exclude={"password"}), "hashed_password": hashed}
+        for (_, user_in), hashed in zip(to_create, hashed_passwords)
+    ]
+    if not rows:
+        return
+    try:
+        ids = await crud.user.create_many(db, rows=rows)
+    except crud.CrudIntegrityError:
+        # Lost a race with another writer: find the culprits one row at a time
+        ids = {}
+        for (line, _), row in zip(to_create, rows):
+            try:
+                ids.update(await crud.user.create_many(db, rows=[row]))
+            except crud.CrudIntegrityError:
+                results.append(
+                    {"line": line, "status": "duplicate", "detail": "Already exists"}
+                )
+    for line, user_in in to_create:
+        if user_in.email in ids:
+            results.append(
+                {"line": line, "status": "created", "id": ids[user_in.email]}
+            )
+
+
+@router.post(
+    "/import",
+    status_code=status.HTTP_200_OK,
+    response_class=ORJSONResponse,
+)
+async def import_users(
+    request: Request,
+    db: AsyncSession = Depends(deps.get_db),
+    session_factory: Callable[[], AsyncSession] = Depends(deps.get_session_factory),
+    current_user: models.User = Depends(deps.get_current_active_superuser),
+) -> Response:
+    """
+    Bulk import users from a streamed NDJSON or CSV body, superuser only.
+
+    Each record holds the fields of a user creation. The response reports, for
+    each input line, whether the user was created or why it was rejected. One
+    import runs at a time: another one gets a 409.
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip()
+    results: list[dict[str, Any]] = []
+    # The lock is held by a session of its own: db commits every chunk
+    async with session_factory() as lock_db, named_lock(
+        lock_db, IMPORT_LOCK
+    ) as acquired:
+        if not acquired:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="A user import is already running.",
+            )
+        try:
+            chunk = []
+            async for item in aiter_records(request.stream(), media_type):
+                chunk.append(item)
+                if len(chunk) == settings.USER_IMPORT_CHUNK_SIZE:
+                    await _import_chunk(db, chunk, results)
+                    chunk = []
+            if chunk:
+                await _import_chunk(db, chunk, results)
+        except RecordError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail=str(exc),
+            )
+        except HashingPoolBusyError:
+            # The chunks imported so far stay: importing again reports them as
+            # duplicates
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry later.",
+                headers={"Retry-After": "1"},
+            )
+        except crud.CrudError:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Internal database server error.",
+            )
+    results.sort(key=lambda result: result["line"])
+    created = sum(result["status"] == "created" for result in results)
+    return ORJSONResponse(
+        {"created": created, "failed": len(results) - created, "results": results}
+    )
+
+
+@router.get(
+    "/export",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def export_users(
+    session_factory: Callable[[], AsyncSession] = Depends(deps.get_session_factory),
+    format: Literal["ndjson", "csv"] = "ndjson",
+    fields: str | None = None,
+    is_active: bool | None = None,
+    is_superuser: bool | None = None,
+    current_user: models.User = Depends(deps.get_current_active_superuser),
+) -> StreamingResponse:
+    """
+    Export users as NDJSON or CSV, superuser only.
+
+    The users are streamed from a server-side cursor, in id order, whatever the
+    size of the table. `fields` restricts the export to a comma-separated list
+    of fields; `is_active` and `is_superuser` filter the exported users.
+    """
+    columns = _parse_fields(fields)
+    filters = {
+        column: value
+        for column, value in (("is_active", is_active), ("is_superuser", is_superuser))
+        if value is not None
+    }
+
+    async def batches() -> AsyncIterator[list[dict[str, Any]]]:
+        # The body is sent after the dependencies exit: the stream reads from
+        # a session of its own, closed when it ends or the client goes away
+        async with session_factory() as db:
+            async for batch in crud.user.stream_rows(
+                db,
+                columns=columns,
+                filters=filters,
+                batch_size=settings.USER_EXPORT_BATCH_SIZE,
+            ):
+                yield batch
+
+    if format == "csv":
+        content, media_type = aiter_csv(batches(), columns), CSV_MEDIA_TYPES[0]
+    else:
+        content, media_type = aiter_ndjson(batches()), NDJSON_MEDIA_TYPES[0]
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'},
+    )
+
+
+@router.get(
+    "/search",
+    status_code=status.HTTP_200_OK,
+    response_model=list[schemas.User],
+    response_class=ORJSONResponse,
+)
+async def search_users(
+    db: AsyncSession = Depends(deps.get_db),
+    q: str = Query(min_length=1, max_length=64),
+    limit: int = Query(default=20, ge=1, le=100),
+    after: str | None = None,
+    fields: str | None = None,
+    current_user: models.User = Depends(deps.get_current_active_user),
+) -> Response:
+    """
+    Search users by username, name or city, for the typeahead.
+
+    A user matches if each word of `q` is in one of these: anywhere in a word
+    if it has 3 characters or more, at the start of a word otherwise. Case and
+    accents do not matter. Users come in id order; pass the X-Next-Cursor header
+    back as `after` to get the next page. `fields` is as for the user list.
+
+    Pages are cached for a few seconds: a user who just changed may show up
+    late or with the previous values.
+    """
+    columns = _parse_fields(fields)
+    key = (tuple(words(q)), columns, after, limit)
+    page = search_cache.get(key)
+    if page is None:
+        try:
+            page = await crud.user.search(
+                db, query=q, columns=columns, after=after, limit=limit
+            )
+        except crud.CrudPaginationError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(exc),
+            )
+        search_cache.set(key, page)
+    rows, next_cursor = page
+    headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+    return ORJSONResponse(rows, headers=headers)
+
+
+@router.get(
+    "/{user_id}",
+    response_model=schemas.User,
+    response_class=ORJSONResponse,
+)
 async def read_user_by_id(
     user_id: int,
+    request: Request,
     # current_user: models.User = Depends(deps.get_current_active_user),
-    db: Session = Depends(deps.get_db),
-) -> schemas.User:
+    db: AsyncSession = Depends(deps.get_db),
+) -> Response:
     """
     Get a specific user by id.
+
+    Send the ETag of the user back in If-None-Match to get a 304 if it did not
+    change.
     """
+    not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="The user with this id does not exist in the system.",
+    )
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Only read the version of the user to check it
+        row = await crud.user.get_row(
+            db, obj_id=user_id, columns=("version", "updated_at")
+        )
+        if row is None:
+            raise not_found
+        headers = validators(
+            make_etag(USER_FIELDS, user_id, row["version"]), row["updated_at"]
+        )
+        if etag_matches(if_none_match, headers["ETag"]):
+            return not_modified(headers)
     user = await crud.user.get(db, obj_id=user_id)
+    if not user:
+        raise not_found
     # if user == current_user:
     #     return user
     # if not crud.user.is_superuser(current_user):
     #     raise HTTPException(
     #         status_code=400, detail="The user doesn't have enough privileges"
     #     )
-    return user
+    headers = validators(
+        make_etag(USER_FIELDS, user_id, user.version), user.updated_at
+    )
+    return ORJSONResponse(serialize(schemas.User, user), headers=headers)
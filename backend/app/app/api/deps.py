@@ -3,32 +3,112 @@
 # 
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
-from typing import Annotated, Generator
+import functools
+import hashlib
+import math
+from typing import Annotated, Any, AsyncGenerator, Callable
 
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, status
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 import jwt
 from pydantic import ValidationError
 
-from app.db.session import SessionLocal
+from app.db.session import SessionLocal, recent_writers
 from app.config import settings
 from app import crud, models, schemas
 from app.core import security
+from app.core.ratelimit import rate_limiter
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login/access-token")
 
 
-def get_db() -> Generator:
-    try:
-        db = SessionLocal()
+def _client_ip(request: Request) -> str:
+    return request.client.host if request.client else ""
+
+
+def _client_key(request: Request) -> str:
+    """Identify the client whose writes must be read back: by its bearer token,
+    else by its address."""
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return hashlib.sha256(authorization.encode()).hexdigest()
+    return _client_ip(request)
+
+
+async def check_rate_limit(request: Request, account: str | None = None) -> None:
+    """Turn away with a 429 an attempt from a throttled client IP or on a
+    throttled account, before any password hashing or database work."""
+    if not settings.RATE_LIMIT_ENABLED:
+        return
+    retry_after = await rate_limiter.check(_client_ip(request), account)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many attempts, please retry later.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+async def record_failed_attempt(request: Request, account: str | None = None) -> None:
+    if settings.RATE_LIMIT_ENABLED:
+        await rate_limiter.failed(_client_ip(request), account)
+
+
+async def record_successful_attempt(request: Request, account: str) -> None:
+    if settings.RATE_LIMIT_ENABLED:
+        await rate_limiter.succeeded(_client_ip(request), account)
+
+
+def get_session_factory(request: Request) -> Callable[[], AsyncSession]:
+    """Opens sessions of the client: to the primary if it wrote recently, else
+    the reads go to the replicas.
+
+    A streamed response body must read from a session of its own, opened by
+    the stream: the session of ``get_db`` may be closed before the body is
+    sent (by FastAPI < 0.118).
+    """
+    key = _client_key(request)
+    return functools.partial(
+        SessionLocal,
+        use_primary=recent_writers.get(key) is not None,
+        on_write=lambda: recent_writers.set(key, True),
+    )
+
+
+async def get_db(
+    session_factory: Annotated[
+        Callable[[], AsyncSession], Depends(get_session_factory)
+    ],
+) -> AsyncGenerator[AsyncSession, None]:
+    async with session_factory() as db:
         yield db
-    finally:
-        db.close()
+
+
+def _principal_values(user: models.User) -> dict[str, Any]:
+    """Column values of ``user``, to cache: the instance itself belongs to the
+    session of the request, a rollback of which would expire it."""
+    loaded = inspect(user).dict
+    return {
+        attr.key: loaded[attr.key]
+        for attr in inspect(models.User).column_attrs
+        if attr.key in loaded
+    }
+
+
+def _principal(values: dict[str, Any]) -> models.User:
+    """Detached user holding the cached ``values``, as if loaded by a query."""
+    user = models.User.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        setattr(user, key, value)
+    make_transient_to_detached(user)
+    return user
 
 
 async def get_current_user(
-        db: Annotated[Session, Depends(get_db)],
+        db: Annotated[AsyncSession, Depends(get_db)],
         token: Annotated[str, Depends(oauth2_scheme)]
 ) -> models.User:
     credentials_exception = HTTPException(
@@ -38,12 +118,7 @@ async def get_current_user(
     )
     try:
         # https://pyjwt.readthedocs.io/en/stable/usage.html#registered-claim-names
-        payload = jwt.decode(
-            token,
-            settings.SECRET_KEY,
-            algorithms=[security.ALGORITHM],
-            options={"require": ["exp", "sub"]},
-        )
+        payload = security.decode_token(token, require=("exp", "sub"))
         # user_email: str = payload.get("sub")
         # if user_email is None:
         #     raise credentials_exception
@@ -56,9 +131,17 @@ async def get_current_user(
     # except (jwt.PyJWTError, ValidationError):
         raise credentials_exception
     token_data = schemas.TokenPayload(**payload)
+    values = security.principal_cache.get(token_data.sub)
+    if values is not None:
+        # Attach a copy of the cached user to this session without any SELECT.
+        # Its version may be behind the row (a write by another worker): a
+        # write of the principal must fail with a CrudStaleDataError, or load
+        # the user again first.
+        return await db.merge(_principal(values), load=False)
     user = await crud.user.get_by_email(db, email=token_data.sub)
     if not user:
         raise credentials_exception
+    security.principal_cache.set(token_data.sub, _principal_values(user))
     return user
 
 
@@ -1,10 +1,11 @@
 from pathlib import Path
+from typing import Literal
 
-from pydantic import computed_field, MySQLDsn, EmailStr, AnyHttpUrl
+from pydantic import EmailStr, AnyHttpUrl, PositiveFloat
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import URL
 
 DOTENV = Path(__file__).parent / ".env"
-print(DOTENV)
 
 
 class Settings(BaseSettings):
@@ -17,26 +18,114 @@ class Settings(BaseSettings):
     MYSQL_USER: str
     MYSQL_PASSWORD: str
     MYSQL_DB: str
+    # Read replicas ("host" or "host:port", same credentials as the primary).
+    # A client reads from the primary for READ_YOUR_WRITES_SECONDS after its
+    # own writes; a failing replica is retried after REPLICA_RETRY_SECONDS.
+    MYSQL_REPLICA_HOSTS: list[str] = []
+    READ_YOUR_WRITES_SECONDS: float = 5
+    REPLICA_RETRY_SECONDS: float = 30
+    # Connection pool of each engine (the primary and every replica)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE_SECONDS: int = 3600
+    DB_POOL_TIMEOUT_SECONDS: float = 30
+    DB_POOL_PRE_PING: bool = True
+    # SQL instrumentation: query count and DB time of each request in response
+    # headers (debug only), log of slow statements and of likely N+1 queries
+    SQL_DEBUG_HEADERS: bool = False
+    SLOW_QUERY_THRESHOLD_MS: float = 200
+    N_PLUS_ONE_THRESHOLD: int = 10
+    # Latency, status and size of the responses, served on /metrics
+    METRICS_ENABLED: bool = True
+    # On startup, open the pool connections and start the hashing workers
+    # before serving, instead of on the first requests
+    STARTUP_WARM_UP: bool = True
+    # Pre-fork serving (app.prefork): number of worker processes, None for one
+    # per CPU within the memory available at WORKER_MEMORY_MB per worker (its
+    # heap plus the Argon2 memory of its hashing pool). Each worker has its own
+    # connection pools.
+    WEB_CONCURRENCY: int | None = None
+    WORKER_MEMORY_MB: int = 384
 
     SECRET_KEY: str # = secrets.token_urlsafe(32)
     # 60 minutes * 24 hours * 8 days = 8 days
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8
     EMAIL_RESET_TOKEN_EXPIRE_HOURS: int = 48
 
+    # Argon2 hashing runs in a bounded pool; None sizes it from the CPU count
+    PWD_HASH_EXECUTOR: Literal["thread", "process"] = "thread"
+    PWD_HASH_MAX_WORKERS: int | None = None
+    PWD_HASH_MAX_QUEUE: int = 64
+    # Bulk user import: rows per batch, and a dedicated hashing pool (None uses
+    # every CPU) so that an import does not starve logins.
+    USER_IMPORT_CHUNK_SIZE: int = 500
+    USER_IMPORT_HASH_EXECUTOR: Literal["thread", "process"] = "process"
+    USER_IMPORT_HASH_WORKERS: int | None = None
+    # User export: rows fetched per round trip of the server-side cursor
+    USER_EXPORT_BATCH_SIZE: int = 1000
+
+    # Authenticated users resolved from a token subject; 0 disables the cache
+    USER_CACHE_TTL_SECONDS: int = 60
+    USER_CACHE_MAX_SIZE: int = 1024
+    # Verified JWT payloads; entries never outlive the token "exp" claim
+    TOKEN_CACHE_TTL_SECONDS: int = 300
+    TOKEN_CACHE_MAX_SIZE: int = 4096
+    # User search: each worker keeps a trigram index of the users (about 160
+    # MiB per million users), synced with the writes of the other workers every
+    # SEARCH_SYNC_SECONDS, and caches the result pages of the frequent queries
+    SEARCH_SYNC_SECONDS: float = 30
+    SEARCH_CACHE_TTL_SECONDS: float = 10
+    SEARCH_CACHE_MAX_SIZE: int = 1024
+    # Throttling of login and password reset: token buckets per client IP and
+    # per account, and a lockout of an IP, or of an account from an IP, having
+    # failed RATE_LIMIT_MAX_FAILURES times in the last
+    # RATE_LIMIT_FAILURE_WINDOW_SECONDS.
+    # The state is per worker process unless RATE_LIMIT_STORE (dotted path of
+    # a RateLimitStore class) is shared.
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_IP_BURST: int = 20
+    RATE_LIMIT_IP_PER_MINUTE: PositiveFloat = 30
+    RATE_LIMIT_ACCOUNT_BURST: int = 5
+    RATE_LIMIT_ACCOUNT_PER_MINUTE: PositiveFloat = 5
+    RATE_LIMIT_MAX_FAILURES: int = 10
+    RATE_LIMIT_FAILURE_WINDOW_SECONDS: float = 900
+    RATE_LIMIT_STORE: str = "app.core.ratelimit.MemoryStore"
+
+    # Outgoing email. Requests only queue the messages in the outbox table: a
+    # worker sends them by batches of EMAIL_BATCH_SIZE over one SMTP
+    # connection, at most EMAIL_MAX_PER_SECOND, and retries a failure up to
+    # EMAIL_MAX_ATTEMPTS times with a backoff doubling from
+    # EMAIL_RETRY_BACKOFF_SECONDS.
+    SMTP_HOST: str = "localhost"
+    SMTP_PORT: int = 25
+    SMTP_TLS: bool = False
+    SMTP_USER: str | None = None
+    SMTP_PASSWORD: str | None = None
+    SMTP_TIMEOUT_SECONDS: float = 10
+    EMAILS_FROM_EMAIL: str = "noreply@localhost"
+    EMAILS_FROM_NAME: str | None = None
+    EMAIL_TEMPLATES_DIR: Path = Path(__file__).parent / "email-templates"
+    EMAIL_WORKER_ENABLED: bool = True
+    EMAIL_BATCH_SIZE: int = 50
+    EMAIL_POLL_SECONDS: float = 5
+    EMAIL_MAX_PER_SECOND: float = 10
+    EMAIL_MAX_ATTEMPTS: int = 5
+    EMAIL_RETRY_BACKOFF_SECONDS: float = 30
+    EMAIL_RETRY_BACKOFF_MAX_SECONDS: float = 3600
+
     FIRST_SUPERUSER_EMAIL: EmailStr
     FIRST_SUPERUSER_USERNAME: str
     FIRST_SUPERUSER_PASSWORD: str
 
-    @computed_field(return_type=str)
-    @property
-    def DB_URI(self):
-        return MySQLDsn.build(
-            scheme="mysql+mysqldb",
+    def db_url(self, host: str | None = None, port: int | None = None) -> URL:
+        """URL of the MySQL server, the primary unless another host is given."""
+        return URL.create(
+            drivername="mysql+aiomysql",
             username=self.MYSQL_USER,
             password=self.MYSQL_PASSWORD,
-            host=self.MYSQL_HOST,
-            port=self.MYSQL_PORT,
-            path=self.MYSQL_DB,
+            host=host or self.MYSQL_HOST,
+            port=port or self.MYSQL_PORT,
+            database=self.MYSQL_DB,
         )
 
     model_config = SettingsConfigDict(env_file=DOTENV, env_file_encoding='utf-8')
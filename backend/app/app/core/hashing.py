@@ -0,0 +1,207 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Literal
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+# Each hash allocates memory_cost KiB (46 MiB): the pool size caps the memory
+# used by concurrent logins.
+pwd_hasher = PasswordHasher(
+    time_cost=1,
+    memory_cost=47104,
+    parallelism=1
+)
+
+
+def hash_password(password: str) -> str:
+    return pwd_hasher.hash(password)
+
+
+def check_password(hashed_password: str, password: str) -> bool:
+    try:
+        return pwd_hasher.verify(hashed_password, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+class HashingPoolBusyError(Exception):
+    pass
+
+
+def _timed(fn: Callable[..., Any], *args: Any) -> tuple[bool, Any, float]:
+    """Run ``fn`` in a worker: whether it returned, its result or exception, and
+    how long it ran."""
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    except Exception as exc:  # pylint: disable=broad-except
+        return False, exc, time.perf_counter() - start
+    return True, result, time.perf_counter() - start
+
+
+@dataclass(frozen=True)
+class HashingPoolStats:
+    """Operations admitted (then completed or failed) and rejected, and their
+    time waiting for a worker and running in it."""
+
+    max_workers: int
+    max_queue: int
+    running: int
+    queue_depth: int
+    completed: int
+    failed: int
+    rejected: int
+    wait_total: float
+    wait_max: float
+    hash_total: float
+    hash_max: float
+
+    @property
+    def wait_avg(self) -> float:
+        done = self.completed + self.failed
+        return self.wait_total / done if done else 0.0
+
+    @property
+    def hash_avg(self) -> float:
+        done = self.completed + self.failed
+        return self.hash_total / done if done else 0.0
+
+
+class HashingPool:
+    """Bounded executor for the CPU and memory hungry Argon2 operations.
+
+    At most ``max_workers`` operations run at once and at most ``max_queue`` wait
+    for a worker: beyond that, ``run`` fails fast with ``HashingPoolBusyError``
+    instead of piling up work (and memory) behind a burst of logins.
+
+    argon2-cffi releases the GIL, so a thread pool already hashes in parallel;
+    a process pool isolates the Argon2 memory from the server process.
+
+    A pool given a ``name`` is reported by ``hashing_stats`` (and the metrics).
+    """
+
+    def __init__(
+        self,
+        kind: Literal["thread", "process"] = "thread",
+        max_workers: int | None = None,
+        max_queue: int = 64,
+        name: str | None = None,
+    ):
+        self.kind = kind
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_queue = max_queue
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self._reset_counters()
+        if name is not None:
+            _pools[name] = self
+
+    def _reset_counters(self) -> None:
+        self._pending = self._completed = self._failed = self._rejected = 0
+        self._wait_total = self._wait_max = 0.0
+        self._hash_total = self._hash_max = 0.0
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix="argon2"
+                    )
+            return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        executor = self._get_executor()
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise HashingPoolBusyError
+            self._pending += 1
+        start = time.perf_counter()
+        ok, duration = False, None
+        try:
+            ok, result, duration = await asyncio.get_running_loop().run_in_executor(
+                executor, _timed, fn, *args
+            )
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._pending -= 1
+                if ok:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+                if duration is not None:
+                    # The rest of the time went waiting for a worker (and, for
+                    # a process pool, sending the work and the result)
+                    wait = max(0.0, elapsed - duration)
+                    self._wait_total += wait
+                    self._wait_max = max(self._wait_max, wait)
+                    self._hash_total += duration
+                    self._hash_max = max(self._hash_max, duration)
+        if not ok:
+            raise result
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def verify(self, hashed_password: str, password: str) -> bool:
+        return await self.run(check_password, hashed_password, password)
+
+    async def warm_up(self) -> None:
+        """Start every worker and have it hash once: the workers and their Argon2
+        memory are ready before the first login."""
+        await asyncio.gather(
+            *(self.hash("warm-up password") for _ in range(self.max_workers))
+        )
+
+    def after_fork(self) -> None:
+        """In a forked child: the workers of the executor were not inherited,
+        start new ones on demand. The parent executor must not be shut down
+        from the child."""
+        self._executor = None
+        self._lock = threading.Lock()
+        self._reset_counters()
+
+    def stats(self) -> HashingPoolStats:
+        with self._lock:
+            return HashingPoolStats(
+                max_workers=self.max_workers,
+                max_queue=self.max_queue,
+                running=min(self._pending, self.max_workers),
+                queue_depth=max(0, self._pending - self.max_workers),
+                completed=self._completed,
+                failed=self._failed,
+                rejected=self._rejected,
+                wait_total=self._wait_total,
+                wait_max=self._wait_max,
+                hash_total=self._hash_total,
+                hash_max=self._hash_max,
+            )
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_pools: dict[str, HashingPool] = {}
+
+
+def hashing_stats() -> dict[str, HashingPoolStats]:
+    """Snapshot of the named hashing pools, by name."""
+    return {name: pool.stats() for name, pool in _pools.items()}
@@ -0,0 +1,186 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Rendering and SMTP delivery of the outbox emails.
+
+A template of EMAIL_TEMPLATES_DIR is the HTML body of a message, setting its
+``subject`` variable, e.g.::
+
+    {% set subject = "Welcome " ~ username %}
+    <p>Hello {{ username }}</p>
+
+``Mailer.send_batch`` is blocking: the outbox worker runs it in a thread.
+"""
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formataddr
+from functools import cached_property
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Protocol, Sequence
+
+from config import settings
+
+if TYPE_CHECKING:
+    from jinja2 import Environment, Template
+
+
+class Email(Protocol):
+    template: str
+    email_to: str
+    environment: dict[str, Any]
+
+
+class Mailer:
+    """Sends batches of emails, each over a single SMTP connection, at most
+    ``max_per_second``."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        *,
+        sender: str,
+        templates_dir: Path,
+        tls: bool = False,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        timeout: float = 10,
+        max_per_second: float = 0,
+    ):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.tls = tls
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.interval = 1 / max_per_second if max_per_second > 0 else 0
+        self.templates_dir = templates_dir
+        self._next_send = 0.0
+        self._lock = threading.Lock()
+
+    @cached_property
+    def templates(self) -> "Environment":
+        # Jinja2 is only imported once there is an email to send: it is not
+        # worth its import time at startup
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+        return Environment(
+            loader=FileSystemLoader(self.templates_dir),
+            autoescape=select_autoescape(),
+        )
+
+    def render(self, emails: Sequence[Email]) -> list[EmailMessage | Exception]:
+        """The messages of ``emails``, or the error preventing to render one.
+
+        Each template is loaded once for the batch.
+        """
+        templates: dict[str, "Template | Exception"] = {}
+        messages: list[EmailMessage | Exception] = []
+        for email in emails:
+            if email.template not in templates:
+                try:
+                    templates[email.template] = self.templates.get_template(
+                        f"{email.template}.html"
+                    )
+                except Exception as exc:  # pylint: disable=broad-except
+                    templates[email.template] = exc
+            template = templates[email.template]
+            if isinstance(template, Exception):
+                messages.append(template)
+                continue
+            try:
+                module = template.make_module(email.environment)
+                message = EmailMessage()
+                message["Subject"] = str(getattr(module, "subject", ""))
+                message["From"] = self.sender
+                message["To"] = email.email_to
+                message.set_content(str(module).strip(), subtype="html")
+            except Exception as exc:  # pylint: disable=broad-except
+                messages.append(exc)
+            else:
+                messages.append(message)
+        return messages
+
+    def _pace(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(self._next_send, now)
+            self._next_send = send_at + self.interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.tls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password or "")
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def send_batch(self, emails: Sequence[Email]) -> list[Optional[Exception]]:
+        """Render and send ``emails``; returns None for each email sent, else
+        the error to record.
+
+        An error of the connection fails the emails not sent yet.
+        """
+        messages = self.render(emails)
+        results: list[Optional[Exception]] = [
+            message if isinstance(message, Exception) else None
+            for message in messages
+        ]
+        pending = [i for i, message in enumerate(messages) if results[i] is None]
+        if not pending:
+            return results
+        try:
+            smtp = self._connect()
+        except (OSError, smtplib.SMTPException) as exc:
+            for i in pending:
+                results[i] = exc
+            return results
+        try:
+            for n, i in enumerate(pending):
+                self._pace()
+                try:
+                    smtp.send_message(messages[i])
+                except (
+                    smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError,
+                ) as exc:
+                    results[i] = exc
+                except (OSError, smtplib.SMTPException) as exc:
+                    for j in pending[n:]:
+                        results[j] = exc
+                    break
+        finally:
+            try:
+                smtp.quit()
+            except (OSError, smtplib.SMTPException):
+                smtp.close()
+        return results
+
+
+mailer = Mailer(
+    settings.SMTP_HOST,
+    settings.SMTP_PORT,
+    sender=formataddr(
+        (settings.EMAILS_FROM_NAME or settings.PROJECT_NAME, settings.EMAILS_FROM_EMAIL)
+    ),
+    templates_dir=settings.EMAIL_TEMPLATES_DIR,
+    tls=settings.SMTP_TLS,
+    user=settings.SMTP_USER,
+    password=settings.SMTP_PASSWORD,
+    timeout=settings.SMTP_TIMEOUT_SECONDS,
+    max_per_second=settings.EMAIL_MAX_PER_SECOND,
+)
@@ -0,0 +1,271 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""In-process HTTP metrics, rendered in the Prometheus text format.
+
+``MetricsMiddleware`` records, per route template, the request latency and the
+response size histograms and the count of responses by status, plus the number
+of requests in flight. The statistics of the database connection pools and of
+the password hashing pools are rendered with them. Everything is held in memory by the worker process, the
+overhead is a few microseconds per request (see
+benchmarks/bench_metrics_overhead.py).
+"""
+import time
+from bisect import bisect_left
+from typing import Iterable
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.hashing import hashing_stats
+from app.db.engine import pool_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class HTTPMetrics:
+    """Metrics of the HTTP requests served by this process.
+
+    Updated from the event loop thread only, hence without locking.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.in_flight = 0
+        self.responses: dict[tuple[str, str, int], int] = {}
+        self.latency: dict[tuple[str, str], Histogram] = {}
+        self.size: dict[tuple[str, str], Histogram] = {}
+
+    def observe(
+        self, method: str, route: str, status: int, duration: float, size: int
+    ) -> None:
+        key = (method, route)
+        latency = self.latency.get(key)
+        if latency is None:
+            latency = self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.size[key] = Histogram(SIZE_BUCKETS)
+        latency.observe(duration)
+        self.size[key].observe(size)
+        status_key = (method, route, status)
+        self.responses[status_key] = self.responses.get(status_key, 0) + 1
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_in_flight Requests being served.",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+            "# HELP http_responses_total Responses sent, by route and status.",
+            "# TYPE http_responses_total counter",
+        ]
+        for (method, route, status), count in sorted(self.responses.items()):
+            lines.append(
+                f'http_responses_total{{method="{method}",route="{_escape(route)}",'
+                f'status="{status}"}} {count}'
+            )
+        for name, help_text, histograms in (
+            (
+                "http_request_duration_seconds",
+                "Request latency, by route.",
+                self.latency,
+            ),
+            (
+                "http_response_size_bytes",
+                "Response body size, by route.",
+                self.size,
+            ),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (method, route), histogram in sorted(histograms.items()):
+                labels = f'method="{method}",route="{_escape(route)}"'
+                lines.extend(histogram.render(name, labels))
+        lines.extend(_render_pool_stats())
+        lines.extend(_render_hashing_stats())
+        return "\n".join(lines) + "\n"
+
+
+def _render_pool_stats() -> list[str]:
+    stats = pool_stats()
+    lines = []
+    for field, name, kind, help_text in (
+        ("size", "db_pool_size", "gauge", "Connections kept in the pool."),
+        ("checked_out", "db_pool_checked_out", "gauge", "Connections in use."),
+        (
+            "overflow",
+            "db_pool_overflow",
+            "gauge",
+            "Connections open beyond the pool size.",
+        ),
+        ("checkouts", "db_pool_checkouts_total", "counter", "Connection checkouts."),
+        (
+            "wait_total",
+            "db_pool_wait_seconds_total",
+            "counter",
+            "Time spent waiting for a connection.",
+        ),
+        ("timeouts", "db_pool_timeouts_total", "counter", "Checkouts timed out."),
+        ("opened", "db_pool_opened_total", "counter", "Connections opened."),
+        ("closed", "db_pool_closed_total", "counter", "Connections closed."),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for engine, engine_stats in sorted(stats.items()):
+            value = getattr(engine_stats, field)
+            lines.append(f'{name}{{engine="{_escape(engine)}"}} {value}')
+    return lines
+
+
+def _render_hashing_stats() -> list[str]:
+    stats = hashing_stats()
+    lines = []
+    for field, name, kind, help_text in (
+        ("max_workers", "hashing_pool_workers", "gauge", "Hashing workers."),
+        (
+            "max_queue",
+            "hashing_pool_queue_limit",
+            "gauge",
+            "Operations allowed to wait for a worker.",
+        ),
+        ("running", "hashing_pool_running", "gauge", "Operations running."),
+        (
+            "queue_depth",
+            "hashing_pool_queue_depth",
+            "gauge",
+            "Operations waiting for a worker.",
+        ),
+        (
+            "completed",
+            "hashing_pool_completed_total",
+            "counter",
+            "Operations completed.",
+        ),
+        ("failed", "hashing_pool_failed_total", "counter", "Operations failed."),
+        (
+            "rejected",
+            "hashing_pool_rejected_total",
+            "counter",
+            "Operations rejected, the queue being full.",
+        ),
+        (
+            "wait_total",
+            "hashing_pool_wait_seconds_total",
+            "counter",
+            "Time spent waiting for a worker.",
+        ),
+        (
+            "wait_max",
+            "hashing_pool_wait_seconds_max",
+            "gauge",
+            "Longest wait for a worker.",
+        ),
+        (
+            "hash_total",
+            "hashing_pool_hash_seconds_total",
+            "counter",
+            "Time spent hashing.",
+        ),
+        ("hash_max", "hashing_pool_hash_seconds_max", "gauge", "Longest operation."),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for pool, snapshot in sorted(stats.items()):
+            value = getattr(snapshot, field)
+            lines.append(f'{name}{{pool="{_escape(pool)}"}} {value}')
+    return lines
+
+
+metrics = HTTPMetrics()
+
+
+def _route_template(scope: Scope) -> str:
+    """Template of the route that served the request, with the prefixes of the
+    routers it was included in."""
+    route = scope.get("route")
+    path_format = getattr(route, "path_format", None)
+    if path_format is None:
+        return "unmatched"
+    # Depending on the FastAPI version, the route knows its full path or only
+    # its path inside its router: rebuild the prefix from the request path.
+    concrete = path_format
+    for name, value in scope.get("path_params", {}).items():
+        convertor = route.param_convertors.get(name)
+        if convertor is not None:
+            concrete = concrete.replace(f"{{{name}}}", convertor.to_string(value))
+    path = scope["path"]
+    if path.endswith(concrete):
+        return path[: len(path) - len(concrete)] + path_format
+    return path_format
+
+
+class MetricsMiddleware:
+    """ASGI middleware feeding ``metrics``.
+
+    Requests are labelled by route template (e.g. "/api/v1/users/{user_id}"),
+    the ones matching no route by "unmatched", so that the number of series
+    stays bounded.
+    """
+
+    def __init__(self, app: ASGIApp, registry: HTTPMetrics = metrics):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        self.registry.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            self.registry.in_flight -= 1
+            self.registry.observe(
+                scope["method"],
+                _route_template(scope),
+                status,
+                time.perf_counter() - start,
+                size,
+            )
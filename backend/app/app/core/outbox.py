@@ -0,0 +1,143 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Background delivery of the emails queued in the outbox table.
+
+Requests queue an email with ``queue_email`` and return: ``OutboxWorker``, run
+by each application process, claims the due emails by batches, sends them with
+the mailer and records the outcome. A failed email is retried later with an
+exponential backoff, until EMAIL_MAX_ATTEMPTS.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import crud, schemas
+from app.core.mail import Mailer, mailer
+from app.db.session import SessionLocal
+from app.models.outbox import OutboxEmail, utcnow
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxWorker:
+    # An email claimed by a worker that died is sent again after this delay
+    CLAIM_LEASE_SECONDS = 300
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        mailer: Mailer,
+        *,
+        batch_size: int,
+        poll_interval: float,
+        max_attempts: int,
+        backoff: float,
+        backoff_max: float,
+    ):
+        self.session_factory = session_factory
+        self.mailer = mailer
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def retry_at(self, email: OutboxEmail) -> Optional[datetime]:
+        """When to retry ``email`` after its latest failure, None if never."""
+        attempts = email.attempts + 1
+        if attempts >= self.max_attempts:
+            return None
+        delay = min(self.backoff * 2 ** (attempts - 1), self.backoff_max)
+        return utcnow() + timedelta(seconds=delay)
+
+    async def run_once(self) -> int:
+        """Send a batch of due emails; returns how many were claimed."""
+        async with self.session_factory() as db:
+            emails = await crud.outbox.claim(
+                db, limit=self.batch_size, lease=self.CLAIM_LEASE_SECONDS
+            )
+            if not emails:
+                return 0
+            errors = await asyncio.to_thread(self.mailer.send_batch, emails)
+            sent = [email.id for email, error in zip(emails, errors) if error is None]
+            await crud.outbox.mark_sent(db, ids=sent)
+            for email, error in zip(emails, errors):
+                if error is None:
+                    continue
+                logger.warning(
+                    "Email %d to %s failed: %r", email.id, email.email_to, error
+                )
+                await crud.outbox.mark_failed(
+                    db, db_obj=email, error=repr(error), retry_at=self.retry_at(email)
+                )
+        return len(emails)
+
+    def wake(self) -> None:
+        """Have the worker look for due emails now rather than at its next poll."""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = await self.run_once()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Email outbox delivery failed")
+                claimed = 0
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def after_fork(self) -> None:
+        """In a forked child: the task of the parent is not running here."""
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+outbox_worker = OutboxWorker(
+    SessionLocal,
+    mailer,
+    batch_size=settings.EMAIL_BATCH_SIZE,
+    poll_interval=settings.EMAIL_POLL_SECONDS,
+    max_attempts=settings.EMAIL_MAX_ATTEMPTS,
+    backoff=settings.EMAIL_RETRY_BACKOFF_SECONDS,
+    backoff_max=settings.EMAIL_RETRY_BACKOFF_MAX_SECONDS,
+)
+
+
+async def queue_email(
+    db: AsyncSession, *, template: str, email_to: str, environment: dict[str, Any]
+) -> OutboxEmail:
+    """Store an email in the outbox, for the worker to send it."""
+    email = await crud.outbox.create(
+        db,
+        obj_in=schemas.OutboxEmailCreate(
+            template=template, email_to=email_to, environment=environment
+        ),
+    )
+    outbox_worker.wake()
+    return email
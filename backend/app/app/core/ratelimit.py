@@ -0,0 +1,205 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Throttling of the endpoints checking passwords.
+
+Each attempt takes a token from the bucket of the client IP and from the bucket
+of the account, or from none of them: an attempt turned away by one bucket does
+not drain the other. On top of that, an IP having failed ``max_failures`` times
+within the last ``failure_window`` seconds is turned away until its oldest
+failure leaves the window, and so is an account from an IP having failed that
+often on it. The lockout of an account is per IP: failures from an attacker do
+not lock its owner out, the account bucket still slows down guesses spread
+over many IPs.
+
+The state lives in a ``RateLimitStore``: ``MemoryStore`` keeps it in the worker
+process, so each worker applies the limits on its own. A store shared by the
+workers (e.g. backed by Redis) implements the same methods and is selected with
+the RATE_LIMIT_STORE setting.
+"""
+import importlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Optional, Sequence
+
+from config import settings
+
+# Key of a token bucket, the number of tokens it holds at most, and the number
+# of tokens it gets back per second
+Bucket = tuple[str, float, float]
+
+
+class RateLimitStore(ABC):
+    @abstractmethod
+    async def take(self, buckets: Sequence[Bucket]) -> float:
+        """Take a token from each of ``buckets`` if they all have one, else
+        from none of them, atomically.
+
+        Returns 0 if the tokens were taken, else the seconds until they all
+        have one.
+        """
+
+    @abstractmethod
+    async def add_failure(self, key: str, window: float) -> None:
+        """Record a failure of ``key``, remembered for ``window`` seconds."""
+
+    @abstractmethod
+    async def failures(self, key: str, window: float) -> tuple[int, float]:
+        """Failures of ``key`` in the last ``window`` seconds, and the seconds
+        until the oldest of them leaves the window."""
+
+    @abstractmethod
+    async def reset_failures(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class MemoryStore(RateLimitStore):
+    """In-process store, keeping the ``maxsize`` most recently used keys."""
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._failures: OrderedDict[str, deque[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _trim(self, data: OrderedDict) -> None:
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    async def take(self, buckets: Sequence[Bucket]) -> float:
+        now = time.monotonic()
+        with self._lock:
+            levels = {}
+            for key, capacity, rate in buckets:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                levels[key] = min(capacity, tokens + (now - updated) * rate)
+            wait = max(
+                (max(0.0, (1 - levels[key]) / rate) for key, _, rate in buckets),
+                default=0.0,
+            )
+            taken = 0 if wait else 1
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens - taken, now)
+                self._buckets.move_to_end(key)
+            self._trim(self._buckets)
+        return wait
+
+    def _recent(self, key: str, window: float, now: float) -> deque[float]:
+        failures = self._failures.get(key)
+        if failures is None:
+            return deque()
+        while failures and failures[0] <= now - window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+        return failures
+
+    async def add_failure(self, key: str, window: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, window, now)
+            failures.append(now)
+            self._failures[key] = failures
+            self._failures.move_to_end(key)
+            self._trim(self._failures)
+
+    async def failures(self, key: str, window: float) -> tuple[int, float]:
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, window, now)
+            if not failures:
+                return 0, 0.0
+            return len(failures), failures[0] + window - now
+
+    async def reset_failures(self, key: str) -> None:
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+            self._failures.clear()
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        store: RateLimitStore,
+        *,
+        ip_burst: float,
+        ip_per_minute: float,
+        account_burst: float,
+        account_per_minute: float,
+        max_failures: int,
+        failure_window: float,
+    ):
+        if ip_per_minute <= 0 or account_per_minute <= 0:
+            raise ValueError("The rates must be positive")
+        self.store = store
+        self.ip_burst = ip_burst
+        self.ip_rate = ip_per_minute / 60
+        self.account_burst = account_burst
+        self.account_rate = account_per_minute / 60
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+
+    def _buckets(self, ip: str, account: Optional[str]) -> list[Bucket]:
+        buckets = [(f"ip:{ip}", self.ip_burst, self.ip_rate)]
+        if account:
+            buckets.append(
+                (f"account:{account.lower()}", self.account_burst, self.account_rate)
+            )
+        return buckets
+
+    @staticmethod
+    def _failure_keys(ip: str, account: Optional[str]) -> list[str]:
+        keys = [f"ip:{ip}"]
+        if account:
+            keys.append(f"account:{account.lower()}|ip:{ip}")
+        return keys
+
+    async def check(self, ip: str, account: Optional[str] = None) -> float:
+        """Admit an attempt from ``ip`` on ``account`` (None if unknown yet).
+
+        Returns 0 if admitted, else the seconds after which to retry. A turned
+        away attempt takes no token.
+        """
+        for key in self._failure_keys(ip, account):
+            count, retry_after = await self.store.failures(key, self.failure_window)
+            if count >= self.max_failures:
+                return retry_after
+        return await self.store.take(self._buckets(ip, account))
+
+    async def failed(self, ip: str, account: Optional[str] = None) -> None:
+        """Record a failed attempt (wrong password, invalid token)."""
+        for key in self._failure_keys(ip, account):
+            await self.store.add_failure(key, self.failure_window)
+
+    async def succeeded(self, ip: str, account: str) -> None:
+        """Forget the failures on ``account`` from ``ip`` after a successful
+        attempt."""
+        await self.store.reset_failures(self._failure_keys(ip, account)[1])
+
+
+def _build_store(path: str) -> RateLimitStore:
+    module, _, name = path.rpartition(".")
+    return getattr(importlib.import_module(module), name)()
+
+
+rate_limiter = RateLimiter(
+    _build_store(settings.RATE_LIMIT_STORE),
+    ip_burst=settings.RATE_LIMIT_IP_BURST,
+    ip_per_minute=settings.RATE_LIMIT_IP_PER_MINUTE,
+    account_burst=settings.RATE_LIMIT_ACCOUNT_BURST,
+    account_per_minute=settings.RATE_LIMIT_ACCOUNT_PER_MINUTE,
+    max_failures=settings.RATE_LIMIT_MAX_FAILURES,
+    failure_window=settings.RATE_LIMIT_FAILURE_WINDOW_SECONDS,
+)
@@ -0,0 +1,106 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Incremental NDJSON and CSV readers and writers for streamed bodies."""
+import csv
+import io
+from typing import Any, AsyncIterable, AsyncIterator, Sequence
+
+import orjson
+
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/jsonl")
+CSV_MEDIA_TYPES = ("text/csv",)
+
+
+class RecordError(ValueError):
+    pass
+
+
+async def aiter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Split a stream of byte chunks into lines, without buffering the whole body."""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if pending:
+        yield pending.rstrip(b"\r")
+
+
+async def aiter_records(
+    chunks: AsyncIterable[bytes], media_type: str
+) -> AsyncIterator[tuple[int, dict[str, Any] | RecordError]]:
+    """Yield ``(line number, record)`` for each non-blank line of an NDJSON or
+    CSV stream. A line that cannot be parsed yields a ``RecordError`` instead of
+    a record, so that the caller can report it and go on.
+
+    CSV streams start with a header line; quoted fields cannot span lines.
+    """
+    if media_type not in NDJSON_MEDIA_TYPES + CSV_MEDIA_TYPES:
+        raise RecordError(f"Unsupported media type: {media_type}")
+    header = None
+    number = 0
+    async for raw_line in aiter_lines(chunks):
+        number += 1
+        try:
+            line = raw_line.decode()
+        except UnicodeDecodeError:
+            yield number, RecordError("Invalid UTF-8")
+            continue
+        if not line.strip():
+            continue
+        if media_type in NDJSON_MEDIA_TYPES:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError as exc:
+                yield number, RecordError(f"Invalid JSON: {exc}")
+                continue
+            if not isinstance(record, dict):
+                yield number, RecordError("A record must be a JSON object")
+                continue
+            yield number, record
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = values
+            continue
+        if len(values) != len(header):
+            yield number, RecordError(
+                f"Expected {len(header)} CSV fields, got {len(values)}"
+            )
+            continue
+        # Empty CSV cells stand for missing values
+        yield number, {key: value for key, value in zip(header, values) if value}
+
+
+async def aiter_ndjson(
+    batches: AsyncIterable[list[dict[str, Any]]],
+) -> AsyncIterator[bytes]:
+    """Render batches of records as NDJSON, one chunk per batch."""
+    async for batch in batches:
+        if batch:
+            yield b"\n".join(orjson.dumps(record) for record in batch) + b"\n"
+
+
+async def aiter_csv(
+    batches: AsyncIterable[list[dict[str, Any]]], columns: Sequence[str]
+) -> AsyncIterator[bytes]:
+    """Render batches of records as CSV, a header line first then one chunk per
+    batch. None values are written as empty cells."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    yield buffer.getvalue().encode()
+    async for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            [
+                ["" if record[column] is None else record[column] for column in columns]
+                for record in batch
+            ]
+        )
+        yield buffer.getvalue().encode()
@@ -0,0 +1,197 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""In-process trigram index of the users, for the search and typeahead.
+
+Text is folded (case and accents) and split into words. Each word is indexed
+under its trigrams, padded with two spaces before and one after: "anne" under
+"  a", " an", "ann", "nne" and "ne ". A query word of three characters or more
+matches the words containing it, a shorter one the words starting with it.
+
+The postings are sorted arrays of user ids, 4 bytes per entry. The index is a
+superset of the truth: a posting may stay after the user changed or went
+away, the rows it returns are checked against the database. It is kept up to
+date by the CRUD writes of the process and, for the writes of the other
+processes, by reading the users updated since the last sync (see
+``crud.user.sync_search_index``).
+"""
+import asyncio
+import bisect
+import re
+import time
+import unicodedata
+from array import array
+from datetime import datetime
+from typing import Any, Iterable, Iterator, Mapping, Optional
+
+from app.core.cache import TTLCache
+from config import settings
+
+# Columns of the user table the search looks into
+SEARCH_FIELDS = ("username", "name", "city")
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def words(text: Optional[str]) -> list[str]:
+    """Words of ``text``, lowercase and without accents."""
+    if not text:
+        return []
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return _WORD.findall(
+        "".join(char for char in decomposed if not unicodedata.combining(char))
+    )
+
+
+def _word_grams(word: str) -> Iterator[str]:
+    padded = f"  {word} "
+    return (padded[i : i + 3] for i in range(len(padded) - 2))
+
+
+def text_grams(texts: Iterable[Optional[str]]) -> set[str]:
+    """Trigrams ``texts`` are indexed under."""
+    return {gram for text in texts for word in words(text) for gram in _word_grams(word)}
+
+
+def query_grams(query_words: Iterable[str]) -> set[str]:
+    """Trigrams every match of ``query_words`` is indexed under."""
+    grams = set()
+    for word in query_words:
+        if len(word) < 3:
+            grams.add(f"  {word}"[-3:])
+        else:
+            grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def matches(query_words: Iterable[str], texts: Iterable[Optional[str]]) -> bool:
+    """Whether every query word is in a word of ``texts``: anywhere in it if it
+    has three characters or more, at its start otherwise."""
+    text_words = [word for text in texts for word in words(text)]
+    return all(
+        any(
+            word.startswith(query) if len(query) < 3 else query in word
+            for word in text_words
+        )
+        for query in query_words
+    )
+
+
+def _contains(posting: array, user_id: int) -> bool:
+    i = bisect.bisect_left(posting, user_id)
+    return i < len(posting) and posting[i] == user_id
+
+
+class SearchIndex:
+    """Trigram postings of the users, and the state of their sync with the
+    database."""
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self._postings: dict[str, array] = {}
+        self.loaded = False
+        # Latest updated_at read from the database, and when
+        self.watermark: Optional[datetime] = None
+        self.synced_at = 0.0
+        self.lock = asyncio.Lock()
+
+    def add(self, user_id: int, texts: Iterable[Optional[str]]) -> None:
+        for gram in text_grams(texts):
+            posting = self._postings.get(gram)
+            if posting is None:
+                self._postings[gram] = array("I", (user_id,))
+            elif posting[-1] < user_id:
+                # New users come in id order: the common case is an append
+                posting.append(user_id)
+            else:
+                i = bisect.bisect_left(posting, user_id)
+                if i == len(posting) or posting[i] != user_id:
+                    posting.insert(i, user_id)
+
+    def remove(self, user_id: int, texts: Iterable[Optional[str]]) -> None:
+        for gram in text_grams(texts):
+            posting = self._postings.get(gram)
+            if posting is None:
+                continue
+            i = bisect.bisect_left(posting, user_id)
+            if i < len(posting) and posting[i] == user_id:
+                del posting[i]
+                if not posting:
+                    del self._postings[gram]
+
+    def replace(
+        self,
+        user_id: int,
+        old: Mapping[str, Optional[str]],
+        new: Mapping[str, Optional[str]],
+    ) -> None:
+        """Reindex a user whose fields changed from ``old`` to ``new`` (the
+        fields missing from ``new`` did not change)."""
+        new = {**old, **new}
+        stale = text_grams(old.values()) - text_grams(new.values())
+        for gram in stale:
+            posting = self._postings.get(gram)
+            if posting is not None and _contains(posting, user_id):
+                posting.remove(user_id)
+                if not posting:
+                    del self._postings[gram]
+        self.add(user_id, new.values())
+
+    def candidates(self, query_words: list[str], after: int = 0) -> Iterator[int]:
+        """Ids greater than ``after`` of the users that may match
+        ``query_words``, in ascending order.
+
+        Walks the shortest posting and looks the others up by bisection: a page
+        costs its length, not the number of matches. The postings may change
+        between two ids (the caller awaits in between): the walk seeks after
+        the last id rather than keeping a position.
+        """
+        postings = []
+        for gram in query_grams(query_words):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return
+            postings.append(posting)
+        if not postings:
+            return
+        postings.sort(key=len)
+        shortest, others = postings[0], postings[1:]
+        user_id = after
+        while True:
+            i = bisect.bisect_right(shortest, user_id)
+            if i == len(shortest):
+                return
+            user_id = shortest[i]
+            if all(_contains(posting, user_id) for posting in others):
+                yield user_id
+
+    def due(self) -> bool:
+        """Whether to sync with the database before searching."""
+        return (
+            not self.loaded
+            or time.monotonic() - self.synced_at >= self.sync_interval
+        )
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "grams": len(self._postings),
+            "postings": sum(len(posting) for posting in self._postings.values()),
+        }
+
+    def clear(self) -> None:
+        self._postings = {}
+        self.loaded = False
+        self.watermark = None
+        self.synced_at = 0.0
+        # A lock possibly held in the parent process or bound to another loop
+        self.lock = asyncio.Lock()
+
+
+user_index = SearchIndex(sync_interval=settings.SEARCH_SYNC_SECONDS)
+
+# Result pages of the frequent queries, typeahead prefixes above all
+search_cache: TTLCache[tuple, tuple[list[dict[str, Any]], Optional[str]]] = TTLCache(
+    maxsize=settings.SEARCH_CACHE_MAX_SIZE, ttl=settings.SEARCH_CACHE_TTL_SECONDS
+)
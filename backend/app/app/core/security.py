@@ -1,15 +1,40 @@
+import hashlib
+import os
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Any
+from typing import Any, Sequence
 
 import jwt
-from argon2 import PasswordHasher
 
+from app.core.cache import TTLCache
+from app.core.hashing import HashingPool
 from config import settings
 
-pwd_hasher = PasswordHasher(
-    time_cost=1,
-    memory_cost=47104,
-    parallelism=1
+hashing_pool = HashingPool(
+    kind=settings.PWD_HASH_EXECUTOR,
+    max_workers=settings.PWD_HASH_MAX_WORKERS,
+    max_queue=settings.PWD_HASH_MAX_QUEUE,
+    name="login",
+)
+# Bulk imports hash a whole chunk at once, on every core
+import_hashing_pool = HashingPool(
+    kind=settings.USER_IMPORT_HASH_EXECUTOR,
+    max_workers=settings.USER_IMPORT_HASH_WORKERS or os.cpu_count(),
+    max_queue=settings.USER_IMPORT_CHUNK_SIZE,
+    name="import",
+)
+
+# Column values of the users resolved by deps.get_current_user, keyed by token
+# subject (email).
+# CRUDUser invalidates an entry whenever it writes that user.
+principal_cache: TTLCache[str, Any] = TTLCache(
+    maxsize=settings.USER_CACHE_MAX_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS
+)
+
+# Verified JWT payloads, keyed by the token SHA-256 digest: a client sends the
+# same bearer token on every request until it expires.
+token_cache: TTLCache[bytes, dict[str, Any]] = TTLCache(
+    maxsize=settings.TOKEN_CACHE_MAX_SIZE, ttl=settings.TOKEN_CACHE_TTL_SECONDS
 )
 
 ALGORITHM = "HS256"
@@ -29,9 +54,33 @@ def create_access_token(
     return encoded_jwt
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_hasher.verify(hashed_password, plain_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await hashing_pool.verify(hashed_password, plain_password)
 
 
-def get_password_hash(password: str) -> str:
-    return pwd_hasher.hash(password)
+async def get_password_hash(password: str) -> str:
+    return await hashing_pool.hash(password)
+
+
+def decode_token(token: str, require: Sequence[str] = ()) -> dict[str, Any]:
+    """Verify and decode a JWT, or raise a ``jwt.PyJWTError``.
+
+    Only valid tokens are cached, until their ``exp`` claim at the latest. The
+    returned payload is shared with later calls and must not be modified.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = jwt.decode(
+            token,
+            settings.SECRET_KEY,
+            algorithms=[ALGORITHM],
+            options={"require": list(require)},
+        )
+        ttl = payload["exp"] - time.time() if "exp" in payload else None
+        token_cache.set(key, payload, ttl=ttl)
+        return payload
+    for claim in require:
+        if claim not in payload:
+            raise jwt.MissingRequiredClaimError(claim)
+    return payload
@@ -0,0 +1,41 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+from functools import lru_cache
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered by orjson, already serialized bytes are sent as is."""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return orjson.dumps(content)
+
+
+@lru_cache(maxsize=None)
+def type_adapter(tp: Any) -> TypeAdapter:
+    """Return the TypeAdapter of ``tp``, its validator and serializer are built
+    only once."""
+    return TypeAdapter(tp)
+
+
+def prime(*types: Any) -> None:
+    """Build the validators and serializers of ``types`` now rather than on the
+    first request needing them."""
+    for tp in types:
+        type_adapter(tp)
+
+
+def serialize(tp: Any, obj: Any) -> bytes:
+    """Validate ``obj`` (an ORM instance, a mapping or a list of them) as ``tp``
+    and dump it as JSON in a single pass."""
+    adapter = type_adapter(tp)
+    return adapter.dump_json(adapter.validate_python(obj, from_attributes=True))
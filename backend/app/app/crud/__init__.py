@@ -3,8 +3,14 @@
 # 
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
-from .base import CrudError
+from .base import (
+    CrudError,
+    CrudIntegrityError,
+    CrudPaginationError,
+    CrudStaleDataError,
+)
 from .user import user
+from .outbox import outbox
 
 # For a new basic set of CRUD operations you could just do
 
@@ -1,10 +1,37 @@
-from typing import Any, Generic, Optional, Type, TypeVar, cast
+import base64
+import binascii
+import json
+import re
+import uuid
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Generic,
+    Mapping,
+    Optional,
+    Sequence,
+    Type,
+    TypeVar,
+    cast,
+)
 
 from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import (
+    Column,
+    ColumnElement,
+    Select,
+    UniqueConstraint,
+    and_,
+    inspect,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 
 from app.db.base_class import Base
 
@@ -18,98 +45,387 @@ class CrudError(Exception):
 
 
 class CrudIntegrityError(CrudError):
+    def __init__(self, *args: Any, field: str | None = None):
+        """``field`` names the column whose unique constraint was violated, when
+        it is known."""
+        super().__init__(*args)
+        self.field = field
+
+
+class CrudPaginationError(CrudError):
     pass
 
 
+class CrudStaleDataError(CrudError):
+    """The row changed or went away since the object was read: its version
+    counter no longer matches."""
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    raise TypeError(f"Cannot put {type(value).__name__} in a cursor")
+
+
+def _from_json(column: Column, value: Any) -> Any:
+    """Sort key value of ``column`` read back from a cursor."""
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if issubclass(python_type, datetime):
+        return datetime.fromisoformat(value)
+    if issubclass(python_type, uuid.UUID):
+        return uuid.UUID(hex=value)
+    return value
+
+
+def encode_cursor(order_by: str, values: list[Any]) -> str:
+    """Opaque cursor pointing after the row having the given sort key ``values``."""
+    raw = json.dumps([order_by, values], separators=(",", ":"), default=_to_json)
+    return base64.urlsafe_b64encode(raw.encode()).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str, order_by: str) -> list[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_order_by, values = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError) as exc:
+        raise CrudPaginationError(f"Invalid cursor: {cursor}") from exc
+    if cursor_order_by != order_by or not isinstance(values, list):
+        raise CrudPaginationError(f"Cursor does not apply to order by {order_by}")
+    return values
+
+
+def _after(keyset: list[Column], values: list[Any]) -> ColumnElement[bool]:
+    """Rows after ``values`` in ``keyset`` order: (a > :a) OR (a = :a AND b > :b)
+    rather than the row value (a, b) > (:a, :b), which MySQL does not always
+    turn into a range of the index. The redundant a >= :a leads to that range.
+    """
+    condition = or_(
+        *(
+            and_(
+                *(column == value for column, value in zip(keyset[:i], values)),
+                keyset[i] > values[i],
+            )
+            for i in range(len(keyset))
+        )
+    )
+    if len(keyset) > 1:
+        condition = and_(keyset[0] >= values[0], condition)
+    return condition
+
+
 class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     def __init__(self, model: Type[ModelType]):
         """ CRUD object with default methods to Create, Read, Update, Delete (CRUD)."""
         self.model = model
 
-    async def get(self, db: Session, obj_id: Any) -> Optional[ModelType]:
+    def _conflicting_field(self, exc: IntegrityError) -> Optional[str]:
+        """Column of the unique constraint violated by ``exc``, found in the
+        driver message: "Duplicate entry ... for key 'user.ix_user_email'" from
+        MySQL, "UNIQUE constraint failed: user.email" from SQLite."""
+        message = str(exc.orig)
+        table = self.model.__table__
+        for column in table.columns:
+            names = [f"{table.name}.{column.name}"]
+            names += [
+                index.name
+                for index in table.indexes
+                if index.unique and list(index.columns) == [column]
+            ]
+            names += [
+                constraint.name
+                for constraint in table.constraints
+                if isinstance(constraint, UniqueConstraint)
+                and list(constraint.columns) == [column]
+                and constraint.name
+            ]
+            if any(re.search(rf"\b{re.escape(name)}\b", message) for name in names):
+                return column.name
+        return None
+
+    async def get(self, db: AsyncSession, obj_id: Any) -> Optional[ModelType]:
         try:
-            obj = db.get(self.model, obj_id)
+            obj = await db.get(self.model, obj_id)
         except SQLAlchemyError as exc:
             raise CrudError from exc
         return obj
 
+    async def get_row(
+        self, db: AsyncSession, *, obj_id: Any, columns: Sequence[str]
+    ) -> Optional[dict[str, Any]]:
+        """Only ``columns`` of the row ``obj_id``, None if there is no such row."""
+        (pk,) = inspect(self.model).primary_key
+        stmt = select(*self._columns(columns)).where(pk == obj_id)
+        try:
+            row = (await db.execute(stmt)).mappings().first()
+        except SQLAlchemyError as exc:
+            raise CrudError from exc
+        return None if row is None else dict(row)
+
     async def get_multi(
-        self, db: Session, *, skip: int = 0, limit: int = 100
+        self, db: AsyncSession, *, skip: int = 0, limit: int = 100
     ) -> list[ModelType]:
         try:
             obj_list = cast(
                 list[ModelType],
-                db.scalars(select(self.model).offset(skip).limit(limit)).all(),
+                (
+                    await db.scalars(select(self.model).offset(skip).limit(limit))
+                ).all(),
             )
         except SQLAlchemyError as exc:
             raise CrudError from exc
         return obj_list
 
-    async def get_all(self, db: Session) -> list[ModelType]:
+    def _keyset(self, order_by: str) -> list[Column]:
+        """Sort key of a keyset page: the indexed column, then the primary key to
+        break ties."""
+        column = self.model.__table__.columns.get(order_by)
+        if column is None or not (column.primary_key or column.index or column.unique):
+            raise CrudPaginationError(f"Cannot paginate on column: {order_by}")
+        pk = list(inspect(self.model).primary_key)
+        return pk if column.primary_key else [column, *pk]
+
+    def _keyset_page(
+        self, stmt: Select, keyset: list[Column], after: str | None, order_by: str
+    ) -> Select:
+        stmt = stmt.order_by(*keyset)
+        if after is not None:
+            values = decode_cursor(after, order_by)
+            if len(values) != len(keyset):
+                raise CrudPaginationError(f"Invalid cursor: {after}")
+            try:
+                values = [
+                    _from_json(column, value) for column, value in zip(keyset, values)
+                ]
+            except (TypeError, ValueError) as exc:
+                raise CrudPaginationError(f"Invalid cursor: {after}") from exc
+            stmt = stmt.where(_after(keyset, values))
+        return stmt
+
+    async def get_page(
+        self,
+        db: AsyncSession,
+        *,
+        after: str | None = None,
+        limit: int = 100,
+        order_by: str = "id",
+    ) -> tuple[list[ModelType], Optional[str]]:
+        """Keyset (cursor) pagination on an indexed column.
+
+        Rows come after the ``after`` cursor in ``order_by`` order. Unlike an
+        OFFSET, the index seek makes a deep page as cheap as the first one.
+        Returns the page and the cursor of the next one, None on the last page.
+        """
+        keyset = self._keyset(order_by)
+        stmt = self._keyset_page(select(self.model), keyset, after, order_by)
+        try:
+            obj_list = cast(list[ModelType], (await db.scalars(stmt.limit(limit))).all())
+        except SQLAlchemyError as exc:
+            raise CrudError from exc
+        if len(obj_list) < limit:
+            return obj_list, None
+        mapper = inspect(self.model)
+        values = [
+            getattr(obj_list[-1], mapper.get_property_by_column(column).key)
+            for column in keyset
+        ]
+        return obj_list, encode_cursor(order_by, values)
+
+    def _columns(self, columns: Sequence[str]) -> list[Column]:
+        table_columns = self.model.__table__.columns
+        try:
+            return [table_columns[name] for name in columns]
+        except KeyError as exc:
+            raise CrudError(f"Unknown column: {exc.args[0]}") from exc
+
+    async def get_multi_rows(
+        self,
+        db: AsyncSession,
+        *,
+        columns: Sequence[str],
+        skip: int = 0,
+        limit: int = 100,
+    ) -> list[dict[str, Any]]:
+        """Like ``get_multi``, but only select ``columns`` and return plain rows,
+        without the cost of building ORM instances."""
+        stmt = select(*self._columns(columns)).offset(skip).limit(limit)
+        try:
+            return [dict(row) for row in (await db.execute(stmt)).mappings()]
+        except SQLAlchemyError as exc:
+            raise CrudError from exc
+
+    async def get_page_rows(
+        self,
+        db: AsyncSession,
+        *,
+        columns: Sequence[str],
+        after: str | None = None,
+        limit: int = 100,
+        order_by: str = "id",
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """Like ``get_page``, but only select ``columns`` and return plain rows.
+
+        The sort key columns, from which the cursor is built, are always selected.
+        """
+        keyset = self._keyset(order_by)
+        selected = self._columns(
+            [*columns, *(column.name for column in keyset if column.name not in columns)]
+        )
+        stmt = self._keyset_page(select(*selected), keyset, after, order_by)
+        try:
+            result = await db.execute(stmt.limit(limit))
+            rows = [dict(row) for row in result.mappings()]
+        except SQLAlchemyError as exc:
+            raise CrudError from exc
+        if len(rows) < limit:
+            return rows, None
+        values = [rows[-1][column.name] for column in keyset]
+        return rows, encode_cursor(order_by, values)
+
+    async def stream_rows(
+        self,
+        db: AsyncSession,
+        *,
+        columns: Sequence[str],
+        filters: Mapping[str, Any] | None = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[list[dict[str, Any]]]:
+        """Yield every row matching ``filters`` (column equality), in primary key
+        order and in batches of ``batch_size``.
+
+        Rows are read from a server-side cursor, ``batch_size`` at a time: the
+        memory used does not depend on the size of the table.
+        """
+        stmt = select(*self._columns(columns)).order_by(
+            *inspect(self.model).primary_key
+        )
+        if filters:
+            filter_columns = self._columns(list(filters))
+            stmt = stmt.where(
+                *(
+                    column == value
+                    for column, value in zip(filter_columns, filters.values())
+                )
+            )
+        try:
+            result = await db.stream(stmt.execution_options(yield_per=batch_size))
+            async for partition in result.mappings().partitions():
+                yield [dict(row) for row in partition]
+        except SQLAlchemyError as exc:
+            raise CrudError from exc
+
+    async def get_all(self, db: AsyncSession) -> list[ModelType]:
         try:
-            obj_list = db.query(self.model).all()
             obj_list = cast(
-                list[ModelType], db.scalars(select(self.model)).all()
+                list[ModelType], (await db.scalars(select(self.model))).all()
             )
         except SQLAlchemyError as exc:
             raise CrudError from exc
         return obj_list
 
-    async def create(self, db: Session, *, obj_in: CreateSchemaType) -> ModelType:
+    async def create(self, db: AsyncSession, *, obj_in: CreateSchemaType) -> ModelType:
         obj_in_data = jsonable_encoder(obj_in)
         db_obj = self.model(**obj_in_data)
         db.add(db_obj)
         try:
-            db.commit()
+            await db.commit()
+        except IntegrityError as exc:
+            await db.rollback()
+            raise CrudIntegrityError(field=self._conflicting_field(exc)) from exc
         except SQLAlchemyError as exc:
-            db.rollback()
+            await db.rollback()
             raise CrudError() from exc
-        db.refresh(db_obj)
+        # The primary key comes back with the INSERT and column defaults are set
+        # client-side: the object is complete without a refresh query
         return db_obj
 
     async def update(
         self,
-        db: Session,
+        db: AsyncSession,
         *,
         db_obj: ModelType,
         obj_in: UpdateSchemaType | dict[str, Any]
     ) -> ModelType:
-        updated = False
-        obj_data = jsonable_encoder(db_obj)
+        """Apply the fields of ``obj_in`` that are set, not None and differ from
+        ``db_obj``.
 
+        Only the changed columns are sent, in a single UPDATE, and the row is not
+        read back: the object already holds the new values.
+        """
         if isinstance(obj_in, dict):
             update_data = obj_in
         else:
-            update_data = obj_in.model_dump(exclude_unset=True)
-
-        for field in obj_data:
-            if (
-                field in update_data
-                and update_data[field] is not None
-                and getattr(db_obj, field) != update_data[field]
-            ):
-                setattr(db_obj, field, update_data[field])
-                updated = True
-
-        if updated:
-            try:
-                db.commit()
-            except SQLAlchemyError as exc:
-                db.rollback()
-                raise CrudError() from exc
-            db.refresh(db_obj)
+            update_data = obj_in.model_dump(exclude_unset=True, mode="json")
+        column_attrs = inspect(self.model).column_attrs
+        changes = {
+            field: value
+            for field, value in update_data.items()
+            if field in column_attrs
+            and value is not None
+            and getattr(db_obj, field) != value
+        }
+        if not changes:
             return db_obj
+        for field, value in changes.items():
+            setattr(db_obj, field, value)
+        try:
+            await db.commit()
+        except IntegrityError as exc:
+            await db.rollback()
+            raise CrudIntegrityError(field=self._conflicting_field(exc)) from exc
+        except StaleDataError as exc:
+            await db.rollback()
+            raise CrudStaleDataError() from exc
+        except SQLAlchemyError as exc:
+            await db.rollback()
+            raise CrudError() from exc
         return db_obj
 
-    async def delete(self, db: Session, *, db_obj: ModelType) -> ModelType:
-        # db_obj = db.get(self.model, obj_id)
-        db.delete(db_obj)
+    async def update_many(
+        self, db: AsyncSession, *, ids: Sequence[Any], values: Mapping[str, Any]
+    ) -> int:
+        """Set the same ``values`` on every row whose primary key is in ``ids``,
+        in a single UPDATE. Returns the number of rows matched.
+
+        The version counter of a versioned model is incremented, as the ORM does
+        on the update of an instance.
+        """
+        self._columns(list(values))
+        mapper = inspect(self.model)
+        (pk,) = mapper.primary_key
+        version = mapper.version_id_col
+        if version is not None:
+            values = {**values, version.name: version + 1}
+        stmt = update(self.model).where(pk.in_(ids)).values(**values)
+        try:
+            result = await db.execute(stmt)
+            await db.commit()
+        except IntegrityError as exc:
+            await db.rollback()
+            raise CrudIntegrityError(field=self._conflicting_field(exc)) from exc
+        except SQLAlchemyError as exc:
+            await db.rollback()
+            raise CrudError() from exc
+        return result.rowcount
+
+    async def delete(self, db: AsyncSession, *, db_obj: ModelType) -> ModelType:
+        # db_obj = await db.get(self.model, obj_id)
+        await db.delete(db_obj)
         try:
-            db.commit()
+            await db.commit()
         except IntegrityError as exc:
-            db.rollback()
+            await db.rollback()
             raise CrudIntegrityError() from exc
+        except StaleDataError as exc:
+            await db.rollback()
+            raise CrudStaleDataError() from exc
         except SQLAlchemyError as exc:
-            db.rollback()
+            await db.rollback()
             raise CrudError() from exc
         return db_obj
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from typing import Sequence
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.crud.base import CRUDBase, CrudError
+from app.models.outbox import FAILED, PENDING, SENT, OutboxEmail, utcnow
+from app.schemas.outbox import OutboxEmailCreate
+
+
+class CRUDOutbox(CRUDBase[OutboxEmail, OutboxEmailCreate, OutboxEmailCreate]):
+    async def claim(
+        self, db: AsyncSession, *, limit: int, lease: float
+    ) -> list[OutboxEmail]:
+        """Take up to ``limit`` pending emails due for sending, oldest first.
+
+        They are not due again for ``lease`` seconds: another worker skips them
+        meanwhile (the rows locked by a concurrent claim are skipped too), and
+        they are sent again if this worker dies before marking them.
+        """
+        now = utcnow()
+        stmt = (
+            select(OutboxEmail)
+            .where(OutboxEmail.status == PENDING, OutboxEmail.next_attempt_at <= now)
+            .order_by(OutboxEmail.next_attempt_at, OutboxEmail.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        try:
+            emails = list((await db.scalars(stmt)).all())
+            for email in emails:
+                email.next_attempt_at = now + timedelta(seconds=lease)
+            await db.commit()
+        except SQLAlchemyError as exc:
+            await db.rollback()
+            raise CrudError() from exc
+        return emails
+
+    async def mark_sent(self, db: AsyncSession, *, ids: Sequence[int]) -> int:
+        if not ids:
+            return 0
+        return await self.update_many(
+            db, ids=ids, values={"status": SENT, "sent_at": utcnow()}
+        )
+
+    async def mark_failed(
+        self,
+        db: AsyncSession,
+        *,
+        db_obj: OutboxEmail,
+        error: str,
+        retry_at: datetime | None,
+    ) -> OutboxEmail:
+        """Record a failed attempt, to retry at ``retry_at``, or never if None."""
+        return await self.update(
+            db,
+            db_obj=db_obj,
+            obj_in={
+                "attempts": db_obj.attempts + 1,
+                "last_error": error[:255],
+                "status": PENDING if retry_at is not None else FAILED,
+                "next_attempt_at": retry_at or db_obj.next_attempt_at,
+            },
+        )
+
+
+outbox = CRUDOutbox(OutboxEmail)
@@ -1,73 +1,294 @@
-from typing import Any, Dict, Optional, Union
-from uuid import uuid4
+import time
+from datetime import timedelta
+from itertools import islice
+from typing import Any, Dict, Iterable, Mapping, Optional, Sequence, Union
+from uuid import UUID, uuid4
 
 from fastapi.encoders import jsonable_encoder
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from pydantic import SecretStr
+from sqlalchemy import insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 
-from app.core.security import get_password_hash, verify_password
-from app.crud.base import CRUDBase, CrudError, CrudIntegrityError
+from app.core.search import SEARCH_FIELDS, matches, user_index, words
+from app.core.security import get_password_hash, principal_cache, verify_password
+from app.crud.base import (
+    CRUDBase,
+    CrudError,
+    CrudIntegrityError,
+    CrudPaginationError,
+    CrudStaleDataError,
+    decode_cursor,
+    encode_cursor,
+)
+from app.db.types import to_uuid
 from app.models.user import User
 from app.schemas.user import UserCreate, UserUpdate
 
 
+def _search_texts(obj: Any) -> dict[str, Optional[str]]:
+    return {field: getattr(obj, field) for field in SEARCH_FIELDS}
+
+
 class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
-    async def get_by_uid(self, db: Session, *, uid: str) -> Optional[User]:
-        return db.scalars(select(User).filter(User.uid == uid)).first()
+    # The users updated since the last sync are read again from this long
+    # before it: the clocks of the writers differ, and a transaction may commit
+    # a row dated before the sync after it.
+    SEARCH_SYNC_MARGIN = timedelta(seconds=60)
+
+    async def get_by_uid(
+        self, db: AsyncSession, *, uid: UUID | str
+    ) -> Optional[User]:
+        """The user of ``uid``, a UUID or its hex form: a lookup of the 16 bytes
+        key in the unique index."""
+        try:
+            uid = to_uuid(uid)
+        except ValueError:
+            return None
+        return (await db.scalars(select(User).filter(User.uid == uid))).first()
 
-    async def get_by_email(self, db: Session, *, email: str) -> Optional[User]:
-        return db.scalars(select(User).filter(User.email == email)).first()
+    async def get_by_email(self, db: AsyncSession, *, email: str) -> Optional[User]:
+        return (await db.scalars(select(User).filter(User.email == email))).first()
 
-    async def get_by_username(self, db: Session, *, username: str) -> Optional[User]:
-        return db.scalars(select(User).filter(User.username == username)).first()
+    async def get_by_username(
+        self, db: AsyncSession, *, username: str
+    ) -> Optional[User]:
+        return (
+            await db.scalars(select(User).filter(User.username == username))
+        ).first()
 
-    async def create(self, db: Session, *, obj_in: UserCreate) -> User:
-        hashed_pwd = get_password_hash(obj_in.password.get_secret_value())
+    async def create(self, db: AsyncSession, *, obj_in: UserCreate) -> User:
+        hashed_pwd = await get_password_hash(obj_in.password.get_secret_value())
         obj_in_data = jsonable_encoder(obj_in)
-        obj_in_data["uid"] = uuid4().hex
+        obj_in_data["uid"] = uuid4()
         del obj_in_data["password"]
         obj_in_data["hashed_password"] = hashed_pwd
         db_obj = self.model(**obj_in_data)
         db.add(db_obj)
         try:
-            db.commit()
+            await db.commit()
+        except IntegrityError as exc:
+            await db.rollback()
+            raise CrudIntegrityError(field=self._conflicting_field(exc)) from exc
         except SQLAlchemyError as exc:
-            db.rollback()
+            await db.rollback()
             raise CrudError() from exc
-        db.refresh(db_obj)
+        # No refresh: the id comes back with the INSERT, defaults are client-side
+        user_index.add(db_obj.id, _search_texts(db_obj).values())
         return db_obj
 
+    async def find_taken(
+        self, db: AsyncSession, *, emails: Iterable[str], usernames: Iterable[str]
+    ) -> tuple[set[str], set[str]]:
+        """Return which of the given emails and usernames are already taken, in a
+        single query."""
+        emails, usernames = list(emails), list(usernames)
+        stmt = select(User.email, User.username).where(
+            or_(User.email.in_(emails), User.username.in_(usernames))
+        )
+        try:
+            rows = (await db.execute(stmt)).all()
+        except SQLAlchemyError as exc:
+            raise CrudError() from exc
+        taken_emails = {row.email for row in rows} & set(emails)
+        taken_usernames = {row.username for row in rows} & set(usernames)
+        return taken_emails, taken_usernames
+
+    async def create_many(
+        self, db: AsyncSession, *, rows: list[dict[str, Any]]
+    ) -> dict[str, int]:
+        """Insert users in one multi-row batch and commit.
+
+        ``rows`` hold column values, passwords already hashed and ``uid`` unset.
+        Returns the ids of the new users, by email.
+        """
+        for row in rows:
+            row["uid"] = uuid4()
+        try:
+            await db.execute(insert(User), rows)
+            await db.commit()
+        except IntegrityError as exc:
+            await db.rollback()
+            raise CrudIntegrityError(field=self._conflicting_field(exc)) from exc
+        except SQLAlchemyError as exc:
+            await db.rollback()
+            raise CrudError() from exc
+        emails = [row["email"] for row in rows]
+        try:
+            result = await db.execute(
+                select(User.email, User.id).where(User.email.in_(emails))
+            )
+        except SQLAlchemyError as exc:
+            raise CrudError() from exc
+        ids = {row.email: row.id for row in result}
+        for row in rows:
+            user_index.add(ids[row["email"]], (row.get(f) for f in SEARCH_FIELDS))
+        return ids
+
     async def update(
-        self, db: Session, *, db_obj: User, obj_in: Union[UserUpdate, Dict[str, Any]]
+        self, db: AsyncSession, *, db_obj: User, obj_in: Union[UserUpdate, Dict[str, Any]]
     ) -> User:
         if isinstance(obj_in, dict):
-            update_data = obj_in
+            update_data = dict(obj_in)
+            password = update_data.pop("password", None)
         else:
-            update_data = obj_in.model_dump(exclude_unset=True)
-        if update_data["password"]:
-            hashed_password = get_password_hash(update_data["password"])
-            del update_data["password"]
-            update_data["hashed_password"] = hashed_password
-        return await super().update(db, db_obj=db_obj, obj_in=update_data)
-
-    async def authenticate(self, db: Session, *, email: str, password: str) -> Optional[User]:
+            update_data = obj_in.model_dump(
+                exclude_unset=True, exclude={"password"}, mode="json"
+            )
+            password = obj_in.password
+        if isinstance(password, SecretStr):
+            password = password.get_secret_value()
+        if password:
+            update_data["hashed_password"] = await get_password_hash(password)
+        # Evict under the email the user was cached with: it may change here and
+        # a failed commit expires the object.
+        email = db_obj.email
+        texts = _search_texts(db_obj)
+        try:
+            db_obj = await super().update(db, db_obj=db_obj, obj_in=update_data)
+        finally:
+            principal_cache.pop(email)
+        user_index.replace(db_obj.id, texts, _search_texts(db_obj))
+        return db_obj
+
+    async def update_many(
+        self, db: AsyncSession, *, ids: Sequence[int], values: Mapping[str, Any]
+    ) -> int:
+        try:
+            updated = await super().update_many(db, ids=ids, values=values)
+        finally:
+            # The emails of the updated users are unknown here, and a batch
+            # update is an admin operation: start over with an empty cache.
+            principal_cache.clear()
+        if any(field in values for field in SEARCH_FIELDS):
+            # The old values stay indexed: the search checks the rows anyway
+            for user_id in ids:
+                user_index.add(user_id, (values.get(f) for f in SEARCH_FIELDS))
+        return updated
+
+    async def authenticate(self, db: AsyncSession, *, email: str, password: str) -> Optional[User]:
         user_db = await self.get_by_email(db, email=email)
         if not user_db:
             return None
-        if not verify_password(password, user_db.hashed_password):
+        if not await verify_password(password, user_db.hashed_password):
             return None
         return user_db
 
-    async def change_password(self, db: Session, *, user_db: User, new_password: str):
-        hashed_password = get_password_hash(new_password)
+    async def change_password(self, db: AsyncSession, *, user_db: User, new_password: str):
+        hashed_password = await get_password_hash(new_password)
+        email = user_db.email
         user_db.hashed_password = hashed_password
         db.add(user_db)
         try:
-            db.commit()
+            await db.commit()
+        except StaleDataError as exc:
+            await db.rollback()
+            raise CrudStaleDataError() from exc
         except SQLAlchemyError as exc:
-            db.rollback()
+            await db.rollback()
             raise CrudError() from exc
+        finally:
+            principal_cache.pop(email)
+
+    async def delete(self, db: AsyncSession, *, db_obj: User) -> User:
+        email = db_obj.email
+        user_id, texts = db_obj.id, _search_texts(db_obj)
+        try:
+            db_obj = await super().delete(db, db_obj=db_obj)
+        finally:
+            principal_cache.pop(email)
+        user_index.remove(user_id, texts.values())
+        return db_obj
+
+    async def sync_search_index(self, db: AsyncSession) -> None:
+        """Load the search index of the process on its first use, then add the
+        users updated since the previous sync, every SEARCH_SYNC_SECONDS: the
+        writes of the other processes.
+
+        The updated users are read through the updated_at index. The postings
+        of their old values stay, as do the ones of the users deleted by other
+        processes: the search checks the rows.
+        """
+        if not user_index.due():
+            return
+        async with user_index.lock:
+            if not user_index.due():
+                return
+            started = time.monotonic()
+            watermark = user_index.watermark
+            # In id order, the order of the postings: a load only appends
+            stmt = select(
+                *self._columns(("id", *SEARCH_FIELDS, "updated_at"))
+            ).order_by(User.id)
+            if user_index.loaded and watermark is not None:
+                stmt = stmt.where(
+                    User.updated_at >= watermark - self.SEARCH_SYNC_MARGIN
+                )
+            try:
+                result = await db.stream(stmt.execution_options(yield_per=1000))
+                async for partition in result.mappings().partitions():
+                    for row in partition:
+                        user_index.add(row["id"], (row[f] for f in SEARCH_FIELDS))
+                        if watermark is None or row["updated_at"] > watermark:
+                            watermark = row["updated_at"]
+            except SQLAlchemyError as exc:
+                raise CrudError() from exc
+            user_index.watermark = watermark
+            user_index.loaded = True
+            user_index.synced_at = started
+
+    async def search(
+        self,
+        db: AsyncSession,
+        *,
+        query: str,
+        columns: Sequence[str],
+        after: str | None = None,
+        limit: int = 20,
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """Users having every word of ``query`` in their username, name or city
+        (see app.core.search), in id order, with only ``columns`` (and the id).
+
+        Keyset paginated like ``get_page_rows``: returns the page and the cursor
+        of the next one, None on the last page. The candidates of the index are
+        read by primary key and checked, a page usually takes one query.
+        """
+        after_id = 0
+        if after is not None:
+            values = decode_cursor(after, "id")
+            if len(values) != 1 or not isinstance(values[0], int):
+                raise CrudPaginationError(f"Invalid cursor: {after}")
+            (after_id,) = values
+        query_words = words(query)
+        if not query_words:
+            return [], None
+        await self.sync_search_index(db)
+        extra = [f for f in ("id", *SEARCH_FIELDS) if f not in columns]
+        stmt = select(*self._columns([*columns, *extra]))
+        candidates = user_index.candidates(query_words, after_id)
+        rows: list[dict[str, Any]] = []
+        while len(rows) < limit:
+            batch = list(islice(candidates, limit - len(rows)))
+            if not batch:
+                break
+            try:
+                result = await db.execute(
+                    stmt.where(User.id.in_(batch)).order_by(User.id)
+                )
+            except SQLAlchemyError as exc:
+                raise CrudError() from exc
+            for row in result.mappings():
+                if matches(query_words, (row[f] for f in SEARCH_FIELDS)):
+                    rows.append(dict(row))
+        unrequested = set(extra) - {"id"}
+        if unrequested:
+            for row in rows:
+                for column in unrequested:
+                    del row[column]
+        if len(rows) < limit:
+            return rows, None
+        return rows, encode_cursor("id", [rows[-1]["id"]])
 
     def is_active(self, user: User) -> bool:
         return user.is_active
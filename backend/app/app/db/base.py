@@ -2,3 +2,4 @@
 # imported by Alembic
 from app.db.base_class import Base  # noqa
 from models.user import User  # noqa
+from models.outbox import OutboxEmail  # noqa
@@ -4,6 +4,7 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+from datetime import datetime, timezone
 from typing import Annotated, TypeVar
 
 from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass, mapped_column
@@ -19,3 +20,8 @@ class Base(MappedAsDataclass, DeclarativeBase):
 
 
 intpk = Annotated[int, mapped_column(primary_key=True)]  # pylint: disable=invalid-name
+
+
+def utcnow() -> datetime:
+    # Naive UTC, as stored in the MySQL DATETIME columns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,184 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Engine factory, pool settings and pool telemetry.
+
+Every engine of the application is built by ``build_engine``: its pool is sized
+from the settings and records how long checkouts wait and how many connections
+are opened and closed. ``pool_stats`` gives a snapshot of every pool. The
+statements are timed too, see app.db.instrumentation.
+"""
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from sqlalchemy import URL, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.db.instrumentation import instrument
+from config import settings
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    size: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    wait_total: float
+    wait_max: float
+    timeouts: int
+    opened: int
+    closed: int
+    invalidated: int
+
+    @property
+    def wait_avg(self) -> float:
+        return self.wait_total / self.checkouts if self.checkouts else 0.0
+
+
+class _PoolCounters:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.opened = 0
+        self.closed = 0
+        self.invalidated = 0
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool timing its checkouts: the wait for a free connection, or for a
+    new one to be opened."""
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.counters = _PoolCounters()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self.counters.lock:
+                self.counters.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self.counters.lock:
+                self.counters.checkouts += 1
+                self.counters.wait_total += wait
+                self.counters.wait_max = max(self.counters.wait_max, wait)
+
+    def recreate(self) -> "InstrumentedQueuePool":
+        # A dispose or a disconnect replaces the pool: keep counting
+        pool = super().recreate()
+        pool.counters = self.counters
+        return pool
+
+    def stats(self) -> PoolStats:
+        with self.counters.lock:
+            return PoolStats(
+                size=self.size(),
+                checked_out=self.checkedout(),
+                overflow=max(self.overflow(), 0),
+                checkouts=self.counters.checkouts,
+                wait_total=self.counters.wait_total,
+                wait_max=self.counters.wait_max,
+                timeouts=self.counters.timeouts,
+                opened=self.counters.opened,
+                closed=self.counters.closed,
+                invalidated=self.counters.invalidated,
+            )
+
+
+# Engines built by build_engine, by name
+_engines: dict[str, AsyncEngine] = {}
+
+
+def _count(engine: AsyncEngine, counter: str) -> None:
+    pool = engine.sync_engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool.counters.lock:
+            setattr(pool.counters, counter, getattr(pool.counters, counter) + 1)
+
+
+def build_engine(name: str, url: URL | str, **kwargs: Any) -> AsyncEngine:
+    """Create the engine ``name`` with the pool options of the settings,
+    ``kwargs`` override them (or replace the pool with a ``poolclass``)."""
+    if "poolclass" not in kwargs:
+        kwargs = {
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_recycle": settings.DB_POOL_RECYCLE_SECONDS,
+            "pool_timeout": settings.DB_POOL_TIMEOUT_SECONDS,
+            "pool_pre_ping": settings.DB_POOL_PRE_PING,
+            **kwargs,
+        }
+    engine = create_async_engine(url, **kwargs)
+    instrument(engine)
+    for event_name, counter in (
+        ("connect", "opened"),
+        ("close", "closed"),
+        ("close_detached", "closed"),
+        ("invalidate", "invalidated"),
+    ):
+        event.listen(
+            engine.sync_engine,
+            event_name,
+            lambda *_args, counter=counter: _count(engine, counter),
+        )
+    _engines[name] = engine
+    return engine
+
+
+async def prefill_pool(engine: AsyncEngine, size: int | None = None) -> int:
+    """Open ``size`` connections (the pool size by default) at once and put them
+    back in the pool, so that the first requests do not wait for a connection.
+
+    Returns the number of connections opened, raises the error of the first
+    one that failed.
+    """
+    if size is None:
+        size = settings.DB_POOL_SIZE
+    results = await asyncio.gather(
+        *(engine.connect() for _ in range(size)), return_exceptions=True
+    )
+    for result in results:
+        if not isinstance(result, BaseException):
+            await result.close()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return size
+
+
+def dispose_after_fork() -> None:
+    """In a forked child, replace the pools inherited from the parent with empty
+    ones, without closing their connections: the parent still uses them.
+
+    Their counters restart too.
+    """
+    for engine in _engines.values():
+        engine.sync_engine.dispose(close=False)
+        pool = engine.sync_engine.pool
+        if isinstance(pool, InstrumentedQueuePool):
+            pool.counters = _PoolCounters()
+
+
+def pool_stats() -> dict[str, PoolStats]:
+    """Snapshot of the pools of the engines built so far, by engine name."""
+    return {
+        name: engine.sync_engine.pool.stats()
+        for name, engine in _engines.items()
+        if isinstance(engine.sync_engine.pool, InstrumentedQueuePool)
+    }
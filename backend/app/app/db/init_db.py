@@ -1,4 +1,4 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud, schemas
 from config import settings
@@ -10,7 +10,7 @@
 # for more details: https://github.com/tiangolo/full-stack-fastapi-postgresql/issues/28
 
 
-async def init_db(db: Session) -> None:
+async def init_db(db: AsyncSession) -> None:
     # Tables should be created with Alembic migrations
     # But if you don't want to use migrations, create
     # the tables un-commenting the next line
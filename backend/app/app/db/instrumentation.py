@@ -0,0 +1,125 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Per-request SQL statistics.
+
+``instrument`` times every statement of an engine. ``SQLStatsMiddleware``
+gathers the statements of each request: their count and total time go to the
+response headers when SQL_DEBUG_HEADERS is set, and statements repeated
+N_PLUS_ONE_THRESHOLD times or more in one request are logged as a likely N+1.
+Statements slower than SLOW_QUERY_THRESHOLD_MS are always logged.
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    total: float = 0.0
+    slowest: float = 0.0
+    slowest_statement: Optional[str] = None
+    statements: Counter[str] = field(default_factory=Counter)
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.statements[statement] += 1
+        if duration > self.slowest:
+            self.slowest = duration
+            self.slowest_statement = statement
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        """Statements executed at least ``threshold`` times."""
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+
+_current_stats: ContextVar[Optional[QueryStats]] = ContextVar(
+    "query_stats", default=None
+)
+
+
+@contextmanager
+def collect_queries() -> Iterator[QueryStats]:
+    """Gather the statements run in the current context during the block."""
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def _before_cursor_execute(conn, _cursor, _statement, *_args) -> None:
+    conn.info["query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, _cursor, statement, *_args) -> None:
+    duration = time.perf_counter() - conn.info.pop("query_start")
+    if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+        logger.warning("Slow query (%.1f ms): %s", duration * 1000, statement)
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(statement, duration)
+
+
+def instrument(engine: AsyncEngine) -> None:
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class SQLStatsMiddleware:
+    """ASGI middleware collecting the SQL statistics of each HTTP request."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with collect_queries() as stats:
+
+            async def send_with_stats(message: Message) -> None:
+                if (
+                    message["type"] == "http.response.start"
+                    and settings.SQL_DEBUG_HEADERS
+                ):
+                    headers = MutableHeaders(scope=message)
+                    headers["X-DB-Query-Count"] = str(stats.count)
+                    headers["X-DB-Time-Ms"] = f"{stats.total * 1000:.2f}"
+                    headers["X-DB-Slowest-Ms"] = f"{stats.slowest * 1000:.2f}"
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_stats)
+            finally:
+                for statement, count in stats.repeated(settings.N_PLUS_ONE_THRESHOLD):
+                    logger.warning(
+                        "Possible N+1 in %s %s: %d executions of %s",
+                        scope["method"],
+                        scope["path"],
+                        count,
+                        statement,
+                    )
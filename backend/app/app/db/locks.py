@@ -0,0 +1,45 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Named locks, shared by every process using the database."""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Stand-ins of the MySQL named locks on the other databases (SQLite in the
+# tests): they are local to the process
+_local_locks: dict[str, asyncio.Lock] = {}
+
+
+@asynccontextmanager
+async def named_lock(db: AsyncSession, name: str) -> AsyncIterator[bool]:
+    """Try to take the lock ``name`` for the block, without waiting: yields
+    whether it was taken.
+
+    On MySQL, a GET_LOCK on the primary connection of ``db``, which must not be
+    committed nor used for anything else meanwhile: MySQL releases the lock when
+    the connection goes away, on a crash or a client disconnect too.
+    """
+    if db.bind is None or db.bind.dialect.name != "mysql":
+        lock = _local_locks.setdefault(name, asyncio.Lock())
+        if lock.locked():
+            yield False
+            return
+        async with lock:
+            yield True
+        return
+    # Not a SELECT sent by the session: it goes to the primary
+    conn = await db.connection()
+    params = {"name": name}
+    if not await conn.scalar(text("SELECT GET_LOCK(:name, 0)"), params):
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        await conn.scalar(text("SELECT RELEASE_LOCK(:name)"), params)
@@ -0,0 +1,179 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Helpers of the migrations changing a big table without downtime.
+
+A change that would rewrite or lock the table is split in three revisions,
+deployed one after the other:
+
+1. expand: add the new columns, nullable or with a server default (an instant
+   change on MySQL 8), and the new tables. From this revision on the
+   application fills them in for the rows it writes.
+2. backfill: fill them in for the existing rows with ``backfill``, by chunks.
+3. contract: add the constraints (NOT NULL, unique indexes) with
+   ``alter_online``, drop what the application no longer uses.
+
+``backfill`` commits each chunk and records its progress in the
+alembic_backfill table: running ``alembic upgrade`` again after a crash resumes
+it where it stopped.
+"""
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import sqlalchemy as sa
+from alembic import op
+
+logger = logging.getLogger("alembic.backfill")
+
+# Progress of the backfills, by name. Not part of the models metadata: see the
+# include_name filter of alembic/env.py.
+checkpoints_metadata = sa.MetaData()
+checkpoints = sa.Table(
+    "alembic_backfill",
+    checkpoints_metadata,
+    sa.Column("name", sa.String(64), primary_key=True),
+    sa.Column("last_key", sa.BigInteger(), nullable=True),
+    sa.Column("updated_rows", sa.BigInteger(), nullable=False),
+    sa.Column("done", sa.Boolean(), nullable=False),
+    sa.Column("updated_at", sa.DateTime(), nullable=False),
+)
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _progress(last: int, low: int, high: int) -> float:
+    return 100 * (last - low) / (high - low) if high > low else 100.0
+
+
+def backfill(
+    table: str,
+    values: dict[str, str],
+    *,
+    where: str,
+    name: str,
+    key: str = "id",
+    chunk_size: int = 1000,
+    sleep_ratio: float = 0.5,
+) -> int:
+    """Set ``values`` (SQL expressions by column) on the rows of ``table``
+    matching ``where``, by chunks of ``chunk_size`` consecutive ``key`` values
+    (an integer column, the primary key usually).
+
+    Each chunk is committed on its own, so that it locks few rows for a short
+    time, and is followed by a pause of ``sleep_ratio`` times its duration, to
+    leave the server (and the replicas) time for the other queries. ``where``
+    must select the rows still to fill in: the chunk interrupted by a crash is
+    then simply done again.
+
+    The checkpoint ``name`` records the progress: a backfill that was
+    interrupted resumes after its last chunk, a completed one is skipped.
+    Returns the number of rows updated.
+    """
+    target = sa.table(table, sa.column(key), *(sa.column(c) for c in values))
+    column = target.c[key]
+    update = sa.update(target).values(
+        {target.c[c]: sa.text(expression) for c, expression in values.items()}
+    )
+    migration_context = op.get_context()
+    if migration_context.as_sql:
+        # No chunking in a SQL script: its statements are reviewed and run by hand
+        op.execute(update.where(sa.text(where)))
+        return 0
+
+    with migration_context.autocommit_block():
+        conn = op.get_bind()
+        checkpoints.create(conn, checkfirst=True)
+        state = conn.execute(
+            sa.select(checkpoints).where(checkpoints.c.name == name)
+        ).one_or_none()
+        if state is None:
+            conn.execute(
+                checkpoints.insert().values(
+                    name=name, updated_rows=0, done=False, updated_at=_utcnow()
+                )
+            )
+            last, total = None, 0
+        elif state.done:
+            logger.info("Backfill %s already done", name)
+            return state.updated_rows
+        else:
+            last, total = state.last_key, state.updated_rows
+            logger.info("Backfill %s resumed after %s = %s", name, key, last)
+
+        low, high = conn.execute(
+            sa.select(sa.func.min(column), sa.func.max(column))
+        ).one()
+        started = time.perf_counter()
+        while True:
+            start = time.perf_counter()
+            remaining = sa.select(column).order_by(column)
+            if last is not None:
+                remaining = remaining.where(column > last)
+            upper = conn.scalar(remaining.offset(chunk_size - 1).limit(1))
+            if upper is None:
+                # The last chunk, shorter
+                upper = conn.scalar(
+                    remaining.order_by(None).with_only_columns(sa.func.max(column))
+                )
+                if upper is None:
+                    break
+            chunk = column <= upper
+            if last is not None:
+                chunk = sa.and_(column > last, chunk)
+            result = conn.execute(update.where(chunk, sa.text(where)))
+            total += max(result.rowcount, 0)
+            last = upper
+            conn.execute(
+                checkpoints.update()
+                .where(checkpoints.c.name == name)
+                .values(last_key=last, updated_rows=total, updated_at=_utcnow())
+            )
+            elapsed = time.perf_counter() - start
+            logger.info(
+                "Backfill %s: %d rows updated, %s %d of %d (%.1f%%)",
+                name,
+                total,
+                key,
+                last,
+                high,
+                _progress(last, low, high),
+            )
+            time.sleep(elapsed * sleep_ratio)
+
+        conn.execute(
+            checkpoints.update()
+            .where(checkpoints.c.name == name)
+            .values(done=True, updated_at=_utcnow())
+        )
+    logger.info(
+        "Backfill %s done: %d rows updated in %.1f s",
+        name,
+        total,
+        time.perf_counter() - started,
+    )
+    return total
+
+
+def alter_online(
+    table: str,
+    *changes: str,
+    algorithm: str = "INPLACE",
+    lock: Optional[str] = "NONE",
+) -> None:
+    """ALTER ``table`` on MySQL without blocking its reads and writes.
+
+    MySQL refuses the statement if ``changes`` (clauses such as "MODIFY c INT
+    NOT NULL" or "ADD UNIQUE INDEX ix (c)") cannot be made with ``algorithm``
+    and ``lock``, instead of silently copying or locking the table.
+    """
+    clauses = [*changes, f"ALGORITHM={algorithm}"]
+    if lock is not None:
+        clauses.append(f"LOCK={lock}")
+    quoted = op.get_context().dialect.identifier_preparer.quote(table)
+    op.execute(f"ALTER TABLE {quoted} {', '.join(clauses)}")
@@ -0,0 +1,136 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Primary/replica routing of the ORM sessions.
+
+Writes, locking reads and every statement of a session that has written go to
+the primary (the session bind). Other reads go to a healthy read replica, or to
+the primary when none is available. A read failing because its replica cannot
+be reached runs once more, on another replica or the primary.
+"""
+import itertools
+import threading
+import time
+from typing import Any, Callable, Optional, Sequence
+
+from sqlalchemy import Engine, Select, event, text
+from sqlalchemy.engine import ExceptionContext
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+
+
+class ReplicaSet:
+    """Read replicas handed out round robin, skipping those seen failing.
+
+    A replica is put aside for ``retry_after`` seconds when it cannot be reached:
+    on a connection error or a disconnect seen by any session, or on a failed
+    ``check``.
+    """
+
+    def __init__(self, engines: Sequence[AsyncEngine], retry_after: float = 30):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self._down_until: dict[Engine, float] = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        for engine in self.engines:
+            event.listen(engine.sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context: ExceptionContext) -> None:
+        # No connection: the replica could not be connected to at all
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine: Engine) -> None:
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_after
+
+    def mark_up(self, engine: Engine) -> None:
+        with self._lock:
+            self._down_until.pop(engine, None)
+
+    def healthy(self) -> list[Engine]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                engine.sync_engine
+                for engine in self.engines
+                if self._down_until.get(engine.sync_engine, 0) <= now
+            ]
+
+    def pick(self) -> Optional[Engine]:
+        """Next healthy replica, None if there is none."""
+        healthy = self.healthy()
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    async def check(self) -> None:
+        """Probe every replica with a ``SELECT 1`` and update its health."""
+        for engine in self.engines:
+            try:
+                async with engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+            except Exception:  # pylint: disable=broad-except
+                self.mark_down(engine.sync_engine)
+            else:
+                self.mark_up(engine.sync_engine)
+
+
+class RoutingSession(Session):
+    """Session sending the reads to ``replicas`` and the rest to its bind.
+
+    ``use_primary`` sends the reads to the primary too, for a client that has
+    just written and must read its writes. ``on_write`` is called when the
+    session starts writing.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        replicas: ReplicaSet | None = None,
+        use_primary: bool = False,
+        on_write: Callable[[], None] | None = None,
+        **kwargs: Any,
+    ):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+        self.use_primary = use_primary
+        self.on_write = on_write
+        self.wrote = False
+        # Replica the statement being executed was sent to
+        self._replica: Optional[Engine] = None
+
+    def get_bind(self, mapper=None, *, clause=None, **kwargs):
+        primary = super().get_bind(mapper, clause=clause, **kwargs)
+        if (
+            not self._flushing
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+        ):
+            if self.replicas is None or self.use_primary:
+                return primary
+            self._replica = self.replicas.pick()
+            return self._replica or primary
+        if not self.wrote:
+            self.wrote = True
+            if self.on_write is not None:
+                self.on_write()
+        # Stick to the primary: the rest of the session reads its own writes
+        self.use_primary = True
+        return primary
+
+    def execute(self, statement: Any, *args: Any, **kwargs: Any) -> Any:
+        self._replica = None
+        try:
+            return super().execute(statement, *args, **kwargs)
+        except DBAPIError:
+            replica, self._replica = self._replica, None
+            if replica is None or replica in self.replicas.healthy():
+                raise
+            # The replica was just put aside (see ReplicaSet._on_error): the
+            # read goes elsewhere, rather than failing the request
+            return super().execute(statement, *args, **kwargs)
@@ -1,15 +1,33 @@
-from sqlalchemy import create_engine, URL
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from app.core.cache import TTLCache
+from app.db.engine import build_engine
+from app.db.routing import ReplicaSet, RoutingSession
 from config import settings
 
-url_object = URL.create(
-    drivername="mysql+mysqldb",
-    username=settings.MYSQL_USER,
-    password=settings.MYSQL_PASSWORD,
-    host=settings.MYSQL_HOST,
-    port=settings.MYSQL_PORT,
-    database=settings.MYSQL_DB,
+
+def _replica_engine(replica: str):
+    host, _, port = replica.partition(":")
+    url = settings.db_url(host, int(port) if port else None)
+    return build_engine(f"replica:{replica}", url)
+
+
+engine = build_engine("primary", settings.db_url())
+replicas = ReplicaSet(
+    [_replica_engine(replica) for replica in settings.MYSQL_REPLICA_HOSTS],
+    retry_after=settings.REPLICA_RETRY_SECONDS,
+)
+# Clients that wrote in the last READ_YOUR_WRITES_SECONDS, they read from the
+# primary (see deps.get_db)
+recent_writers: TTLCache[str, bool] = TTLCache(
+    maxsize=10000, ttl=settings.READ_YOUR_WRITES_SECONDS
+)
+# Objects stay usable after commit: an expired attribute would trigger an implicit
+# (blocking) refresh, which AsyncSession cannot do.
+SessionLocal = async_sessionmaker(
+    engine,
+    autoflush=False,
+    expire_on_commit=False,
+    sync_session_class=RoutingSession,
+    replicas=replicas if replicas.engines else None,
 )
-engine = create_engine(url_object, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
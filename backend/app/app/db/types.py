@@ -0,0 +1,59 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Column types of the models."""
+import uuid
+from typing import Any, Callable, Optional
+
+from sqlalchemy import BINARY
+from sqlalchemy.engine import Dialect
+from sqlalchemy.types import TypeDecorator
+
+
+def to_uuid(value: uuid.UUID | str | bytes) -> uuid.UUID:
+    """``value`` as a UUID: a UUID, its hex form (with or without dashes) or its
+    16 bytes."""
+    if isinstance(value, uuid.UUID):
+        return value
+    if isinstance(value, bytes):
+        return uuid.UUID(bytes=value)
+    return uuid.UUID(hex=value)
+
+
+class BinaryUUID(TypeDecorator):
+    """UUID stored in 16 bytes, BINARY(16), rather than in its 32 hex digits.
+
+    Half the key size of the hex form: the unique index of the column is as
+    much smaller. Values are read as ``uuid.UUID``, and the ones written or
+    compared to may be UUIDs or hex strings.
+    """
+
+    impl = BINARY(16)
+    cache_ok = True
+
+    @property
+    def python_type(self) -> type:
+        return uuid.UUID
+
+    def process_bind_param(
+        self, value: Optional[uuid.UUID | str | bytes], dialect: Dialect
+    ) -> Optional[bytes]:
+        if value is None:
+            return None
+        return to_uuid(value).bytes
+
+    def literal_processor(self, dialect: Dialect) -> Callable[[Any], str]:
+        # A hex literal: the raw bytes are not valid in a SQL string
+        def process(value: Any) -> str:
+            return "NULL" if value is None else f"X'{to_uuid(value).hex}'"
+
+        return process
+
+    def process_result_value(
+        self, value: Optional[bytes], dialect: Dialect
+    ) -> Optional[uuid.UUID]:
+        if value is None:
+            return None
+        return uuid.UUID(bytes=bytes(value))
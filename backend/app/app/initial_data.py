@@ -10,8 +10,8 @@
 
 
 async def init() -> None:
-    db = SessionLocal()
-    await init_db(db)
+    async with SessionLocal() as db:
+        await init_db(db)
 
 
 async def main() -> None:
@@ -1,28 +1,142 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
-from app.api.api_v1.api import api_router
+from app import crud, schemas
+from app.core.metrics import MetricsMiddleware, metrics
+from app.core.outbox import outbox_worker
+from app.core.ratelimit import rate_limiter
+from app.core.search import search_cache, user_index
+from app.core.security import (
+    hashing_pool,
+    import_hashing_pool,
+    principal_cache,
+    token_cache,
+)
+from app.core.serialization import prime
+from app.db import session
+from app.db.engine import dispose_after_fork, prefill_pool
+from app.db.instrumentation import SQLStatsMiddleware
 # from starlette.middleware.cors import CORSMiddleware
 
 from config import settings
 
-app = FastAPI()
-#     title="Cycliti",
-#     openapi_url="/openapi.json",
-#     # title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json"
-# )
-
-# Set all CORS enabled origins
-# if settings.BACKEND_CORS_ORIGINS:
-#     app.add_middleware(
-#         CORSMiddleware,
-#         allow_origins=[str(origin) for origin in settings.BACKEND_CORS_ORIGINS],
-#         allow_credentials=True,
-#         allow_methods=["*"],
-#         allow_headers=["*"],
-#     )
-
-# app.include_router(api_router)
-app.include_router(api_router, prefix=settings.API_V1_STR)
-
-db_uri = settings.DB_URI
-print(f"Connecting to MySQL database using: {db_uri}")
+logger = logging.getLogger(__name__)
+
+
+async def load_search_index() -> None:
+    async with session.SessionLocal() as db:
+        await crud.user.sync_search_index(db)
+
+
+async def warm_up() -> None:
+    """Pay the cost of the first requests before serving them: open the pool
+    connections, start the hashing workers, build the serializers and load the
+    search index.
+
+    A database that cannot be reached is logged, not fatal: the pool connects
+    on demand once the database is back.
+    """
+    prime(schemas.User)
+    results = await asyncio.gather(
+        prefill_pool(session.engine),
+        session.replicas.check(),
+        hashing_pool.warm_up(),
+        load_search_index(),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.warning("Startup warm-up failed: %r", result)
+    for engine in session.replicas.healthy():
+        try:
+            await prefill_pool(engine)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Startup warm-up of %s failed: %r", engine.url, exc)
+
+
+def reset_after_fork() -> None:
+    """Make a forked worker process start from clean resources: its own
+    connection pools and executors, empty caches and metrics.
+
+    The parent must not have other threads when it forks (a lock they hold
+    would stay locked in the child): the pre-fork master only imports the
+    application, the lifespan hook runs in each worker.
+
+    Called by the pre-fork server in each worker it forks, not registered as a
+    fork hook: the processes of the hashing pools are forked too, and have no
+    use for it. Another pre-fork server must call it the same way (the
+    post_fork hook of gunicorn).
+    """
+    dispose_after_fork()
+    for pool in (hashing_pool, import_hashing_pool):
+        pool.after_fork()
+    outbox_worker.after_fork()
+    for cache in (principal_cache, token_cache, session.recent_writers, search_cache):
+        cache.clear()
+    user_index.clear()
+    rate_limiter.store.clear()
+    metrics.reset()
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    logger.info(
+        "Connecting to MySQL database using: %s",
+        session.engine.url.render_as_string(hide_password=True),
+    )
+    if settings.STARTUP_WARM_UP:
+        await warm_up()
+    if settings.EMAIL_WORKER_ENABLED:
+        outbox_worker.start()
+    try:
+        yield
+    finally:
+        await outbox_worker.stop()
+        for engine in (session.engine, *session.replicas.engines):
+            await engine.dispose()
+
+
+def create_app() -> FastAPI:
+    """The application, for ``uvicorn --factory app.main:create_app``.
+
+    Importing this module builds no application and does no I/O: the routes
+    are imported here, the database is connected by the lifespan hook, and the
+    OpenAPI schema is built on its first request.
+    """
+    from app.api.api_v1.api import api_router
+
+    app = FastAPI(lifespan=lifespan)
+    #     title="Cycliti",
+    #     openapi_url="/openapi.json",
+    #     # title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    # )
+
+    # Set all CORS enabled origins
+    # if settings.BACKEND_CORS_ORIGINS:
+    #     app.add_middleware(
+    #         CORSMiddleware,
+    #         allow_origins=[str(origin) for origin in settings.BACKEND_CORS_ORIGINS],
+    #         allow_credentials=True,
+    #         allow_methods=["*"],
+    #         allow_headers=["*"],
+    #     )
+
+    app.add_middleware(SQLStatsMiddleware)
+    if settings.METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
+
+        @app.get("/metrics", include_in_schema=False)
+        def read_metrics() -> PlainTextResponse:
+            """Metrics of this worker process, in the Prometheus text format."""
+            return PlainTextResponse(
+                metrics.render(), media_type="text/plain; version=0.0.4"
+            )
+
+    # app.include_router(api_router)
+    app.include_router(api_router, prefix=settings.API_V1_STR)
+    return app
@@ -4,3 +4,4 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 from .user import User
+from .outbox import OutboxEmail
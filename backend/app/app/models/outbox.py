@@ -0,0 +1,40 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+from datetime import datetime
+from typing import Any, Optional
+
+from sqlalchemy import JSON, DateTime, Index, Integer, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.db.base_class import Base, intpk, utcnow
+
+# Status of an outbox email
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+
+class OutboxEmail(Base):
+    """Email waiting to be sent, or sent, by the outbox worker."""
+
+    # pylint: disable=too-few-public-methods
+    __tablename__ = "email_outbox"
+    __table_args__ = (Index("ix_email_outbox_due", "status", "next_attempt_at"),)
+
+    id: Mapped[intpk] = mapped_column(init=False)
+    template: Mapped[str] = mapped_column(String(64))
+    email_to: Mapped[str] = mapped_column(String(254))
+    environment: Mapped[dict[str, Any]] = mapped_column(JSON)
+    status: Mapped[str] = mapped_column(String(8), default=PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default_factory=utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default_factory=utcnow)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, default=None, nullable=True
+    )
+    last_error: Mapped[Optional[str]] = mapped_column(
+        String(255), default=None, nullable=True
+    )
@@ -3,12 +3,15 @@
 # 
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import uuid
+from datetime import datetime
 from typing import TYPE_CHECKING, cast
 
-from sqlalchemy import String, Integer
+from sqlalchemy import DateTime, String, Integer
 from sqlalchemy.orm import Mapped, mapped_column
 
-from app.db.base_class import Base, intpk
+from app.db.base_class import Base, intpk, utcnow
+from app.db.types import BinaryUUID
 
 # Refer to: https://github.com/dropbox/sqlalchemy-stubs/issues/98#issuecomment-762884766
 # if TYPE_CHECKING:
@@ -22,7 +25,7 @@ class User(Base):
     __tablename__ = "user"
 
     id: Mapped[intpk] = mapped_column(init=False)
-    uid: Mapped[str] = mapped_column(String(32), unique=True, index=True)
+    uid: Mapped[uuid.UUID] = mapped_column(BinaryUUID, unique=True, index=True)
     email: Mapped[str] = mapped_column(String(254), unique=True, index=True)
     username: Mapped[str] = mapped_column(String(16), unique=True, index=True)
     hashed_password: Mapped[str] = mapped_column(String(100))
@@ -35,7 +38,18 @@ class User(Base):
     access_type: Mapped[int] = mapped_column(Integer, default=1)
     is_active: Mapped[bool] = mapped_column(default=False)
     is_superuser: Mapped[bool] = mapped_column(default=False)
+    # version is incremented by every UPDATE of the row, the ORM checks that it
+    # did not change meanwhile. The ETag and Last-Modified of the user resource
+    # are derived from version and updated_at. The search index of each worker
+    # reads the users updated since its last sync through the updated_at index.
+    version: Mapped[int] = mapped_column(
+        Integer, init=False, insert_default=1, server_default="1"
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, init=False, insert_default=utcnow, onupdate=utcnow, index=True
+    )
 
+    __mapper_args__ = {"version_id_col": version}
 
     # basket: Mapped["Basket"] = relationship(
     #     init=False,
@@ -0,0 +1,217 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Pre-fork serving: one master process, several uvicorn workers.
+
+The master imports the application once (settings, models, validators and
+serializers, routes and OpenAPI schema), freezes the garbage collector so that
+those objects stay shared copy-on-write, binds the listening socket and forks
+the workers, which accept on that socket. It restarts a worker that dies, and
+stops them all on SIGTERM or SIGINT.
+
+A forked worker starts from clean resources (see app.main.reset_after_fork),
+then its lifespan hook connects its pools and starts its outbox worker. The
+master connects to nothing and runs no thread.
+
+Usage (from backend/app, with PYTHONPATH=.:app)::
+
+    python -m app.prefork --host 0.0.0.0 --port 8000 [--workers 4]
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+from pathlib import Path
+from typing import Any, Optional
+
+import uvicorn
+from fastapi import FastAPI
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Exit status of a worker whose application failed to start: restarting it
+# would fail again
+WORKER_BOOT_ERROR = 3
+
+
+def _available_memory() -> Optional[int]:
+    """Memory of the box, or the limit of its cgroup if lower, in bytes."""
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return None
+    try:
+        limit = Path("/sys/fs/cgroup/memory.max").read_text().strip()
+    except OSError:
+        return memory
+    return min(memory, int(limit)) if limit.isdigit() else memory
+
+
+def default_workers(
+    cpus: Optional[int] = None,
+    memory: Optional[int] = None,
+    worker_memory: int = settings.WORKER_MEMORY_MB * 2**20,
+) -> int:
+    """Worker processes for ``cpus`` and ``memory`` bytes (the ones of this box
+    by default): an async worker uses one CPU, as many as fit in memory."""
+    if cpus is None:
+        cpus = len(os.sched_getaffinity(0))
+    if memory is None:
+        memory = _available_memory()
+    workers = cpus
+    if memory is not None:
+        workers = min(workers, memory // worker_memory)
+    return max(1, workers)
+
+
+def preload() -> FastAPI:
+    """Import and prepare everything the workers share."""
+    from app import schemas
+    from app.core.serialization import prime
+    from app.main import create_app
+
+    app = create_app()
+    prime(schemas.User)
+    app.openapi()
+    # Move the objects created so far out of the collected generations: a
+    # collection in a worker does not write to (and so copy) their pages
+    gc.collect()
+    gc.freeze()
+    return app
+
+
+class PreforkServer:
+    def __init__(
+        self,
+        app: Any,
+        *,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        workers: Optional[int] = None,
+        backlog: int = 2048,
+        **options: Any,
+    ):
+        self.host = host
+        self.port = port
+        self.workers = workers or settings.WEB_CONCURRENCY or default_workers()
+        self.backlog = backlog
+        self.config = uvicorn.Config(app, lifespan="on", backlog=backlog, **options)
+        self.sock: Optional[socket.socket] = None
+        self.children: set[int] = set()
+        self.stopping = False
+
+    def bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def _serve(self, sock: socket.socket) -> int:
+        from app.main import reset_after_fork
+
+        reset_after_fork()
+        # uvicorn installs its own handlers
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        server = uvicorn.Server(self.config)
+        asyncio.run(server.serve(sockets=[sock]))
+        return 0 if server.started else WORKER_BOOT_ERROR
+
+    def spawn(self) -> int:
+        assert self.sock is not None
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = self._serve(self.sock)
+            except BaseException:  # pylint: disable=broad-except
+                logger.exception("Worker %d failed", os.getpid())
+            finally:
+                # Skip the exit handlers inherited from the master
+                os._exit(status)
+        self.children.add(pid)
+        logger.info("Started worker %d", pid)
+        return pid
+
+    def stop(self, *_args: Any) -> None:
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        """Serve until stopped; returns the exit status of the master.
+
+        Binds the socket unless ``bind`` was called already.
+        """
+        if self.sock is None:
+            self.sock = self.bind()
+        logger.info(
+            "Serving on %s:%d with %d workers", self.host, self.port, self.workers
+        )
+        status = 0
+        previous = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            for _ in range(self.workers):
+                self.spawn()
+            while self.children:
+                pid, wait_status = os.wait()
+                self.children.discard(pid)
+                code = os.waitstatus_to_exitcode(wait_status)
+                if self.stopping:
+                    continue
+                if code == WORKER_BOOT_ERROR:
+                    logger.error("Worker %d failed to start, stopping", pid)
+                    status = WORKER_BOOT_ERROR
+                    self.stop()
+                    continue
+                logger.warning("Worker %d exited with %d, restarting", pid, code)
+                self.spawn()
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self.sock.close()
+        return status
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="default: WEB_CONCURRENCY, else from the CPUs and the memory",
+    )
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+    server = PreforkServer(
+        preload(),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        log_level=args.log_level,
+    )
+    sys.exit(server.run())
+
+
+if __name__ == "__main__":
+    main()
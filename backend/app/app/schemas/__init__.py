@@ -3,6 +3,7 @@
 # 
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
-from .user import User, UserCreate, UserInDB, UserUpdate
+from .user import User, UserBatchUpdate, UserCreate, UserInDB, UserUpdate
 from .token import Token, TokenPayload
 from .msg import Msg
+from .outbox import OutboxEmailCreate
@@ -0,0 +1,9 @@
+from typing import Any
+
+from pydantic import BaseModel, EmailStr
+
+
+class OutboxEmailCreate(BaseModel):
+    template: str
+    email_to: EmailStr
+    environment: dict[str, Any]
@@ -51,6 +51,14 @@ class UserUpdate(BaseModel):
     # model_config = ConfigDict(from_attributes=True)
 
 
+# Properties to receive via API on a batch update of many users
+class UserBatchUpdate(BaseModel):
+    ids: list[PositiveInt] = Field(min_length=1, max_length=1000)
+    is_active: bool | None = Field(default=None)
+    is_superuser: bool | None = Field(default=None)
+    access_type: int | None = Field(default=None)
+
+
 # class _UserInDBBase(_UserBase):
 #     id: int | None = None
 #
@@ -60,6 +68,9 @@ class UserUpdate(BaseModel):
 # Additional properties to return via API
 # class User(BaseModel):
 class User(UserBase):
+    # Emails were validated on the way in: re-validating them on output costs
+    # more than the rest of the serialization.
+    email: str = Field(json_schema_extra={"format": "email"})
     id: PositiveInt
     # uid: UUID4
     # hashed_password: str
@@ -69,7 +80,8 @@ class User(UserBase):
     city: str | None = Field(max_length=64)
     birthdate: PastDate | None
     gender: GenderEnum | None
-    photo_path: DirectoryPath | None
+    # Not a DirectoryPath: serializing a user must not stat the filesystem
+    photo_path: str | None
     preferred_language: str
     access_type: int
     # is_active: bool
@@ -80,6 +92,7 @@ class User(UserBase):
 
 # Additional properties stored in DB
 class UserInDB(User):
+    # Read from the model as a UUID, a hex string or 16 bytes are accepted too
     uid: UUID4
     hashed_password: str
 
@@ -1,10 +1,17 @@
+import sys
+
 import pytest
 from fastapi.testclient import TestClient
 from pydantic import SecretStr
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud
+from app.api import deps
 from app.config import settings
+from app.core.ratelimit import rate_limiter
+from app.core.security import create_access_token, principal_cache
+from app.models.outbox import OutboxEmail
 from schemas import UserCreate
 from tests.utils.utils import random_email, random_lower_string
 
@@ -34,7 +41,7 @@ def test_get_access_token_unknown_user(client: TestClient) -> None:
     assert "Incorrect email or password" in r.text
 
 
-async def test_get_access_token_inactive_user(session: Session, client: TestClient) -> None:
+async def test_get_access_token_inactive_user(session: AsyncSession, client: TestClient) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -54,6 +61,75 @@ async def test_get_access_token_inactive_user(session: Session, client: TestClie
     assert "Inactive user" in r.text
 
 
+def test_get_access_token_hashing_pool_busy(
+        client: TestClient,
+        mock_hashing_pool_busy,
+) -> None:
+    login_data = {
+        "username": settings.FIRST_SUPERUSER_EMAIL,
+        "password": settings.FIRST_SUPERUSER_PASSWORD,
+    }
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "1"
+
+
+def test_get_access_token_locked_after_failures(client: TestClient, monkeypatch) -> None:
+    monkeypatch.setattr(rate_limiter, "max_failures", 2)
+    login_data = {
+        "username": settings.FIRST_SUPERUSER_EMAIL,
+        "password": random_lower_string(8),
+    }
+    for _ in range(2):
+        r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+        assert r.status_code == 400
+
+    async def no_hashing(*_args):
+        raise AssertionError("a rejected attempt must not check the password")
+
+    monkeypatch.setattr(sys.modules["app.crud.user"], "verify_password", no_hashing)
+    login_data["password"] = settings.FIRST_SUPERUSER_PASSWORD
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) > 0
+
+
+def test_get_access_token_account_burst(client: TestClient, monkeypatch) -> None:
+    monkeypatch.setattr(rate_limiter, "account_burst", 1)
+    login_data = {
+        "username": settings.FIRST_SUPERUSER_EMAIL,
+        "password": settings.FIRST_SUPERUSER_PASSWORD,
+    }
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 200
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 429
+    # Another account, from the same IP
+    login_data["username"] = random_email()
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 400
+
+
+def test_get_access_token_throttled_account_keeps_ip_budget(
+    client: TestClient, monkeypatch
+) -> None:
+    monkeypatch.setattr(rate_limiter, "ip_burst", 2)
+    monkeypatch.setattr(rate_limiter, "account_burst", 1)
+    login_data = {
+        "username": settings.FIRST_SUPERUSER_EMAIL,
+        "password": settings.FIRST_SUPERUSER_PASSWORD,
+    }
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 200
+    for _ in range(5):
+        r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+        assert r.status_code == 429
+    # The attempts turned away on the account left the IP its second token
+    login_data["username"] = random_email()
+    r = client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 400
+
+
 #
 # Path: /login/test-token
 #
@@ -69,6 +145,33 @@ def test_use_access_token_success(
     assert "email" in result
 
 
+def test_use_access_token_cached_user(
+    client: TestClient, superuser_token_headers: dict[str, str]
+) -> None:
+    principal_cache.clear()
+    hits = principal_cache.stats().hits
+    for _ in range(2):
+        r = client.post(
+            f"{settings.API_V1_STR}/login/test-token",
+            headers=superuser_token_headers,
+        )
+        assert r.status_code == 200
+        assert r.json()["email"] == settings.FIRST_SUPERUSER_EMAIL
+    assert principal_cache.stats().hits == hits + 1
+
+
+async def test_cached_user_survives_rollback(session: AsyncSession) -> None:
+    token = create_access_token(settings.FIRST_SUPERUSER_EMAIL)
+    await deps.get_current_user(session, token)
+    # A request failing a write rolls its session back, expiring its objects
+    await session.rollback()
+    hits = principal_cache.stats().hits
+    user = await deps.get_current_user(session, token)
+    assert principal_cache.stats().hits == hits + 1
+    assert user.email == settings.FIRST_SUPERUSER_EMAIL
+    assert crud.user.is_superuser(user)
+
+
 def test_use_access_token_no_sub_claim(
     client: TestClient,
         mock_create_token_no_sub,
@@ -109,13 +212,17 @@ def test_use_access_token_unknowk_user(
 #
 # Path: /password-recovery/{email}
 #
-def test_recover_password_success(client: TestClient) -> None:
+async def test_recover_password_success(session: AsyncSession, client: TestClient) -> None:
     email = settings.FIRST_SUPERUSER_EMAIL
     r = client.post(f"{settings.API_V1_STR}/password-recovery/{email}")
     assert r.status_code == 200
     msg = r.json()
     assert "msg" in msg
     assert msg["msg"].startswith("Password recovery email sent")
+    # Queued, for the outbox worker to send
+    [queued] = (await session.scalars(select(OutboxEmail))).all()
+    assert (queued.template, queued.email_to) == ("reset_password", email)
+    assert queued.status == "pending"
 
 
 def test_recover_password_unknown_user(client: TestClient) -> None:
@@ -155,6 +262,18 @@ def test_reset_password_invalid_token(client: TestClient) -> None:
     assert "Invalid token" in r.text
 
 
+def test_reset_password_invalid_tokens_locked(client: TestClient, monkeypatch) -> None:
+    monkeypatch.setattr(rate_limiter, "max_failures", 1)
+    body_data = {
+        "token": random_lower_string(32),
+        "new_password": random_lower_string(8),
+    }
+    r = client.post(f"{settings.API_V1_STR}/reset-password/", json=body_data)
+    assert r.status_code == 400
+    r = client.post(f"{settings.API_V1_STR}/reset-password/", json=body_data)
+    assert r.status_code == 429
+
+
 def test_reset_password_unknown_user(
         client: TestClient,
         mock_verify_password_reset_token_unknown_sub
@@ -173,7 +292,7 @@ def test_reset_password_unknown_user(
     assert "The user with this username does not exist in the system." in r.text
 
 
-async def test_reset_password_inactive_user(session: Session, client: TestClient) -> None:
+async def test_reset_password_inactive_user(session: AsyncSession, client: TestClient) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -199,7 +318,7 @@ async def test_reset_password_inactive_user(session: Session, client: TestClient
 
 
 def test_reset_password_db_server_error(
-        session: Session,
+        session: AsyncSession,
         client: TestClient,
         mock_change_password_commit_failed,
 ) -> None:
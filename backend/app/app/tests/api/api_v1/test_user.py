@@ -1,18 +1,33 @@
+import asyncio
+import json
+from uuid import uuid4
+
 import pytest
 from fastapi import status
 from fastapi.exceptions import HTTPException
 from fastapi.encoders import jsonable_encoder
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from argon2 import PasswordHasher
 
 from app import crud
-from app.core.security import verify_password
+from app.api import deps
+from app.api.api_v1.endpoints.users import IMPORT_LOCK
+from app.config import settings as app_settings
+from app.db.base_class import Base
+from app.db.routing import RoutingSession
+from app.main import create_app
+from app.models.user import User
+from app.core.hashing import HashingPoolBusyError
+from app.core.security import create_access_token, import_hashing_pool, verify_password
+from app.db.locks import _local_locks
 # from app.schemas.user import UserCreate, UserUpdate
 # from app.tests.utils.utils import random_email, random_lower_string
 from app import schemas
 from config import settings
 from app.db.init_db import init_db  # noqa
+from app.tests.utils.utils import random_email
 
 
 def test_create_user(client: TestClient):
@@ -43,6 +58,130 @@ def test_create_user(client: TestClient):
     assert data["is_superuser"] is False
 
 
+def test_read_users_cursor_pagination(client: TestClient):
+    r = client.get(f"{settings.API_V1_STR}/users/", params={"limit": 1000})
+    assert r.status_code == 200
+    all_ids = [user["id"] for user in r.json()]
+
+    ids = []
+    params = {"limit": 1}
+    while True:
+        r = client.get(f"{settings.API_V1_STR}/users/", params=params)
+        assert r.status_code == 200
+        ids.extend(user["id"] for user in r.json())
+        if "X-Next-Cursor" not in r.headers:
+            break
+        params["after"] = r.headers["X-Next-Cursor"]
+    assert ids == sorted(all_ids)
+
+
+def test_read_users_invalid_cursor(client: TestClient):
+    r = client.get(f"{settings.API_V1_STR}/users/", params={"after": "garbage"})
+    assert r.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_read_users_same_as_user_resource(client: TestClient):
+    r = client.get(f"{settings.API_V1_STR}/users/", params={"limit": 1})
+    assert r.status_code == 200
+    user = r.json()[0]
+    r = client.get(f"{settings.API_V1_STR}/users/{user['id']}")
+    assert r.json() == user
+
+
+def test_read_user_unknown_user(client: TestClient):
+    r = client.get(f"{settings.API_V1_STR}/users/0")
+    assert r.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_read_users_sparse_fields(client: TestClient):
+    r = client.get(
+        f"{settings.API_V1_STR}/users/",
+        params={"fields": "email,username", "order_by": "username"},
+    )
+    assert r.status_code == 200
+    users = r.json()
+    assert users
+    assert all(set(user) == {"email", "username", "id"} for user in users)
+
+
+async def test_read_user_not_modified(
+    session: AsyncSession, client: TestClient, max_queries
+):
+    user = await crud.user.get(session, obj_id=1)
+    r = client.get(f"{settings.API_V1_STR}/users/1")
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    assert r.headers["Last-Modified"].endswith(" GMT")
+
+    with max_queries(1) as statements:
+        r = client.get(f"{settings.API_V1_STR}/users/1", headers={"If-None-Match": etag})
+    assert r.status_code == status.HTTP_304_NOT_MODIFIED
+    assert r.content == b""
+    assert r.headers["ETag"] == etag
+    # The version only, the user is not read
+    assert statements[0].startswith("SELECT user.version, user.updated_at")
+
+    await crud.user.update(session, db_obj=user, obj_in={"city": "Annecy"})
+    r = client.get(f"{settings.API_V1_STR}/users/1", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json()["city"] == "Annecy"
+    assert r.headers["ETag"] != etag
+
+
+def test_read_user_not_modified_unknown_user(client: TestClient):
+    r = client.get(f"{settings.API_V1_STR}/users/0", headers={"If-None-Match": '"x"'})
+    assert r.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_read_users_not_modified(session: AsyncSession, client: TestClient):
+    params = {"limit": 2, "fields": "email"}
+    r = client.get(f"{settings.API_V1_STR}/users/", params=params)
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    assert all(set(user) == {"email", "id"} for user in r.json())
+
+    r = client.get(
+        f"{settings.API_V1_STR}/users/", params=params, headers={"If-None-Match": etag}
+    )
+    assert r.status_code == status.HTTP_304_NOT_MODIFIED
+    # Another representation of the same users
+    r = client.get(
+        f"{settings.API_V1_STR}/users/",
+        params={"limit": 2},
+        headers={"If-None-Match": etag},
+    )
+    assert r.status_code == 200
+
+    await crud.user.update_many(session, ids=[1], values={"access_type": 3})
+    r = client.get(
+        f"{settings.API_V1_STR}/users/", params=params, headers={"If-None-Match": etag}
+    )
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+
+def test_read_users_unknown_fields(client: TestClient):
+    r = client.get(
+        f"{settings.API_V1_STR}/users/", params={"fields": "email,hashed_password"}
+    )
+    assert r.status_code == status.HTTP_400_BAD_REQUEST
+    assert "hashed_password" in r.text
+
+
+
+@pytest.mark.parametrize("field", ["email", "username"])
+def test_create_user_conflict(client: TestClient, field: str):
+    body = {"email": random_email(), "username": f"dup{field}", "password": "password"}
+    r = client.post(f"{settings.API_V1_STR}/users/", json=body)
+    assert r.status_code == status.HTTP_201_CREATED
+    other = {"email": random_email(), "username": f"other{field}", "password": "password"}
+    other[field] = body[field]
+    r = client.post(f"{settings.API_V1_STR}/users/", json=other)
+    assert r.status_code == status.HTTP_409_CONFLICT
+    assert r.json()["detail"] == (
+        f"The user with this {field} already exists in the system."
+    )
+
 # def test_create_user_error(client: TestClient, mock_commit):
 #     state, _called = mock_commit
 #     state["failed"] = True
@@ -57,3 +196,308 @@ def test_create_user(client: TestClient):
 #         }
 #     )
 #     assert response.status_code is status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+@pytest.fixture
+def superuser_headers() -> dict[str, str]:
+    # The login tests may have changed the superuser password in the shared
+    # session, mint the token directly
+    token = create_access_token(settings.FIRST_SUPERUSER_EMAIL)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_import_users_ndjson(client: TestClient, superuser_headers):
+    existing = client.get(f"{settings.API_V1_STR}/users/", params={"limit": 1}).json()[0]
+    email = random_email()
+    lines = [
+        json.dumps({"email": email, "username": "import1", "password": "password"}),
+        "",
+        json.dumps({"email": random_email(), "username": "import2"}),
+        json.dumps({"email": email, "username": "import3", "password": "password"}),
+        json.dumps(
+            {"email": existing["email"], "username": "import4", "password": "password"}
+        ),
+        "{not json",
+    ]
+    r = client.post(
+        f"{settings.API_V1_STR}/users/import",
+        content="\n".join(lines).encode(),
+        headers={**superuser_headers, "Content-Type": "application/x-ndjson"},
+    )
+    assert r.status_code == 200
+    report = r.json()
+    assert report["created"] == 1
+    assert report["failed"] == 4
+    statuses = {result["line"]: result["status"] for result in report["results"]}
+    assert statuses == {
+        1: "created",
+        3: "invalid",
+        4: "duplicate",
+        5: "duplicate",
+        6: "invalid",
+    }
+    user_id = report["results"][0]["id"]
+    r = client.get(f"{settings.API_V1_STR}/users/{user_id}")
+    assert r.json()["email"] == email
+
+
+def test_import_users_csv(client: TestClient, superuser_headers):
+    body = "email,username,password,is_active\n" + "\n".join(
+        f"{random_email()},csv{i},password,true" for i in range(3)
+    )
+    r = client.post(
+        f"{settings.API_V1_STR}/users/import",
+        content=body.encode(),
+        headers={**superuser_headers, "Content-Type": "text/csv"},
+    )
+    assert r.status_code == 200
+    assert r.json()["created"] == 3
+    user_id = r.json()["results"][0]["id"]
+    assert client.get(f"{settings.API_V1_STR}/users/{user_id}").json()["is_active"]
+
+
+def test_import_users_unsupported_media_type(
+    client: TestClient, superuser_headers
+):
+    r = client.post(
+        f"{settings.API_V1_STR}/users/import",
+        content=b"<users/>",
+        headers={**superuser_headers, "Content-Type": "application/xml"},
+    )
+    assert r.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+
+def test_import_users_invalid_utf8(client: TestClient, superuser_headers):
+    valid = {"email": random_email(), "username": "utf8a", "password": "password"}
+    body = b"\n".join(
+        [
+            json.dumps(valid).encode(),
+            b'{"email": "\xe9@x.org", "username": "utf8b", "password": "password"}',
+        ]
+    )
+    r = client.post(
+        f"{settings.API_V1_STR}/users/import",
+        content=body,
+        headers={**superuser_headers, "Content-Type": "application/x-ndjson"},
+    )
+    assert r.status_code == 200
+    assert [(result["line"], result["status"]) for result in r.json()["results"]] == [
+        (1, "created"),
+        (2, "invalid"),
+    ]
+
+
+def test_import_users_busy(
+    client: TestClient, superuser_headers, monkeypatch: pytest.MonkeyPatch
+):
+    async def hash(password: str) -> str:
+        raise HashingPoolBusyError()
+
+    monkeypatch.setattr(import_hashing_pool, "hash", hash)
+    body = json.dumps(
+        {"email": random_email(), "username": "busy", "password": "password"}
+    )
+    r = client.post(
+        f"{settings.API_V1_STR}/users/import",
+        content=body.encode(),
+        headers={**superuser_headers, "Content-Type": "application/x-ndjson"},
+    )
+    assert r.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert r.headers["Retry-After"] == "1"
+
+
+def test_import_users_one_at_a_time(client: TestClient, superuser_headers):
+    lock = _local_locks.setdefault(IMPORT_LOCK, asyncio.Lock())
+    client.portal.call(lock.acquire)
+    try:
+        r = client.post(
+            f"{settings.API_V1_STR}/users/import",
+            content=b"",
+            headers={**superuser_headers, "Content-Type": "application/x-ndjson"},
+        )
+    finally:
+        lock.release()
+    assert r.status_code == status.HTTP_409_CONFLICT
+
+
+def test_export_users_ndjson(client: TestClient, superuser_headers):
+    r = client.get(
+        f"{settings.API_V1_STR}/users/export",
+        params={"is_superuser": True},
+        headers=superuser_headers,
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/x-ndjson"
+    users = [json.loads(line) for line in r.text.splitlines()]
+    assert users
+    assert all(user["is_superuser"] for user in users)
+    assert settings.FIRST_SUPERUSER_EMAIL in {user["email"] for user in users}
+    assert set(users[0]) == set(schemas.User.model_fields)
+
+
+def test_export_users_csv(client: TestClient, superuser_headers):
+    r = client.get(
+        f"{settings.API_V1_STR}/users/export",
+        params={"format": "csv", "fields": "id,email"},
+        headers=superuser_headers,
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/csv")
+    lines = r.text.splitlines()
+    assert lines[0] == "id,email"
+    listed = client.get(
+        f"{settings.API_V1_STR}/users/", params={"fields": "id,email", "limit": 1000}
+    ).json()
+    assert lines[1:] == [f"{user['id']},{user['email']}" for user in listed]
+
+
+def test_export_users_own_session(monkeypatch: pytest.MonkeyPatch, tmp_path):
+    """Without the test session overrides: the stream must not read from the
+    session of get_db, which may be closed before the body is sent."""
+    path = tmp_path / "export.sqlite"
+    sync_engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(sync_engine)
+    with sync_engine.begin() as conn:
+        conn.execute(
+            insert(User),
+            [
+                {
+                    "uid": uuid4(),
+                    "email": settings.FIRST_SUPERUSER_EMAIL if i == 0 else f"u{i}@x.org",
+                    "username": f"user{i}",
+                    "hashed_password": "x",
+                    "is_active": True,
+                    "is_superuser": i == 0,
+                }
+                for i in range(250)
+            ],
+        )
+    sync_engine.dispose()
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    monkeypatch.setattr(
+        deps,
+        "SessionLocal",
+        async_sessionmaker(
+            engine,
+            autoflush=False,
+            expire_on_commit=False,
+            sync_session_class=RoutingSession,
+        ),
+    )
+    monkeypatch.setattr(app_settings, "USER_EXPORT_BATCH_SIZE", 100)
+    token = create_access_token(settings.FIRST_SUPERUSER_EMAIL)
+
+    with TestClient(create_app()) as client:
+        r = client.get(
+            f"{settings.API_V1_STR}/users/export",
+            params={"fields": "id,username"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert r.status_code == 200
+        users = [json.loads(line) for line in r.text.splitlines()]
+        assert [user["username"] for user in users] == [f"user{i}" for i in range(250)]
+        # Both sessions, the one of the request and the one of the stream, are closed
+        assert engine.sync_engine.pool.checkedout() == 0
+        client.portal.call(engine.dispose)
+
+
+def test_export_users_unknown_fields(client: TestClient, superuser_headers):
+    r = client.get(
+        f"{settings.API_V1_STR}/users/export",
+        params={"fields": "id,hashed_password"},
+        headers=superuser_headers,
+    )
+    assert r.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_update_users_batch(client: TestClient, superuser_headers):
+    ids = []
+    for i in range(2):
+        body = {"email": random_email(), "username": f"batch{i}", "password": "password"}
+        r = client.post(f"{settings.API_V1_STR}/users/", json=body)
+        ids.append(r.json()["id"])
+    r = client.patch(
+        f"{settings.API_V1_STR}/users/",
+        json={"ids": ids, "is_active": True},
+        headers=superuser_headers,
+    )
+    assert r.status_code == 200
+    assert r.json() == {"updated": 2}
+    for user_id in ids:
+        assert client.get(f"{settings.API_V1_STR}/users/{user_id}").json()["is_active"]
+
+
+def test_update_users_batch_nothing_to_update(client: TestClient, superuser_headers):
+    r = client.patch(
+        f"{settings.API_V1_STR}/users/", json={"ids": [1]}, headers=superuser_headers
+    )
+    assert r.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_create_user_query_count(client: TestClient, max_queries):
+    body = {"email": random_email(), "username": "counted", "password": "password"}
+    with max_queries(1):
+        r = client.post(f"{settings.API_V1_STR}/users/", json=body)
+    assert r.status_code == status.HTTP_201_CREATED
+    with max_queries(1):
+        r = client.get(f"{settings.API_V1_STR}/users/{r.json()['id']}")
+    assert r.status_code == 200
+
+
+def test_authenticated_request_query_count(
+    client: TestClient, superuser_headers, max_queries
+):
+    # The first call resolves the user, the next ones find it in the cache
+    client.patch(
+        f"{settings.API_V1_STR}/users/", json={"ids": [1]}, headers=superuser_headers
+    )
+    with max_queries(0):
+        r = client.patch(
+            f"{settings.API_V1_STR}/users/", json={"ids": [1]}, headers=superuser_headers
+        )
+    assert r.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_search_users(client: TestClient, superuser_headers, max_queries):
+    ids = []
+    for username in ("velo_anne", "annecy74", "bob"):
+        body = {"email": random_email(), "username": username, "password": "password"}
+        ids.append(client.post(f"{settings.API_V1_STR}/users/", json=body).json()["id"])
+    url = f"{settings.API_V1_STR}/users/search"
+    params = {"q": "Ann", "fields": "username"}
+
+    r = client.get(url, params=params, headers=superuser_headers)
+    assert r.status_code == 200
+    assert r.json() == [
+        {"id": ids[0], "username": "velo_anne"},
+        {"id": ids[1], "username": "annecy74"},
+    ]
+    assert "X-Next-Cursor" not in r.headers
+    # The page is cached
+    with max_queries(0):
+        r2 = client.get(url, params=params, headers=superuser_headers)
+    assert r2.json() == r.json()
+
+    # A short word only matches the start of a word
+    r = client.get(url, params={"q": "cy"}, headers=superuser_headers)
+    assert r.json() == []
+
+    found, params = [], {"q": "ann", "limit": 1}
+    while True:
+        r = client.get(url, params=params, headers=superuser_headers)
+        found.extend(user["id"] for user in r.json())
+        if "X-Next-Cursor" not in r.headers:
+            break
+        params["after"] = r.headers["X-Next-Cursor"]
+    assert found == ids[:2]
+
+
+def test_search_users_errors(client: TestClient, superuser_headers):
+    url = f"{settings.API_V1_STR}/users/search"
+    assert client.get(url, params={"q": "ann"}).status_code == 401
+    for params in ({"q": ""}, {"q": "ann", "limit": 0}):
+        r = client.get(url, params=params, headers=superuser_headers)
+        assert r.status_code == 422
+    for params in ({"q": "ann", "after": "xx"}, {"q": "ann", "fields": "password"}):
+        r = client.get(url, params=params, headers=superuser_headers)
+        assert r.status_code == status.HTTP_400_BAD_REQUEST
@@ -3,97 +3,172 @@
 # 
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import asyncio
+import fcntl
+import functools
+import os
+import shutil
 import sys
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
+from pathlib import Path
 
+import aiosqlite
 import jwt
 import pytest
 import pytest_asyncio
+from dotenv import dotenv_values
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, URL
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.exc import SQLAlchemyError
-
-from app.db.base_class import Base
-import app.config as config
-from app.config import Settings
-from app import crud
-from tests.utils.utils import random_email
-
-# Replace the env file in the settings object
-config.settings = Settings(_env_file='/home/eric/code/cycliti/backend/app/app/.test.env')
-
-# All other modules that import settings are imported here
-# This ensures that those modules will use the updated settings object
-# Don't forget to use "noqa", otherwise a formatter might put it back on top
-from app.main import app  # noqa
-from app.config import settings
-from app.api.deps import get_db # noqa
-from app.db.init_db import init_db  # noqa
-from app.tests.utils.user import authentication_token_from_email
-from app.tests.utils.utils import get_superuser_token_headers
+from sqlalchemy.pool import StaticPool
+
+# The settings of the tests come from app/.test.env, the environment overrides
+# them. They must be in the environment before any module reads the settings.
+for key, value in dotenv_values(Path(__file__).parents[1] / ".test.env").items():
+    os.environ.setdefault(key, value)
+
+from app.db.base_class import Base  # noqa: E402
+from app import crud  # noqa: E402
+from app.config import settings  # noqa: E402
+from app.core.hashing import HashingPoolBusyError  # noqa: E402
+from app.core.ratelimit import rate_limiter  # noqa: E402
+from app.core.search import search_cache, user_index  # noqa: E402
+from app.core.security import principal_cache, token_cache  # noqa: E402
+from app.main import create_app  # noqa: E402
+from app.api.deps import get_db, get_session_factory  # noqa: E402
+from app.db.init_db import init_db  # noqa: E402
+from app.db.engine import build_engine  # noqa: E402
+from app.tests.utils.user import authentication_token_from_email  # noqa: E402
+from app.tests.utils.utils import get_superuser_token_headers  # noqa: E402
+from app.tests.utils.db import assert_max_queries  # noqa: E402
+from app.tests.utils.smtp import SMTPSink  # noqa: E402
+from app.core.mail import Mailer  # noqa: E402
+from tests.utils.utils import random_email  # noqa: E402
+
+app = create_app()
+
+# "memory" (default): an in-memory database per test process.
+# "file": a database file per test process, kept in the pytest temporary
+# directory for inspection.
+TEST_DATABASE = os.environ.get("TEST_DATABASE", "memory")
 
 
 @pytest.fixture(scope="session")
-def engine():
-    url_object = URL.create(
-        drivername="mysql+mysqldb",
-        username=config.settings.MYSQL_USER,
-        password=config.settings.MYSQL_PASSWORD,
-        host=config.settings.MYSQL_HOST,
-        port=config.settings.MYSQL_PORT,
-        database=config.settings.MYSQL_DB,
+def schema_template(tmp_path_factory) -> Path:
+    """SQLite file holding the schema and the first superuser, built once per
+    run and copied into the database of each test process."""
+    # The pytest-xdist workers share the parent of their temporary directories
+    root = tmp_path_factory.getbasetemp()
+    if "PYTEST_XDIST_WORKER" in os.environ:
+        root = root.parent
+    path = root / "schema.sqlite"
+    with open(root / "schema.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not path.exists():
+            asyncio.run(_build_schema_template(root / "schema.tmp"))
+            (root / "schema.tmp").rename(path)
+    return path
+
+
+async def _build_schema_template(path: Path) -> None:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+        await init_db(session)
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def engine(schema_template, tmp_path_factory):
+    # SQLite stands in for the MySQL server: a single connection is shared
+    # (StaticPool) so that the application sees the data of the test session.
+    if TEST_DATABASE == "file":
+        path = tmp_path_factory.getbasetemp() / "test.sqlite"
+        shutil.copyfile(schema_template, path)
+        url = f"sqlite+aiosqlite:///{path}"
+    elif TEST_DATABASE == "memory":
+        url = "sqlite+aiosqlite://"
+    else:
+        raise pytest.UsageError(f"Unknown TEST_DATABASE {TEST_DATABASE!r}")
+    engine = build_engine(
+        "test",
+        url,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
     )
-    engine = create_engine(url_object, pool_pre_ping=True)
-    return engine
 
+    # pysqlite defers BEGIN and does not support SAVEPOINT out of the box
+    # https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+    @event.listens_for(engine.sync_engine, "connect")
+    def do_connect(dbapi_connection, _connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    if TEST_DATABASE == "memory":
+        async with engine.connect() as conn:
+            raw = await conn.get_raw_connection()
+            async with aiosqlite.connect(schema_template) as template:
+                await template.backup(raw.driver_connection)
+
+    yield engine
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture(name="session", loop_scope="session")
+async def session_fixture(engine):
+    """Returns a sqlalchemy session whose work is rolled back after the test.
+
+    The test runs in a transaction of its own: the commits of the session (and
+    of the application, which shares it) only release savepoints.
+    """
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        session_factory = async_sessionmaker(
+            bind=connection,
+            autoflush=False,
+            expire_on_commit=False,
+            join_transaction_mode="create_savepoint",
+        )
+        session = session_factory()
 
-@pytest.fixture(scope="session")
-def tables(engine):
-    Base.metadata.create_all(engine)
-    yield
-    Base.metadata.drop_all(engine)
-
-
-@pytest_asyncio.fixture(name="session", scope="session", loop_scope="session")
-async def session_fixture(engine, tables):
-    """Returns a sqlalchemy session, and after the test tears down everything properly."""
-    connection = engine.connect()
-    # begin the nested transaction
-    transaction = connection.begin()
-    # use the connection with the already started transaction
-    # session = Session(bind=connection, join_transaction_mode="create_savepoint")
-    session_factory = sessionmaker(
-        autocommit=False,
-        autoflush=False,
-        bind=connection,
-        join_transaction_mode="create_savepoint",
-    )
-    session = session_factory()
+        yield session
 
-    await init_db(session)
-    # asyncio.run(init_db(session))
+        await session.close()
+        await transaction.rollback()
 
-    yield session
 
-    session.close()
-    # roll back the broader transaction
-    transaction.rollback()
-    # put back the connection to the connection pool
-    connection.close()
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """The cached users, tokens and searches must not outlive the rows of the
+    test, nor the rate limits its attempts."""
+    yield
+    principal_cache.clear()
+    token_cache.clear()
+    search_cache.clear()
+    user_index.clear()
+    rate_limiter.store.clear()
 
 
-@pytest.fixture(name="client", scope="module")
-def client_fixture(session: Session):
+@pytest.fixture(name="client")
+def client_fixture(session: AsyncSession):
     """Create a test client that uses the override_get_db fixture to return a session."""
 
-    def get_db_override():
-        try:
-            yield session
-        finally:
-            session.close()
+    async def get_db_override():
+        yield session
+
+    @asynccontextmanager
+    async def session_override():
+        # The test session outlives the streams that use it
+        yield session
 
     app.dependency_overrides[get_db] = get_db_override
+    app.dependency_overrides[get_session_factory] = lambda: session_override
     with TestClient(app, raise_server_exceptions=False) as test_client:
         yield test_client
     app.dependency_overrides.clear()
@@ -105,7 +180,7 @@ def superuser_token_headers(client: TestClient) -> dict[str, str]:
 
 
 @pytest.fixture
-def normal_user_token_headers(client: TestClient, db: Session) -> dict[str, str]:
+def normal_user_token_headers(client: TestClient, db: AsyncSession) -> dict[str, str]:
     return authentication_token_from_email(
         client=client, email=settings.EMAIL_TEST_USER, db=db
     )
@@ -176,16 +251,48 @@ async def _change_password(db, user_db, new_password):
     monkeypatch.setattr("app.crud.user.change_password", _change_password)
 
 
+@pytest.fixture
+def mock_hashing_pool_busy(monkeypatch):
+    async def _run(fn, *args):
+        raise HashingPoolBusyError
+
+    monkeypatch.setattr("app.core.security.hashing_pool.run", _run)
+
+
 @pytest.fixture()
 def mock_commit(monkeypatch):
     state = {"failed": False}
     called = []
 
-    def _commit(_):
+    async def _commit(_):
         called.append(True)
         if state["failed"]:
             raise SQLAlchemyError("Commit failed")
 
-    monkeypatch.setattr("app.crud.base.Session.commit", _commit)
+    monkeypatch.setattr("app.crud.base.AsyncSession.commit", _commit)
 
     return state, called
+
+
+@pytest.fixture
+def max_queries(engine):
+    """``with max_queries(n):`` fails the test if the block runs more than n
+    statements."""
+    return functools.partial(assert_max_queries, engine)
+
+
+@pytest.fixture
+def smtp_sink():
+    with SMTPSink(reject=("refused@example.com",)) as sink:
+        yield sink
+
+
+@pytest.fixture
+def mailer(smtp_sink) -> Mailer:
+    """Mailer sending to ``smtp_sink``."""
+    return Mailer(
+        "127.0.0.1",
+        smtp_sink.port,
+        sender="Cycliti <noreply@example.com>",
+        templates_dir=settings.EMAIL_TEMPLATES_DIR,
+    )
@@ -0,0 +1,57 @@
+import pytest
+
+from app.core import cache
+from app.core.cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_get_set() -> None:
+    c = TTLCache(maxsize=2, ttl=60)
+    assert c.get("a") is None
+    c.set("a", 1)
+    assert c.get("a") == 1
+    stats = c.stats()
+    assert (stats.hits, stats.misses, stats.size) == (1, 1, 1)
+    assert stats.hit_ratio == 0.5
+
+
+def test_lru_eviction() -> None:
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert c.stats().evictions == 1
+
+
+def test_ttl_expiry(clock) -> None:
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    clock[0] += 59
+    assert c.get("a") == 1
+    clock[0] += 1
+    assert c.get("a") is None
+    assert c.stats().size == 0
+
+
+def test_pop() -> None:
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    assert c.pop("a") == 1
+    assert c.pop("a") is None
+    assert c.get("a") is None
+
+
+def test_disabled() -> None:
+    c = TTLCache(maxsize=0, ttl=60)
+    c.set("a", 1)
+    assert c.get("a") is None
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.core.hashing import HashingPool, HashingPoolBusyError
+
+
+@pytest.fixture
+def pool():
+    pool = HashingPool(kind="thread", max_workers=1, max_queue=1)
+    yield pool
+    pool.shutdown()
+
+
+async def test_hash_and_verify(pool: HashingPool) -> None:
+    hashed = await pool.hash("password")
+    assert hashed.startswith("$argon2")
+    assert await pool.verify(hashed, "password") is True
+
+
+async def test_verify_wrong_password(pool: HashingPool) -> None:
+    hashed = await pool.hash("password")
+    assert await pool.verify(hashed, "wrong password") is False
+
+
+async def test_verify_invalid_hash(pool: HashingPool) -> None:
+    assert await pool.verify("not an argon2 hash", "password") is False
+
+
+async def test_pool_saturated(pool: HashingPool) -> None:
+    release = threading.Event()
+    # One running operation and one queued operation fill the pool
+    tasks = [asyncio.create_task(pool.run(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0.05)
+    stats = pool.stats()
+    assert stats.running == 1
+    assert stats.queue_depth == 1
+
+    with pytest.raises(HashingPoolBusyError):
+        await pool.run(release.wait)
+    release.set()
+    await asyncio.gather(*tasks)
+
+    stats = pool.stats()
+    assert stats.running == stats.queue_depth == 0
+    assert stats.completed == 2
+    assert stats.failed == 0
+    assert stats.rejected == 1
+    # The first operation ran, and the second one waited, until the release
+    assert stats.hash_max > 0.02
+    assert stats.wait_max > 0.02
+    assert stats.hash_max >= stats.hash_avg > 0
+
+
+async def test_failure_counted(pool: HashingPool) -> None:
+    def fail() -> None:
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError, match="boom"):
+        await pool.run(fail)
+    await pool.hash("password")
+    stats = pool.stats()
+    assert stats.completed == 1
+    assert stats.failed == 1
+    assert stats.hash_total > 0
+
+
+async def test_warm_up() -> None:
+    pool = HashingPool(kind="thread", max_workers=2, max_queue=0)
+    try:
+        await pool.warm_up()
+        assert pool.stats().completed == 2
+        assert len(pool._executor._threads) == 2  # type: ignore[union-attr]
+    finally:
+        pool.shutdown()
@@ -0,0 +1,60 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from app.core.mail import Mailer
+
+
+@dataclass
+class Email:
+    email_to: str
+    template: str = "reset_password"
+    environment: dict[str, Any] = field(
+        default_factory=lambda: {
+            "project_name": "Cycliti",
+            "username": "<rider>",
+            "valid_hours": 48,
+            "link": "http://localhost/reset-password?token=abc",
+        }
+    )
+
+
+def test_send_batch(mailer: Mailer, smtp_sink) -> None:
+    emails = [Email(f"rider{i}@example.com") for i in range(3)]
+    assert mailer.send_batch(emails) == [None] * 3
+    # A single connection for the batch
+    assert smtp_sink.connections == 1
+    assert [m["To"] for m in smtp_sink.messages] == [e.email_to for e in emails]
+    message = smtp_sink.messages[0]
+    assert message["Subject"] == "Cycliti - Password recovery for user <rider>"
+    assert message["From"] == "Cycliti <noreply@example.com>"
+    body = message.get_content()
+    assert "&lt;rider&gt;" in body
+    assert "http://localhost/reset-password?token=abc" in body
+
+
+def test_send_batch_errors(mailer: Mailer, smtp_sink) -> None:
+    emails = [
+        Email("refused@example.com"),
+        Email("rider@example.com", template="unknown"),
+        Email("rider@example.com"),
+    ]
+    refused, unknown, sent = mailer.send_batch(emails)
+    assert "Refused" in str(refused)
+    assert "unknown.html" in str(unknown)
+    assert sent is None
+    assert len(smtp_sink.messages) == 1
+
+
+def test_send_batch_server_down(mailer: Mailer, smtp_sink) -> None:
+    smtp_sink.__exit__()
+    errors = mailer.send_batch([Email("a@example.com"), Email("b@example.com")])
+    assert all(isinstance(error, OSError) for error in errors)
+
+
+def test_send_batch_rate(mailer: Mailer, smtp_sink) -> None:
+    mailer.interval = 1 / 50
+    start = time.monotonic()
+    emails = [Email(f"r{i}@example.com") for i in range(5)]
+    assert mailer.send_batch(emails) == [None] * 5
+    assert time.monotonic() - start >= 4 / 50
@@ -0,0 +1,43 @@
+from fastapi.testclient import TestClient
+
+from app.core.metrics import HTTPMetrics, Histogram
+from config import settings
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.render("latency", 'route="/"') == [
+        'latency_bucket{route="/",le="0.1"} 2',
+        'latency_bucket{route="/",le="1.0"} 3',
+        'latency_bucket{route="/",le="+Inf"} 4',
+        'latency_sum{route="/"} 3.65',
+        'latency_count{route="/"} 4',
+    ]
+
+
+def test_render_escapes_labels():
+    registry = HTTPMetrics()
+    registry.observe("GET", '/a"b', 200, 0.01, 10)
+    assert 'route="/a\\"b",status="200"} 1' in registry.render()
+
+
+def test_metrics_endpoint(client: TestClient):
+    client.get(f"{settings.API_V1_STR}/users/1")
+    client.get(f"{settings.API_V1_STR}/users/999999")
+    client.get("/not-a-route")
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    route = f"{settings.API_V1_STR}/users/{{user_id}}"
+    assert f'http_responses_total{{method="GET",route="{route}",status="200"}}' in r.text
+    assert f'http_responses_total{{method="GET",route="{route}",status="404"}}' in r.text
+    assert 'route="unmatched",status="404"' in r.text
+    assert (
+        f'http_request_duration_seconds_count{{method="GET",route="{route}"}}' in r.text
+    )
+    assert "http_requests_in_flight 1" in r.text
+    assert "db_pool_checkouts_total" in r.text
+    assert 'hashing_pool_rejected_total{pool="login"} 0' in r.text
+    assert 'hashing_pool_wait_seconds_total{pool="import"}' in r.text
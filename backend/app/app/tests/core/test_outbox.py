@@ -0,0 +1,92 @@
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import outbox
+from app.core.mail import Mailer
+from app.core.outbox import OutboxWorker, queue_email
+from app.models.outbox import utcnow
+
+ENVIRONMENT = {
+    "project_name": "Cycliti",
+    "username": "rider",
+    "valid_hours": 48,
+    "link": "http://localhost/reset-password",
+}
+
+
+@pytest.fixture
+def worker(session: AsyncSession, mailer: Mailer) -> OutboxWorker:
+    @asynccontextmanager
+    async def session_factory():
+        yield session
+
+    return OutboxWorker(
+        session_factory,
+        mailer,
+        batch_size=10,
+        poll_interval=1,
+        max_attempts=3,
+        backoff=30,
+        backoff_max=3600,
+    )
+
+
+async def test_deliver(session: AsyncSession, worker: OutboxWorker, smtp_sink) -> None:
+    emails = [
+        await queue_email(
+            session,
+            template="reset_password",
+            email_to=f"rider{i}@example.com",
+            environment=ENVIRONMENT,
+        )
+        for i in range(2)
+    ]
+    assert await worker.run_once() == 2
+    assert [m["To"] for m in smtp_sink.messages] == [e.email_to for e in emails]
+    assert smtp_sink.connections == 1
+    for email in emails:
+        await session.refresh(email)
+        assert email.status == "sent" and email.sent_at is not None
+    assert await worker.run_once() == 0
+
+
+async def test_retry_with_backoff(session: AsyncSession, worker: OutboxWorker) -> None:
+    email = await queue_email(
+        session,
+        template="reset_password",
+        email_to="refused@example.com",
+        environment=ENVIRONMENT,
+    )
+    assert await worker.run_once() == 1
+    await session.refresh(email)
+    assert (email.status, email.attempts) == ("pending", 1)
+    assert "Refused" in email.last_error
+    assert email.next_attempt_at > utcnow() + timedelta(seconds=25)
+    # Not due yet
+    assert await worker.run_once() == 0
+
+    email.next_attempt_at = utcnow()
+    await session.commit()
+    assert await worker.run_once() == 1
+    await session.refresh(email)
+    assert email.attempts == 2
+    assert email.next_attempt_at > utcnow() + timedelta(seconds=55)
+
+    email.next_attempt_at = utcnow()
+    await session.commit()
+    assert await worker.run_once() == 1
+    await session.refresh(email)
+    # Given up after max_attempts
+    assert (email.status, email.attempts) == ("failed", 3)
+
+
+async def test_queue_email_wakes_worker(session: AsyncSession, monkeypatch) -> None:
+    woken = []
+    monkeypatch.setattr(outbox.outbox_worker, "wake", lambda: woken.append(True))
+    await queue_email(
+        session, template="reset_password", email_to="r@example.com", environment={}
+    )
+    assert woken == [True]
@@ -0,0 +1,114 @@
+import pytest
+
+from app.core import ratelimit
+from app.core.ratelimit import MemoryStore, RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _limiter(**kwargs) -> RateLimiter:
+    options = {
+        "ip_burst": 3,
+        "ip_per_minute": 60,
+        "account_burst": 2,
+        "account_per_minute": 6,
+        "max_failures": 3,
+        "failure_window": 60,
+        **kwargs,
+    }
+    return RateLimiter(MemoryStore(), **options)
+
+
+async def test_token_bucket(clock) -> None:
+    store = MemoryStore()
+    bucket = [("k", 2, 1)]
+    assert [await store.take(bucket) for _ in range(2)] == [0, 0]
+    assert await store.take(bucket) == pytest.approx(1)
+    clock[0] += 0.5
+    assert await store.take(bucket) == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert await store.take(bucket) == 0
+
+
+async def test_take_all_or_nothing(clock) -> None:
+    store = MemoryStore()
+    assert await store.take([("a", 1, 1)]) == 0
+    # "a" is empty: "b" keeps its token
+    assert await store.take([("a", 1, 1), ("b", 1, 0.5)]) == pytest.approx(1)
+    assert await store.take([("b", 1, 0.5)]) == 0
+    # Waits for the slowest bucket
+    assert await store.take([("a", 1, 1), ("b", 1, 0.5)]) == pytest.approx(2)
+
+
+async def test_ip_and_account_buckets(clock) -> None:
+    limiter = _limiter()
+    assert await limiter.check("1.2.3.4", "a@example.com") == 0
+    assert await limiter.check("1.2.3.4", "A@example.com") == 0
+    # The account bucket is empty, refilled at 6 per minute
+    assert await limiter.check("1.2.3.4", "a@example.com") == pytest.approx(10)
+    # The turned away attempt took no token from the IP bucket
+    assert await limiter.check("1.2.3.4", "b@example.com") == 0
+    # The IP bucket is empty now: the account bucket keeps its token
+    assert await limiter.check("1.2.3.4", "c@example.com") == pytest.approx(1)
+    assert await limiter.check("5.6.7.8", "c@example.com") == 0
+    assert await limiter.check("5.6.7.8", "c@example.com") == 0
+    assert await limiter.check("5.6.7.8", "c@example.com") > 0
+
+
+async def test_failures_sliding_window(clock) -> None:
+    limiter = _limiter(ip_burst=100, account_burst=100)
+    for _ in range(3):
+        assert await limiter.check("1.2.3.4", "a@example.com") == 0
+        await limiter.failed("1.2.3.4", "a@example.com")
+        clock[0] += 10
+    # Locked out until the first failure, 30 s ago, leaves the window
+    assert await limiter.check("1.2.3.4", "a@example.com") == pytest.approx(30)
+    assert await limiter.check("1.2.3.4") == pytest.approx(30)
+    clock[0] += 30
+    assert await limiter.check("1.2.3.4", "a@example.com") == 0
+
+
+async def test_account_lockout_per_ip(clock) -> None:
+    limiter = _limiter(ip_burst=100, account_burst=100)
+    # Failures spread over many IPs lock none of them out
+    for i in range(3):
+        await limiter.failed(f"10.0.0.{i}", "a@example.com")
+    assert await limiter.check("10.0.0.0", "a@example.com") == 0
+    assert await limiter.check("5.6.7.8", "a@example.com") == 0
+    # Failures from one IP lock the account out from that IP only
+    for _ in range(3):
+        await limiter.failed("1.2.3.4", "b@example.com")
+    assert await limiter.check("1.2.3.4", "b@example.com") > 0
+    assert await limiter.check("5.6.7.8", "b@example.com") == 0
+
+
+async def test_success_resets_account_failures(clock) -> None:
+    limiter = _limiter(ip_burst=100, account_burst=100)
+    for _ in range(3):
+        await limiter.failed("1.2.3.4", "a@example.com")
+    await limiter.succeeded("1.2.3.4", "a@example.com")
+    key = "account:a@example.com|ip:1.2.3.4"
+    assert await limiter.store.failures(key, 60) == (0, 0.0)
+    # The IP stays penalized
+    assert await limiter.check("1.2.3.4") > 0
+
+
+def test_rates_must_be_positive() -> None:
+    with pytest.raises(ValueError):
+        _limiter(account_per_minute=0)
+
+
+async def test_memory_store_bounded() -> None:
+    store = MemoryStore(maxsize=2)
+    for key in ("a", "b", "c"):
+        await store.take([(key, 1, 1)])
+        await store.add_failure(key, 60)
+    # The least recently used key is forgotten
+    assert await store.take([("a", 1, 1)]) == 0
+    assert await store.failures("a", 60) == (0, 0.0)
+    assert (await store.failures("c", 60))[0] == 1
@@ -0,0 +1,42 @@
+import pytest
+
+from app.core.records import RecordError, aiter_records
+
+
+async def _chunks(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def test_aiter_records_ndjson_split_chunks():
+    chunks = _chunks(b'{"a": 1}\r\n{"a"', b': 2}\n\n[1]\n{"a": 3}')
+    records = [item async for item in aiter_records(chunks, "application/x-ndjson")]
+    assert records[0] == (1, {"a": 1})
+    assert records[1] == (2, {"a": 2})
+    assert records[2][0] == 4 and isinstance(records[2][1], RecordError)
+    assert records[3] == (5, {"a": 3})
+
+
+async def test_aiter_records_csv():
+    chunks = _chunks(b"email,city\nfoo@bar.com,\n", b'baz@bar.com,"Lyon"\nx\n')
+    records = [item async for item in aiter_records(chunks, "text/csv")]
+    assert records[:2] == [
+        (2, {"email": "foo@bar.com"}),
+        (3, {"email": "baz@bar.com", "city": "Lyon"}),
+    ]
+    assert records[2][0] == 4 and isinstance(records[2][1], RecordError)
+
+
+@pytest.mark.parametrize("media_type", ["application/x-ndjson", "text/csv"])
+async def test_aiter_records_invalid_utf8(media_type):
+    first = b'{"a": 1}' if media_type != "text/csv" else b"a"
+    chunks = _chunks(first + b"\n", b'{"a": "\xe9"}\n', b'{"a": 3}\n')
+    records = [item async for item in aiter_records(chunks, media_type)]
+    assert records[-2][0] == 2 and str(records[-2][1]) == "Invalid UTF-8"
+    assert records[-1][0] == 3
+
+
+async def test_aiter_records_unsupported_media_type():
+    with pytest.raises(RecordError):
+        async for _ in aiter_records(_chunks(b"<a/>"), "application/xml"):
+            pass
@@ -0,0 +1,87 @@
+import pytest
+
+from app.core import search
+from app.core.search import SearchIndex, matches, query_grams, text_grams, words
+
+
+def test_words() -> None:
+    assert words("Saint-Étienne") == ["saint", "etienne"]
+    assert words("jean_DUPONT42") == ["jean", "dupont42"]
+    assert words("  ") == []
+    assert words(None) == []
+
+
+def test_grams() -> None:
+    assert text_grams(["Anne"]) == {"  a", " an", "ann", "nne", "ne "}
+    assert query_grams(["a"]) == {"  a"}
+    assert query_grams(["an"]) == {" an"}
+    assert query_grams(["anne"]) == {"ann", "nne"}
+    # Every match is indexed under the grams of the query
+    assert query_grams(words("NNE an")) <= text_grams(["Anne"])
+
+
+def test_matches() -> None:
+    texts = ["jdupont", "Jean Dupont", "Saint-Étienne"]
+    assert matches(["dup"], texts)
+    assert matches(["jea", "etie"], texts)
+    assert matches(["je"], texts)
+    # A short word only matches the start of a word
+    assert not matches(["ea"], texts)
+    assert not matches(["jean", "lyon"], texts)
+    assert not matches(["x"], [None, None])
+
+
+def test_candidates() -> None:
+    index = SearchIndex(sync_interval=30)
+    index.add(3, ["Anne", "Lyon"])
+    index.add(1, ["Jeanne", "Paris"])
+    index.add(2, ["Jean", None])
+    assert list(index.candidates(["anne"])) == [1, 3]
+    assert list(index.candidates(["an"])) == [3]
+    assert list(index.candidates(["jean"])) == [1, 2]
+    assert list(index.candidates(["jean"], after=1)) == [2]
+    assert list(index.candidates(["jea", "par"])) == [1]
+    assert list(index.candidates(["zzz"])) == []
+    # Adding a user again does not duplicate its postings
+    index.add(1, ["Jeanne"])
+    assert list(index.candidates(["jean"])) == [1, 2]
+
+
+def test_candidates_while_index_changes() -> None:
+    index = SearchIndex(sync_interval=30)
+    for user_id in range(1, 6):
+        index.add(user_id, ["Anne"])
+    candidates = index.candidates(["anne"])
+    assert next(candidates) == 1
+    index.remove(2, ["Anne"])
+    index.remove(3, ["Anne"])
+    index.add(7, ["Anne"])
+    assert list(candidates) == [4, 5, 7]
+
+
+def test_remove_and_replace() -> None:
+    index = SearchIndex(sync_interval=30)
+    index.add(1, ["jdupont", "Jean Dupont", "Lyon"])
+    index.replace(
+        1,
+        {"username": "jdupont", "name": "Jean Dupont", "city": "Lyon"},
+        {"city": "Paris"},
+    )
+    assert list(index.candidates(["lyon"])) == []
+    assert list(index.candidates(["paris"])) == [1]
+    assert list(index.candidates(["dupont"])) == [1]
+    index.remove(1, ["jdupont", "Jean Dupont", "Paris"])
+    assert index.stats() == {"grams": 0, "postings": 0}
+
+
+def test_due(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr(search.time, "monotonic", lambda: now[0])
+    index = SearchIndex(sync_interval=30)
+    assert index.due()
+    index.loaded, index.synced_at = True, now[0]
+    assert not index.due()
+    now[0] += 30
+    assert index.due()
+    index.clear()
+    assert not index.loaded and index.watermark is None
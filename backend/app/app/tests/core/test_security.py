@@ -0,0 +1,56 @@
+import hashlib
+import time
+from datetime import timedelta
+
+import jwt
+import pytest
+
+from app.config import settings
+from app.core.security import create_access_token, decode_token, token_cache
+
+
+def digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    token_cache.clear()
+    yield
+    token_cache.clear()
+
+
+def test_decode_token_cached() -> None:
+    token = create_access_token("user@example.com")
+    payload = decode_token(token, require=("exp", "sub"))
+    assert payload["sub"] == "user@example.com"
+    hits = token_cache.stats().hits
+    assert decode_token(token, require=("exp", "sub")) is payload
+    assert token_cache.stats().hits == hits + 1
+
+
+def test_decode_token_invalid_not_cached() -> None:
+    with pytest.raises(jwt.PyJWTError):
+        decode_token("not.a.token")
+    assert token_cache.stats().size == 0
+
+
+def test_decode_token_entry_expires_with_token(monkeypatch) -> None:
+    token = create_access_token("user@example.com", expires_delta=timedelta(seconds=5))
+    decode_token(token)
+    assert token_cache.get(digest(token)) is not None
+    # The cache TTL is longer, but the entry must not outlive the token
+    real_monotonic = time.monotonic
+    monkeypatch.setattr(
+        "app.core.cache.time.monotonic", lambda: real_monotonic() + 6
+    )
+    assert token_cache.get(digest(token)) is None
+
+
+def test_decode_token_cached_missing_claim() -> None:
+    token = jwt.encode(
+        {"exp": int(time.time()) + 60}, settings.SECRET_KEY, algorithm="HS256"
+    )
+    decode_token(token)
+    with pytest.raises(jwt.MissingRequiredClaimError):
+        decode_token(token, require=("exp", "sub"))
@@ -0,0 +1,40 @@
+import json
+
+from app import schemas
+from app.core.serialization import ORJSONResponse, serialize, type_adapter
+from app.models.user import User
+
+
+def make_user() -> User:
+    user = User(
+        uid="0" * 32,
+        email="rider@example.com",
+        username="rider",
+        hashed_password="secret",
+        preferred_language="fr-FR",
+        access_type=1,
+    )
+    user.id = 1
+    user.photo_path = "/does/not/exist"
+    return user
+
+
+def test_type_adapter_cached() -> None:
+    assert type_adapter(schemas.User) is type_adapter(schemas.User)
+
+
+def test_serialize_orm_instance() -> None:
+    data = json.loads(serialize(schemas.User, make_user()))
+    assert data["email"] == "rider@example.com"
+    assert data["photo_path"] == "/does/not/exist"
+    assert "hashed_password" not in data
+
+
+def test_serialize_list() -> None:
+    data = json.loads(serialize(list[schemas.User], [make_user(), make_user()]))
+    assert [user["id"] for user in data] == [1, 1]
+
+
+def test_orjson_response() -> None:
+    assert ORJSONResponse({"a": 1}).body == b'{"a":1}'
+    assert ORJSONResponse(b'{"b":2}').body == b'{"b":2}'
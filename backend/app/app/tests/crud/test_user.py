@@ -1,17 +1,24 @@
+from uuid import UUID, uuid4
+
 import pytest
 from fastapi.encoders import jsonable_encoder
 from pydantic import SecretStr
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, event, insert, select
+from sqlalchemy.dialects import mysql
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud
-from app.core.security import verify_password
+from app.core.search import user_index
+from app.core.security import principal_cache, verify_password
+from app.crud import CrudError, CrudIntegrityError, CrudPaginationError
+from app.crud.base import encode_cursor
+from app.models.user import User
 from app.schemas.user import UserCreate, UserUpdate
 from app.tests.utils.utils import random_email, random_lower_string
 from config import settings
-from crud import CrudError
 
 
-async def test_init_db(session: Session):
+async def test_init_db(session: AsyncSession):
     user = await crud.user.get_by_email(session, email=settings.FIRST_SUPERUSER_EMAIL)
     assert user is not None
     assert user.username == settings.FIRST_SUPERUSER_USERNAME
@@ -19,7 +26,7 @@ async def test_init_db(session: Session):
     assert user.is_superuser
 
 
-async def test_create_user(session: Session) -> None:
+async def test_create_user(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = SecretStr(random_lower_string(32))
@@ -28,9 +35,24 @@ async def test_create_user(session: Session) -> None:
     assert user.email == email
     assert user.username == username
     assert hasattr(user, "hashed_password")
+    # Filled without a refresh
+    assert user.id is not None
+    assert user.preferred_language == "fr-FR"
+    assert user.is_active is False
+
+
+async def test_create_user_duplicate_email(session: AsyncSession) -> None:
+    email = random_email()
+    password = SecretStr(random_lower_string(32))
+    user_in = UserCreate(email=email, username=random_lower_string(8), password=password)
+    await crud.user.create(session, obj_in=user_in)
+    user_in = UserCreate(email=email, username=random_lower_string(8), password=password)
+    with pytest.raises(CrudIntegrityError) as exc_info:
+        await crud.user.create(session, obj_in=user_in)
+    assert exc_info.value.field == "email"
 
 
-async def test_authenticate_user(session: Session) -> None:
+async def test_authenticate_user(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -44,14 +66,14 @@ async def test_authenticate_user(session: Session) -> None:
     assert user.username == authenticated_user.username
 
 
-async def test_not_authenticate_user(session: Session) -> None:
+async def test_not_authenticate_user(session: AsyncSession) -> None:
     email = random_email()
     password = random_lower_string(32)
     user = await crud.user.authenticate(session, email=email, password=password)
     assert user is None
 
 
-async def test_check_if_user_is_active(session: Session) -> None:
+async def test_check_if_user_is_active(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -66,7 +88,7 @@ async def test_check_if_user_is_active(session: Session) -> None:
     assert is_active is True
 
 
-async def test_check_if_user_is_active_inactive(session: Session) -> None:
+async def test_check_if_user_is_active_inactive(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -80,7 +102,7 @@ async def test_check_if_user_is_active_inactive(session: Session) -> None:
     assert is_active is False
 
 
-async def test_check_if_user_is_superuser(session: Session) -> None:
+async def test_check_if_user_is_superuser(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -95,7 +117,7 @@ async def test_check_if_user_is_superuser(session: Session) -> None:
     assert is_superuser is True
 
 
-async def test_check_if_user_is_superuser_normal_user(session: Session) -> None:
+async def test_check_if_user_is_superuser_normal_user(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -109,7 +131,7 @@ async def test_check_if_user_is_superuser_normal_user(session: Session) -> None:
     assert is_superuser is False
 
 
-async def test_get_user(session: Session) -> None:
+async def test_get_user(session: AsyncSession) -> None:
     email = random_email()
     username = random_lower_string(8)
     password = random_lower_string(32)
@@ -126,20 +148,343 @@ async def test_get_user(session: Session) -> None:
     assert jsonable_encoder(user) == jsonable_encoder(user_2)
 
 
-async def test_get_user_unknown_user(session: Session) -> None:
+async def test_get_user_unknown_user(session: AsyncSession) -> None:
     user = await crud.user.get(session, obj_id=42)
     assert user is None
 
 
-# def test_update_user(db: Session) -> None:
-#     password = random_lower_string()
-#     email = random_email()
-#     user_in = UserCreate(email=email, password=password, is_superuser=True)
-#     user = crud.user.create(db, obj_in=user_in)
-#     new_password = random_lower_string()
-#     user_in_update = UserUpdate(password=new_password, is_superuser=True)
-#     crud.user.update(db, db_obj=user, obj_in=user_in_update)
-#     user_2 = crud.user.get(db, id=user.id)
-#     assert user_2
-#     assert user.email == user_2.email
-#     assert verify_password(new_password, user_2.hashed_password)
+async def test_get_user_by_uid(session: AsyncSession) -> None:
+    user_in = UserCreate(
+        email=random_email(),
+        username=random_lower_string(8),
+        password=SecretStr(random_lower_string(32)),
+    )
+    user = await crud.user.create(session, obj_in=user_in)
+    assert isinstance(user.uid, UUID)
+    session.expunge_all()
+    for uid in (user.uid, user.uid.hex, str(user.uid)):
+        user_2 = await crud.user.get_by_uid(session, uid=uid)
+        assert user_2 is not None
+        assert user_2.id == user.id
+        assert user_2.uid == user.uid
+    assert await crud.user.get_by_uid(session, uid=uuid4()) is None
+    assert await crud.user.get_by_uid(session, uid="not a uid") is None
+
+
+async def test_change_password_evicts_cached_user(session: AsyncSession) -> None:
+    email = random_email()
+    username = random_lower_string(8)
+    password = SecretStr(random_lower_string(32))
+    user_in = UserCreate(email=email, username=username, password=password)
+    user = await crud.user.create(session, obj_in=user_in)
+    principal_cache.set(email, user)
+    await crud.user.change_password(session, user_db=user, new_password="changeme")
+    assert principal_cache.get(email) is None
+
+
+async def test_update_stale_cached_user(session: AsyncSession) -> None:
+    email = random_email()
+    user_in = UserCreate(
+        email=email,
+        username=random_lower_string(8),
+        password=SecretStr(random_lower_string(32)),
+    )
+    await crud.user.create(session, obj_in=user_in)
+    session.expunge_all()
+    # Loaded as deps.get_current_user does
+    user = await crud.user.get_by_email(session, email=email)
+    assert user is not None
+    session.expunge(user)
+    # Another worker writes the user after it was cached
+    await crud.user.update_many(session, ids=[user.id], values={"city": "Lyon"})
+    principal_cache.set(email, user)
+    # As deps.get_current_user attaches a cached user
+    stale = await session.merge(user, load=False)
+    with pytest.raises(crud.CrudStaleDataError):
+        await crud.user.update(session, db_obj=stale, obj_in={"name": "Jean"})
+    assert principal_cache.get(email) is None
+    # Loaded again, the user updates
+    fresh = await crud.user.get(session, user.id)
+    assert fresh is not None and fresh.city == "Lyon"
+    fresh = await crud.user.update(session, db_obj=fresh, obj_in={"name": "Jean"})
+    assert fresh.name == "Jean"
+
+
+@pytest.mark.parametrize("order_by", ["id", "username", "email", "uid", "updated_at"])
+async def test_get_page_walks_all_users(session: AsyncSession, order_by: str) -> None:
+    for _ in range(3):
+        user_in = UserCreate(
+            email=random_email(),
+            username=random_lower_string(8),
+            password=SecretStr(random_lower_string(32)),
+        )
+        await crud.user.create(session, obj_in=user_in)
+    all_users = await crud.user.get_all(session)
+
+    walked = []
+    after = None
+    while True:
+        page, after = await crud.user.get_page(
+            session, after=after, limit=2, order_by=order_by
+        )
+        walked.extend(page)
+        if after is None:
+            break
+    assert [getattr(u, order_by) for u in walked] == sorted(
+        getattr(u, order_by) for u in all_users
+    )
+
+
+async def test_get_page_rows(session: AsyncSession) -> None:
+    users, _ = await crud.user.get_page(session, limit=3)
+    rows, after = await crud.user.get_page_rows(
+        session, columns=["username"], limit=3, order_by="username"
+    )
+    assert set(rows[0]) == {"username", "id"}
+    assert [row["username"] for row in rows] == sorted(
+        row["username"] for row in rows
+    )
+    rows, _ = await crud.user.get_page_rows(session, columns=["email"], limit=3)
+    assert [row["email"] for row in rows] == [user.email for user in users]
+
+
+async def test_get_page_invalid_cursor(session: AsyncSession) -> None:
+    with pytest.raises(CrudPaginationError):
+        await crud.user.get_page(session, after="not-a-cursor")
+    _, after = await crud.user.get_page(session, limit=1, order_by="id")
+    with pytest.raises(CrudPaginationError):
+        await crud.user.get_page(session, after=after, order_by="email")
+    for values in (["yesterday", 1], [42, 1]):
+        with pytest.raises(CrudPaginationError):
+            await crud.user.get_page(
+                session,
+                after=encode_cursor("updated_at", values),
+                order_by="updated_at",
+            )
+
+
+def test_get_page_mysql_range() -> None:
+    """The condition of a page is a range of the index on MySQL: no row value
+    comparison, and a leading bound on the indexed column."""
+    keyset = crud.user._keyset("username")
+    stmt = crud.user._keyset_page(
+        select(User.id), keyset, encode_cursor("username", ["bob", 3]), "username"
+    )
+    sql = " ".join(
+        str(
+            stmt.compile(
+                dialect=mysql.dialect(), compile_kwargs={"literal_binds": True}
+            )
+        ).split()
+    )
+    assert sql.endswith(
+        "WHERE user.username >= 'bob' AND (user.username > 'bob'"
+        " OR user.username = 'bob' AND user.id > 3)"
+        " ORDER BY user.username, user.id"
+    )
+
+
+async def test_get_page_unindexed_column(session: AsyncSession) -> None:
+    with pytest.raises(CrudPaginationError):
+        await crud.user.get_page(session, order_by="city")
+
+
+async def test_update_user(session: AsyncSession) -> None:
+    user_in = UserCreate(
+        email=random_email(),
+        username=random_lower_string(8),
+        password=SecretStr(random_lower_string(32)),
+    )
+    user = await crud.user.create(session, obj_in=user_in)
+    statements = []
+
+    def record(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    sync_engine = session.bind.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", record)
+    try:
+        new_password = random_lower_string(32)
+        user_in_update = UserUpdate(
+            username=user.username, city="Grenoble", password=SecretStr(new_password)
+        )
+        await crud.user.update(session, db_obj=user, obj_in=user_in_update)
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", record)
+
+    # One UPDATE of the changed columns only, and no SELECT
+    statements = [s for s in statements if not s.startswith(("SAVEPOINT", "RELEASE"))]
+    assert len(statements) == 1
+    assert statements[0].startswith("UPDATE user SET hashed_password=?, city=?")
+    assert user.city == "Grenoble"
+    assert await verify_password(new_password, user.hashed_password)
+
+
+async def test_update_user_version(session: AsyncSession) -> None:
+    user_in = UserCreate(
+        email=random_email(),
+        username=random_lower_string(8),
+        password=SecretStr(random_lower_string(32)),
+    )
+    user = await crud.user.create(session, obj_in=user_in)
+    assert user.version == 1
+    created_at = user.updated_at
+
+    await crud.user.update(session, db_obj=user, obj_in={"city": "Lyon"})
+    assert user.version == 2
+    assert user.updated_at >= created_at
+    # Nothing changed: no UPDATE, same version
+    await crud.user.update(session, db_obj=user, obj_in={"city": "Lyon"})
+    assert user.version == 2
+
+    await crud.user.update_many(session, ids=[user.id], values={"access_type": 2})
+    row = await crud.user.get_row(session, obj_id=user.id, columns=["version"])
+    assert row == {"version": 3}
+
+
+async def test_update_many_users(session: AsyncSession) -> None:
+    users = []
+    for _ in range(3):
+        user_in = UserCreate(
+            email=random_email(),
+            username=random_lower_string(8),
+            password=SecretStr(random_lower_string(32)),
+        )
+        users.append(await crud.user.create(session, obj_in=user_in))
+    principal_cache.set(users[0].email, users[0])
+    ids = [user.id for user in users[:2]]
+
+    updated = await crud.user.update_many(
+        session, ids=ids, values={"is_active": True, "access_type": 2}
+    )
+    assert updated == 2
+    assert principal_cache.get(users[0].email) is None
+    rows = [
+        row
+        async for batch in crud.user.stream_rows(
+            session, columns=["id", "is_active", "access_type"]
+        )
+        for row in batch
+        if row["id"] in {user.id for user in users}
+    ]
+    assert rows == [
+        {"id": users[0].id, "is_active": True, "access_type": 2},
+        {"id": users[1].id, "is_active": True, "access_type": 2},
+        {"id": users[2].id, "is_active": False, "access_type": 1},
+    ]
+    with pytest.raises(CrudError):
+        await crud.user.update_many(session, ids=ids, values={"unknown": 1})
+
+
+async def test_stream_rows_batches(session: AsyncSession) -> None:
+    for _ in range(3):
+        user_in = UserCreate(
+            email=random_email(),
+            username=random_lower_string(8),
+            password=SecretStr(random_lower_string(32)),
+        )
+        await crud.user.create(session, obj_in=user_in)
+    all_users = await crud.user.get_all(session)
+
+    batches = [
+        batch
+        async for batch in crud.user.stream_rows(
+            session, columns=["id", "is_active"], batch_size=2
+        )
+    ]
+    assert all(len(batch) <= 2 for batch in batches)
+    rows = [row for batch in batches for row in batch]
+    assert [row["id"] for row in rows] == sorted(user.id for user in all_users)
+
+    inactive = [
+        row
+        async for batch in crud.user.stream_rows(
+            session, columns=["id"], filters={"is_active": False}
+        )
+        for row in batch
+    ]
+    assert {row["id"] for row in inactive} == {
+        user.id for user in all_users if not user.is_active
+    }
+
+
+async def _create_user(session: AsyncSession, **fields) -> User:
+    user_in = UserCreate(
+        email=random_email(),
+        username=random_lower_string(8),
+        password=SecretStr(random_lower_string(32)),
+    )
+    user = await crud.user.create(session, obj_in=user_in)
+    if fields:
+        user = await crud.user.update(session, db_obj=user, obj_in=fields)
+    return user
+
+
+async def test_search_users(session: AsyncSession) -> None:
+    users = [
+        await _create_user(session, name="Jeanne Martin", city="Lyon"),
+        await _create_user(session, name="Jean Dupont", city="Saint-Étienne"),
+        await _create_user(session, name="Anne Jeannot", city="Lyon"),
+    ]
+    ids = [user.id for user in users]
+
+    rows, cursor = await crud.user.search(session, query="jean", columns=["name"])
+    assert rows == [
+        {"name": "Jeanne Martin", "id": ids[0]},
+        {"name": "Jean Dupont", "id": ids[1]},
+        {"name": "Anne Jeannot", "id": ids[2]},
+    ]
+    assert cursor is None
+    rows, _ = await crud.user.search(session, query="ETIEN", columns=["id"])
+    assert rows == [{"id": ids[1]}]
+    rows, _ = await crud.user.search(session, query="jean ly", columns=["id"])
+    assert rows == [{"id": ids[0]}, {"id": ids[2]}]
+    assert await crud.user.search(session, query=" - ", columns=["id"]) == ([], None)
+
+    # Updates and deletes are reindexed
+    await crud.user.update(session, db_obj=users[2], obj_in={"name": "Anne Martin"})
+    await crud.user.delete(session, db_obj=users[1])
+    rows, _ = await crud.user.search(session, query="jean", columns=["id"])
+    assert rows == [{"id": ids[0]}]
+
+
+async def test_search_users_pages(session: AsyncSession) -> None:
+    ids = [(await _create_user(session, city="Grenoble")).id for _ in range(5)]
+    found, cursor = [], None
+    while True:
+        rows, cursor = await crud.user.search(
+            session, query="greno", columns=["id"], after=cursor, limit=2
+        )
+        found.extend(row["id"] for row in rows)
+        if cursor is None:
+            break
+    assert found == ids
+    with pytest.raises(CrudPaginationError):
+        await crud.user.search(session, query="greno", columns=["id"], after="xx")
+
+
+async def test_search_index_sync(session: AsyncSession) -> None:
+    await crud.user.search(session, query="lyon", columns=["id"])
+    assert user_index.loaded
+    # Written by another process: not in the index of this one
+    user_id = (
+        await session.execute(
+            insert(User)
+            .values(
+                uid=uuid4(),
+                email=random_email(),
+                username=random_lower_string(8),
+                hashed_password="x",
+                city="Lyon",
+            )
+            .returning(User.id)
+        )
+    ).scalar_one()
+    assert await crud.user.search(session, query="lyon", columns=["id"]) == ([], None)
+
+    user_index.synced_at = 0.0
+    rows, _ = await crud.user.search(session, query="lyon", columns=["id"])
+    assert rows == [{"id": user_id}]
+    # Deleted by another process: the row is checked
+    await session.execute(delete(User).where(User.id == user_id))
+    assert await crud.user.search(session, query="lyon", columns=["id"]) == ([], None)
@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from app.db.engine import build_engine, pool_stats, prefill_pool
+
+
+async def test_pool_stats(tmp_path):
+    engine = build_engine(
+        "stats",
+        f"sqlite+aiosqlite:///{tmp_path}/db.sqlite",
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05,
+    )
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        stats = pool_stats()["stats"]
+        assert (stats.size, stats.checked_out, stats.opened) == (1, 1, 1)
+        with pytest.raises(PoolTimeoutError):
+            async with engine.connect():
+                pass
+    # The connection went back to the pool, it is reused
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    await engine.dispose()
+
+    stats = pool_stats()["stats"]
+    assert stats.checked_out == 0
+    assert stats.checkouts == 3
+    assert stats.timeouts == 1
+    assert stats.wait_max >= 0.05
+    assert (stats.opened, stats.closed) == (1, 1)
+
+
+async def test_pool_overflow(tmp_path):
+    engine = build_engine(
+        "overflow",
+        f"sqlite+aiosqlite:///{tmp_path}/db.sqlite",
+        pool_size=1,
+        max_overflow=1,
+    )
+    async with engine.connect(), engine.connect():
+        stats = pool_stats()["overflow"]
+        assert (stats.checked_out, stats.overflow) == (2, 1)
+    assert pool_stats()["overflow"].overflow == 0
+    await engine.dispose()
+
+
+async def test_prefill_pool(tmp_path):
+    engine = build_engine(
+        "prefill",
+        f"sqlite+aiosqlite:///{tmp_path}/db.sqlite",
+        pool_size=3,
+        max_overflow=0,
+    )
+    assert await prefill_pool(engine, 3) == 3
+    stats = pool_stats()["prefill"]
+    assert (stats.opened, stats.checked_out) == (3, 0)
+    # The requests reuse the connections opened at startup
+    async with engine.connect(), engine.connect(), engine.connect():
+        pass
+    assert pool_stats()["prefill"].opened == 3
+    await engine.dispose()
+
+
+async def test_prefill_pool_unreachable(tmp_path):
+    engine = build_engine(
+        "unreachable", f"sqlite+aiosqlite:///{tmp_path}/missing/db.sqlite"
+    )
+    with pytest.raises(OperationalError):
+        await prefill_pool(engine, 2)
+    assert pool_stats()["unreachable"].checked_out == 0
+    await engine.dispose()
@@ -0,0 +1,48 @@
+import logging
+
+from fastapi.testclient import TestClient
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import instrumentation
+from app.db.instrumentation import collect_queries
+from app.models.user import User
+from config import settings
+
+
+async def test_collect_queries(session: AsyncSession):
+    # Begin the session transaction (a savepoint in the tests) beforehand
+    await session.execute(text("SELECT 0"))
+    with collect_queries() as stats:
+        for _ in range(3):
+            await session.execute(select(User.id).where(User.id == 1))
+        await session.execute(text("SELECT 1"))
+    assert stats.count == 4
+    assert stats.total >= stats.slowest > 0
+    assert stats.slowest_statement is not None
+    [(statement, count)] = stats.repeated(3)
+    assert statement.startswith("SELECT user.id") and count == 3
+
+
+async def test_slow_query_log(session: AsyncSession, monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation.settings, "SLOW_QUERY_THRESHOLD_MS", 0)
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        await session.execute(text("SELECT 42"))
+    assert "Slow query" in caplog.text
+    assert "SELECT 42" in caplog.text
+
+
+def test_debug_headers(client: TestClient, monkeypatch):
+    r = client.get(f"{settings.API_V1_STR}/users/1")
+    assert "X-DB-Query-Count" not in r.headers
+    monkeypatch.setattr(instrumentation.settings, "SQL_DEBUG_HEADERS", True)
+    r = client.get(f"{settings.API_V1_STR}/users/1")
+    assert r.headers["X-DB-Query-Count"] == "1"
+    assert float(r.headers["X-DB-Time-Ms"]) >= float(r.headers["X-DB-Slowest-Ms"])
+
+
+def test_n_plus_one_log(client: TestClient, monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation.settings, "N_PLUS_ONE_THRESHOLD", 1)
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        client.get(f"{settings.API_V1_STR}/users/1")
+    assert "Possible N+1 in GET /api/v1/users/1" in caplog.text
@@ -0,0 +1,14 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.locks import named_lock
+
+
+async def test_named_lock(session: AsyncSession) -> None:
+    async with named_lock(session, "test") as acquired:
+        assert acquired
+        async with named_lock(session, "test") as again:
+            assert not again
+        async with named_lock(session, "other") as other:
+            assert other
+    async with named_lock(session, "test") as acquired:
+        assert acquired
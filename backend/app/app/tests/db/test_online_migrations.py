@@ -0,0 +1,120 @@
+import io
+
+import pytest
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+from app.db import online_migrations
+from app.db.online_migrations import alter_online, backfill, checkpoints
+
+metadata = sa.MetaData()
+rider = sa.Table(
+    "rider",
+    metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("city", sa.String(64), nullable=True),
+)
+
+
+@pytest.fixture(name="connection")
+def connection_fixture(tmp_path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path}/migrations.sqlite")
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        # Ids 1 to 2500 with a gap, the rows of 1 to 10 are filled in already
+        conn.execute(
+            rider.insert(),
+            [
+                {"id": i, "city": "Lyon" if i <= 10 else None}
+                for i in range(1, 2501)
+                if not 1200 < i <= 1300
+            ],
+        )
+    with engine.connect() as conn:
+        yield conn
+    engine.dispose()
+
+
+def _backfill(conn: sa.Connection, **kwargs) -> int:
+    """Run backfill as alembic/env.py runs a migration."""
+    conn.commit()
+    context = MigrationContext.configure(conn)
+    with Operations.context(context), context.begin_transaction():
+        return backfill(
+            "rider",
+            {"city": "'Paris'"},
+            where="city IS NULL",
+            name="rider_city",
+            chunk_size=1000,
+            sleep_ratio=0,
+            **kwargs,
+        )
+
+
+def _cities(conn: sa.Connection) -> dict[str, int]:
+    rows = conn.execute(sa.select(rider.c.city, sa.func.count()).group_by(rider.c.city))
+    return dict(rows.all())
+
+
+def test_backfill(connection):
+    statements = []
+    sa.event.listen(
+        connection,
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    assert _backfill(connection) == 2390
+    assert _cities(connection) == {"Lyon": 10, "Paris": 2390}
+    # By chunks of 1000 ids
+    assert sum(s.startswith("UPDATE rider") for s in statements) == 3
+    checkpoint = connection.execute(sa.select(checkpoints)).one()
+    assert (checkpoint.last_key, checkpoint.updated_rows) == (2500, 2390)
+    assert checkpoint.done
+
+    # Done already
+    assert _backfill(connection) == 2390
+
+
+def test_backfill_resumes(connection, monkeypatch):
+    def crash(_seconds):
+        raise KeyboardInterrupt
+
+    # Interrupted after its first chunk
+    monkeypatch.setattr(online_migrations.time, "sleep", crash)
+    with pytest.raises(KeyboardInterrupt):
+        _backfill(connection)
+    assert _cities(connection) == {"Lyon": 10, "Paris": 990, None: 1400}
+    assert connection.execute(sa.select(checkpoints.c.last_key)).scalar() == 1000
+    monkeypatch.undo()
+
+    # The ids up to 1000 are not scanned again
+    statements = []
+    sa.event.listen(
+        connection,
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    assert _backfill(connection) == 2390
+    assert sum(s.startswith("UPDATE rider") for s in statements) == 2
+    assert _cities(connection) == {"Lyon": 10, "Paris": 2390}
+
+
+def test_backfill_empty_table(connection):
+    connection.execute(rider.delete())
+    connection.commit()
+    assert _backfill(connection) == 0
+    assert connection.execute(sa.select(checkpoints.c.done)).scalar() is True
+
+
+def test_alter_online():
+    output = io.StringIO()
+    context = MigrationContext.configure(
+        dialect_name="mysql", opts={"as_sql": True, "output_buffer": output}
+    )
+    with Operations.context(context):
+        alter_online("user", "MODIFY updated_at DATETIME NOT NULL")
+    assert output.getvalue().strip() == (
+        "ALTER TABLE user MODIFY updated_at DATETIME NOT NULL, "
+        "ALGORITHM=INPLACE, LOCK=NONE;"
+    )
@@ -0,0 +1,134 @@
+import pytest
+import pytest_asyncio
+from pydantic import SecretStr
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import crud
+from app.db.base_class import Base
+from app.db.routing import ReplicaSet, RoutingSession
+from app.models.user import User
+from app.schemas.user import UserCreate
+
+EMAIL = "rider@example.com"
+
+
+async def _database(path, username):
+    """A SQLite stand-in holding a single user, ``username`` tells them apart."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            insert(User),
+            [{"uid": "0" * 32, "email": EMAIL, "username": username,
+              "hashed_password": "x" * 97}],
+        )
+    return engine
+
+
+@pytest_asyncio.fixture
+async def engines(tmp_path):
+    primary = await _database(tmp_path / "primary.sqlite", "primary")
+    replica = await _database(tmp_path / "replica.sqlite", "replica")
+    yield primary, replica
+    await primary.dispose()
+    await replica.dispose()
+
+
+def _session_factory(primary, replicas):
+    return async_sessionmaker(
+        primary,
+        autoflush=False,
+        expire_on_commit=False,
+        sync_session_class=RoutingSession,
+        replicas=replicas,
+    )
+
+
+async def _read_username(db) -> str:
+    return (await crud.user.get_by_email(db, email=EMAIL)).username
+
+
+async def test_reads_go_to_replica(engines):
+    primary, replica = engines
+    session_factory = _session_factory(primary, ReplicaSet([replica]))
+    async with session_factory() as db:
+        assert await _read_username(db) == "replica"
+    async with session_factory(use_primary=True) as db:
+        assert await _read_username(db) == "primary"
+
+
+async def test_reads_stick_to_primary_after_write(engines):
+    primary, replica = engines
+    writes = []
+    session_factory = _session_factory(primary, ReplicaSet([replica]))
+    async with session_factory(on_write=lambda: writes.append(1)) as db:
+        user_in = UserCreate(
+            email="new@example.com", username="new", password=SecretStr("password")
+        )
+        await crud.user.create(db, obj_in=user_in)
+        assert await _read_username(db) == "primary"
+        assert await crud.user.get_by_email(db, email="new@example.com")
+    assert writes == [1]
+    async with replica.connect() as conn:
+        emails = (await conn.execute(select(User.email))).scalars().all()
+    assert emails == [EMAIL]
+
+
+async def test_locking_reads_go_to_primary(engines):
+    primary, replica = engines
+    session_factory = _session_factory(primary, ReplicaSet([replica]))
+    async with session_factory() as db:
+        stmt = select(User.username).with_for_update()
+        assert (await db.execute(stmt)).scalar() == "primary"
+
+
+async def test_unhealthy_replica_falls_back_to_primary(engines, tmp_path):
+    primary, replica = engines
+    broken = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/db.sqlite")
+    replicas = ReplicaSet([broken, replica], retry_after=60)
+    await replicas.check()
+    assert replicas.healthy() == [replica.sync_engine]
+
+    replicas.mark_down(replica.sync_engine)
+    assert replicas.pick() is None
+    session_factory = _session_factory(primary, replicas)
+    async with session_factory() as db:
+        assert await _read_username(db) == "primary"
+    await broken.dispose()
+
+
+async def test_replica_marked_down_on_connection_error(engines, tmp_path):
+    primary, _ = engines
+    broken = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/db.sqlite")
+    replicas = ReplicaSet([broken], retry_after=60)
+    session_factory = _session_factory(primary, replicas)
+    async with session_factory() as db:
+        # Read again from the primary
+        assert await _read_username(db) == "primary"
+        assert replicas.healthy() == []
+        assert await _read_username(db) == "primary"
+    await broken.dispose()
+
+
+async def test_read_retried_on_healthy_replica(engines, tmp_path):
+    primary, replica = engines
+    broken = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/db.sqlite")
+    replicas = ReplicaSet([broken, replica], retry_after=60)
+    session_factory = _session_factory(primary, replicas)
+    async with session_factory() as db:
+        assert await _read_username(db) == "replica"
+        assert await _read_username(db) == "replica"
+    assert replicas.healthy() == [replica.sync_engine]
+    await broken.dispose()
+
+
+async def test_replica_query_error_not_retried(engines):
+    primary, replica = engines
+    replicas = ReplicaSet([replica], retry_after=60)
+    session_factory = _session_factory(primary, replicas)
+    async with session_factory() as db:
+        with pytest.raises(DBAPIError):
+            await db.execute(select(User.username).where(text("missing = 1")))
+    assert replicas.healthy() == [replica.sync_engine]
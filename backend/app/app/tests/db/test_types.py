@@ -0,0 +1,46 @@
+import uuid
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+from app.db.types import BinaryUUID, to_uuid
+
+UID = uuid.UUID("5f0c7a3e-8d1b-4c2a-9e6f-0a1b2c3d4e5f")
+
+metadata = sa.MetaData()
+table = sa.Table("t", metadata, sa.Column("uid", BinaryUUID, primary_key=True))
+
+
+@pytest.mark.parametrize("value", [UID, UID.hex, str(UID), UID.bytes])
+def test_to_uuid(value) -> None:
+    assert to_uuid(value) == UID
+
+
+def test_to_uuid_invalid() -> None:
+    with pytest.raises(ValueError):
+        to_uuid("not a uid")
+
+
+def test_binary_uuid(tmp_path) -> None:
+    engine = sa.create_engine(f"sqlite:///{tmp_path}/db.sqlite")
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        conn.execute(table.insert(), [{"uid": UID.hex}])
+        # Stored in 16 bytes
+        assert conn.scalar(sa.text("SELECT length(uid) FROM t")) == 16
+        assert conn.scalar(sa.select(table.c.uid)) == UID
+        # Compared to its hex form
+        select = sa.select(table.c.uid)
+        assert conn.scalar(select.where(table.c.uid == str(UID))) == UID
+        assert conn.scalar(select.where(table.c.uid.is_(None))) is None
+    engine.dispose()
+
+
+def test_binary_uuid_mysql() -> None:
+    assert str(BinaryUUID().compile(dialect=mysql.dialect())) == "BINARY(16)"
+    statement = sa.select(table).where(table.c.uid == UID)
+    sql = statement.compile(
+        dialect=mysql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    assert f"X'{UID.hex}'" in str(sql)
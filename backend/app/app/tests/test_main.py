@@ -0,0 +1,113 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.db.engine
+import app.main
+from app.core.metrics import metrics
+from app.core.search import user_index
+from app.core.security import principal_cache
+from app.db.engine import build_engine, pool_stats
+from app.main import create_app
+from config import settings
+
+# CPU time allowed to import app.main, in seconds: it takes about 0.8 s. The CPU
+# time, unlike the elapsed time, does not depend on the load of the box.
+IMPORT_BUDGET = 2.0
+
+IMPORT_CODE = """
+import sys, time
+start = time.process_time()
+import app.main
+print(
+    time.process_time() - start,
+    "jinja2" in sys.modules,
+    "app.api.api_v1.api" in sys.modules,
+)
+"""
+
+
+def test_import_time() -> None:
+    """Importing the application must stay cheap, and do no I/O."""
+    backend = Path(app.main.__file__).parents[1]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([".", "app"])}
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE],
+        cwd=backend,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Nothing else printed, jinja2 is only imported to send the first email and
+    # the routes by create_app
+    elapsed, jinja2, routes = result.stdout.split()
+    assert float(elapsed) < IMPORT_BUDGET
+    assert jinja2 == "False"
+    assert routes == "False"
+
+
+def test_lifespan(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+
+    async def warm_up() -> None:
+        calls.append("warm_up")
+
+    monkeypatch.setattr(app.main, "warm_up", warm_up)
+    monkeypatch.setattr(settings, "STARTUP_WARM_UP", True)
+    monkeypatch.setattr(settings, "EMAIL_WORKER_ENABLED", True)
+    with TestClient(create_app()):
+        assert calls == ["warm_up"]
+        assert app.main.outbox_worker._task is not None
+    assert app.main.outbox_worker._task is None
+
+
+async def test_warm_up(monkeypatch: pytest.MonkeyPatch) -> None:
+    prefilled = []
+
+    async def prefill_pool(engine) -> int:
+        prefilled.append(engine)
+        raise OSError("Can't connect")
+
+    async def hashing_warm_up() -> None:
+        pass
+
+    async def load_search_index() -> None:
+        raise OSError("Can't connect")
+
+    monkeypatch.setattr(app.main, "prefill_pool", prefill_pool)
+    monkeypatch.setattr(app.main.hashing_pool, "warm_up", hashing_warm_up)
+    monkeypatch.setattr(app.main, "load_search_index", load_search_index)
+    # An unreachable database does not prevent the startup
+    await app.main.warm_up()
+    assert prefilled == [app.main.session.engine]
+
+
+async def test_reset_after_fork(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    engine = build_engine("forked", f"sqlite+aiosqlite:///{tmp_path}/db.sqlite")
+    monkeypatch.setattr(app.db.engine, "_engines", {"forked": engine})
+    async with engine.connect():
+        pass
+    await app.main.hashing_pool.hash("password")
+    executor = app.main.hashing_pool._executor
+    principal_cache.set("user@example.com", object())
+    user_index.add(1, ["Anne"])
+    user_index.loaded = True
+    metrics.observe("GET", "/", 200, 0.01, 10)
+
+    app.main.reset_after_fork()
+
+    # The connection of the parent is left open for it, the child opens its own
+    stats = pool_stats()["forked"]
+    assert (stats.checked_out, stats.opened, stats.closed) == (0, 0, 0)
+    assert app.main.hashing_pool.stats().completed == 0
+    assert app.main.hashing_pool._executor is None
+    assert principal_cache.get("user@example.com") is None
+    assert not user_index.loaded and not list(user_index.candidates(["anne"]))
+    assert not metrics.responses
+    await engine.dispose()
+    executor.shutdown()
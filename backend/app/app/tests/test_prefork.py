@@ -0,0 +1,108 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+import app.main
+import app.prefork
+from app.main import create_app
+from app.prefork import default_workers
+
+SERVER = """
+import sys
+from app.prefork import PreforkServer, preload
+
+server = PreforkServer(preload(), port=0, workers=2, log_level="warning")
+server.sock = server.bind()
+print(server.port, flush=True)
+sys.exit(server.run())
+"""
+
+
+def test_default_workers() -> None:
+    gib = 2**30
+    assert default_workers(cpus=8, memory=16 * gib, worker_memory=gib) == 8
+    # Bounded by the memory, but at least one
+    assert default_workers(cpus=8, memory=3 * gib, worker_memory=gib) == 3
+    assert default_workers(cpus=8, memory=gib // 2, worker_memory=gib) == 1
+    assert default_workers(cpus=4, memory=None, worker_memory=gib) == 4
+    assert default_workers() >= 1
+
+
+def test_worker_resets_resources(monkeypatch: pytest.MonkeyPatch) -> None:
+    """A worker starts from clean resources: the pre-fork server resets them,
+    no fork hook does (it would run in the hashing pool processes too)."""
+    calls = []
+
+    class Server:
+        started = True
+
+        def __init__(self, config) -> None:
+            pass
+
+        async def serve(self, sockets) -> None:
+            calls.append("serve")
+
+    monkeypatch.setattr(app.main, "reset_after_fork", lambda: calls.append("reset"))
+    monkeypatch.setattr(app.prefork.uvicorn, "Server", Server)
+    # Keep the handlers of pytest
+    monkeypatch.setattr(signal, "signal", lambda *_args: None)
+    server = app.prefork.PreforkServer(create_app(), port=0, workers=1)
+    assert server._serve(None) == 0
+    assert calls == ["reset", "serve"]
+
+
+def _workers(pid: int) -> set[int]:
+    children = Path(f"/proc/{pid}/task/{pid}/children").read_text()
+    return {int(child) for child in children.split()}
+
+
+def _wait_workers(pid: int, count: int, url: str, dead: int = 0) -> set[int]:
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        workers = _workers(pid)
+        if len(workers) == count and dead not in workers:
+            try:
+                if httpx.get(url).status_code == 200:
+                    return workers
+            except httpx.TransportError:
+                pass
+        time.sleep(0.05)
+    raise AssertionError("The workers did not start")
+
+
+@pytest.mark.skipif(
+    not Path(f"/proc/{os.getpid()}/task/{os.getpid()}/children").exists(),
+    reason="needs /proc/<pid>/task/<tid>/children",
+)
+def test_prefork_server() -> None:
+    backend = Path(app.prefork.__file__).parents[1]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([".", "app"])}
+    master = subprocess.Popen(
+        [sys.executable, "-c", SERVER],
+        cwd=backend,
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        port = int(master.stdout.readline())
+        url = f"http://127.0.0.1:{port}/metrics"
+        workers = _wait_workers(master.pid, 2, url)
+
+        # A worker that dies is replaced
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        assert workers < _wait_workers(master.pid, 2, url, dead=killed)
+
+        master.send_signal(signal.SIGTERM)
+        assert master.wait(timeout=20) == 0
+    finally:
+        if master.poll() is None:
+            master.kill()
+            master.wait()
@@ -0,0 +1,31 @@
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Statements of the test transaction wrapping, not of the code under test
+_TEST_STATEMENTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+@contextmanager
+def assert_max_queries(engine: AsyncEngine, maximum: int) -> Iterator[list[str]]:
+    """Fail if the block runs more than ``maximum`` statements on ``engine``.
+
+    Yields the list of the statements run so far.
+    """
+    statements: list[str] = []
+
+    def record(_conn, _cursor, statement, *_args):
+        if not statement.startswith(_TEST_STATEMENTS):
+            statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+    assert len(statements) <= maximum, (
+        f"{len(statements)} queries, expected at most {maximum}:\n"
+        + "\n".join(statements)
+    )
@@ -0,0 +1,71 @@
+import socketserver
+import threading
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+
+
+class SMTPSink:
+    """Local SMTP server keeping the messages it receives, refusing the
+    recipients of ``reject``.
+
+    Usage::
+
+        with SMTPSink() as sink:
+            ...  # send to ("127.0.0.1", sink.port)
+        sink.messages
+    """
+
+    def __init__(self, reject: tuple[str, ...] = ()):
+        self.messages: list[EmailMessage] = []
+        self.connections = 0
+        self.reject = set(reject)
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line: str) -> None:
+                self.wfile.write(f"{line}\r\n".encode())
+
+            def handle(self) -> None:
+                sink.connections += 1
+                self.reply("220 sink ready")
+                for raw in self.rfile:
+                    line = raw.decode().rstrip("\r\n")
+                    verb = line[:4].upper()
+                    if verb in ("HELO", "EHLO", "MAIL", "RSET", "NOOP"):
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        address = line.split(":", 1)[1].strip(" <>")
+                        refused = address in sink.reject
+                        self.reply("550 Refused" if refused else "250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line == b".\r\n":
+                                break
+                            if data_line.startswith(b".."):
+                                data_line = data_line[1:]
+                            data.append(data_line)
+                        sink.messages.append(
+                            message_from_bytes(b"".join(data), policy=policy.default)
+                        )
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Not implemented")
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def __enter__(self) -> "SMTPSink":
+        threading.Thread(
+            target=self._server.serve_forever, args=(0.01,), daemon=True
+        ).start()
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -2,7 +2,7 @@
 
 from fastapi.testclient import TestClient
 from pydantic import SecretStr
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud
 from app.config import settings
@@ -23,7 +23,7 @@ def user_authentication_headers(
     return headers
 
 
-def create_random_user(db: Session) -> User:
+def create_random_user(db: AsyncSession) -> User:
     email = random_email()
     password = SecretStr(random_lower_string())
     user_in = UserCreate(username=email, email=email, password=password)
@@ -32,7 +32,7 @@ def create_random_user(db: Session) -> User:
 
 
 def authentication_token_from_email(
-    *, client: TestClient, email: str, db: Session
+    *, client: TestClient, email: str, db: AsyncSession
 ) -> Dict[str, str]:
     """
     Return a valid token for the user with given email.
@@ -1,27 +1,15 @@
-import logging
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Optional
 
 # import emails
 # from emails.template import JinjaTemplate
 import jwt
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
+from app.core.outbox import queue_email
+from app.core.security import decode_token
 
-
-def send_email(
-    *,
-    email_to: str,
-    environment: Dict[str, Any],
-    subject_template: str = "",
-    html_template: str = "",
-) -> dict[str, dict[str, Any] | str]:
-    return {
-        "To": email_to,
-        "Subject": subject_template,
-        "Message": environment
-    }
 # def send_email(
 #     email_to: str,
 #     subject_template: str = "",
@@ -58,17 +46,16 @@ def send_email(
 #     )
 
 
-def send_reset_password_email(email_to: str, email: str, token: str) -> str:
-    project_name = settings.PROJECT_NAME
-    subject = f"{project_name} - Password recovery for user {email}"
-    # with open(Path(settings.EMAIL_TEMPLATES_DIR) / "reset_password.html") as f:
-    #     template_str = f.read()
+async def send_reset_password_email(
+    db: AsyncSession, email_to: str, email: str, token: str
+) -> str:
+    """Queue the password recovery email, the outbox worker sends it."""
     server_host = settings.SERVER_HOST
     link = f"{server_host}/reset-password?token={token}"
-    send_email(
+    await queue_email(
+        db,
+        template="reset_password",
         email_to=email_to,
-        subject_template=subject,
-        # html_template=template_str,
         environment={
             "project_name": settings.PROJECT_NAME,
             "username": email,
@@ -113,7 +100,7 @@ def generate_password_reset_token(email: str) -> str:
 
 def verify_password_reset_token(token: str) -> Optional[str]:
     try:
-        decoded_token = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+        decoded_token = decode_token(token)
         return decoded_token["sub"]
     except (jwt.PyJWTError, KeyError):
         return None
@@ -0,0 +1,338 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Load test of the main API routes, with JSON results and regression checks.
+
+Drives the real application, in-process through its ASGI interface or over
+HTTP through uvicorn, against a seeded SQLite file standing in for MySQL
+(``--latency-ms`` emulates the server round-trip of each statement). Each
+scenario sends ``--requests`` requests, ``--concurrency`` at a time, and
+reports its throughput, latency percentiles, errors and SQL statements per
+request.
+
+In the uvicorn mode the server runs on the event loop of the load generator:
+the client cost is part of the figures, compare runs of the same mode only.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_api.py --output baseline.json
+    python benchmarks/bench_api.py --transport uvicorn --scenario get-user
+    python benchmarks/bench_api.py --baseline baseline.json  # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import bootstrap  # noqa: F401  (must come first)
+import httpx
+import uvicorn
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.api.deps import get_db
+from app.config import settings
+from app.core import security
+from app.core.hashing import pwd_hasher
+from app.db.base_class import Base
+from app.db.engine import build_engine
+from app.main import create_app
+from app.models.user import User
+
+EMAIL = "rider0@example.com"
+PASSWORD = "password"
+
+# Scenario name -> builder of the i-th request: (method, url, httpx keywords)
+Request = tuple[str, str, dict[str, Any]]
+
+
+def _scenarios(users: int, token: str, run_id: str) -> dict[str, Callable[[int], Request]]:
+    api = settings.API_V1_STR
+    return {
+        "login": lambda i: (
+            "POST",
+            f"{api}/login/access-token",
+            {"data": {"username": EMAIL, "password": PASSWORD}},
+        ),
+        "test-token": lambda i: (
+            "POST",
+            f"{api}/login/test-token",
+            {"headers": {"Authorization": f"Bearer {token}"}},
+        ),
+        "list-users": lambda i: ("GET", f"{api}/users/", {"params": {"limit": 20}}),
+        "get-user": lambda i: ("GET", f"{api}/users/{1 + i % users}", {}),
+        "create-user": lambda i: (
+            "POST",
+            f"{api}/users/",
+            {
+                "json": {
+                    "email": f"new{run_id}-{i}@example.com",
+                    "username": f"n{run_id}{i}"[:16],
+                    "password": PASSWORD,
+                }
+            },
+        ),
+    }
+
+
+SCENARIOS = ("login", "test-token", "list-users", "get-user", "create-user")
+
+
+def seed(path: Path, users: int) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    hashed_password = pwd_hasher.hash(PASSWORD)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(User),
+            [
+                {
+                    "uid": f"{i:032x}",
+                    "email": f"rider{i}@example.com",
+                    "username": f"rider{i}",
+                    # Only the user logging in needs a real hash
+                    "hashed_password": hashed_password if i == 0 else "x" * 97,
+                    "preferred_language": "fr-FR",
+                    "access_type": 1,
+                    "is_active": True,
+                    "is_superuser": i == 0,
+                }
+                for i in range(users)
+            ],
+        )
+    engine.dispose()
+
+
+class Database:
+    """Session factory over the seeded file, counting the statements run."""
+
+    def __init__(self, path: Path, pool_size: int, latency: float):
+        self.statements = 0
+        self.engine = build_engine(
+            "bench",
+            f"sqlite+aiosqlite:///{path}",
+            connect_args={"check_same_thread": False},
+            pool_size=pool_size,
+            max_overflow=0,
+        )
+
+        @event.listens_for(self.engine.sync_engine, "connect")
+        def configure(dbapi_connection, _connection_record):
+            dbapi_connection.run_async(
+                lambda conn: conn.executescript(
+                    "PRAGMA journal_mode=WAL; PRAGMA synchronous=OFF;"
+                )
+            )
+            if latency:
+                dbapi_connection.run_async(
+                    lambda conn: conn.set_trace_callback(
+                        lambda _stmt: time.sleep(latency)
+                    )
+                )
+
+        @event.listens_for(self.engine.sync_engine, "before_cursor_execute")
+        def count(*_args):
+            self.statements += 1
+
+        self.session_factory = async_sessionmaker(
+            self.engine, autoflush=False, expire_on_commit=False
+        )
+
+    async def get_db(self):
+        async with self.session_factory() as db:
+            yield db
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    return values[max(0, int(len(values) * percent / 100 + 0.5) - 1)]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    database: Database,
+    build_request: Callable[[int], Request],
+    requests: int,
+    concurrency: int,
+) -> dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        method, url, kwargs = build_request(i)
+        async with semaphore:
+            start = time.perf_counter()
+            r = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+        if r.status_code >= 400:
+            errors += 1
+
+    # Warm up the pool, the caches and the serializers
+    await asyncio.gather(*(one(requests + i) for i in range(concurrency)))
+    latencies.clear()
+    errors = 0
+    statements = database.statements
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+        "errors": errors,
+        "queries_per_request": round((database.statements - statements) / requests, 2),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args: argparse.Namespace, path: Path) -> dict[str, Any]:
+    database = Database(path, args.concurrency, args.latency_ms / 1000)
+    app = create_app()
+    app.dependency_overrides[get_db] = database.get_db
+    # A single load generator logging in as one user would be throttled
+    settings.RATE_LIMIT_ENABLED = False
+    token = security.create_access_token(EMAIL)
+    scenarios = _scenarios(args.users, token, f"{time.time_ns() % 10**6}")
+    limits = httpx.Limits(max_connections=args.concurrency)
+    server = server_task = None
+    if args.transport == "uvicorn":
+        port = _free_port()
+        server = uvicorn.Server(
+            uvicorn.Config(
+                app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"
+            )
+        )
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits)
+    else:
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://bench"
+        )
+    results = {}
+    try:
+        async with client:
+            for name in args.scenario or SCENARIOS:
+                results[name] = await run_scenario(
+                    client, database, scenarios[name], args.requests, args.concurrency
+                )
+                print(f"{name:>12}: {_format(results[name])}", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await server_task
+        app.dependency_overrides.clear()
+        await database.engine.dispose()
+    return {
+        "transport": args.transport,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "latency_ms": args.latency_ms,
+        "python": platform.python_version(),
+        "scenarios": results,
+    }
+
+
+def _format(result: dict[str, Any]) -> str:
+    return (
+        f"{result['rps']:8.1f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+        f"p95 {result['p95_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+        f"{result['queries_per_request']:4.1f} queries/req  {result['errors']} errors"
+    )
+
+
+def compare(
+    results: dict[str, Any], baseline: dict[str, Any], tolerance: float
+) -> list[str]:
+    """Regressions of ``results`` against ``baseline``: throughput down or p99
+    latency up by more than ``tolerance``, more queries or more errors."""
+    regressions = []
+    for name, result in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {base['rps']} -> {result['rps']} req/s")
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {base['p99_ms']} -> {result['p99_ms']} ms")
+        if result["queries_per_request"] > base["queries_per_request"]:
+            regressions.append(
+                f"{name}: {base['queries_per_request']} -> "
+                f"{result['queries_per_request']} queries/request"
+            )
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{name}: {base['errors']} -> {result['errors']} errors")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transport", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument(
+        "--scenario", action="append", choices=SCENARIOS, help="default: all"
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=1.0,
+        help="emulated server round-trip per statement",
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.10,
+        help="relative throughput or p99 change accepted against the baseline",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.sqlite"
+        seed(path, args.users)
+        results = asyncio.run(run(args, path))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        for key in ("transport", "concurrency", "requests", "latency_ms"):
+            if baseline[key] != results[key]:
+                print(
+                    f"WARNING {key} differs from the baseline: "
+                    f"{baseline[key]} -> {results[key]}",
+                    file=sys.stderr,
+                )
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Cost of the ``deps.get_current_user`` chain with and without its caches.
+
+Each iteration resolves the same bearer token in a fresh session, as the
+requests of one client do. The token cache skips the JWT verification, the
+user cache skips the SELECT.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_auth_dependency.py --iterations 5000
+"""
+import argparse
+import asyncio
+import time
+
+import bootstrap  # noqa: F401  (must come first)
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.api import deps
+from app.core import security
+from app.db.base_class import Base
+from app.models.user import User
+
+EMAIL = "rider@example.com"
+
+MODES = {
+    "no cache": (0, 0),
+    "token cache": (security.token_cache.maxsize, 0),
+    "token + user cache": (
+        security.token_cache.maxsize,
+        security.principal_cache.maxsize,
+    ),
+}
+
+
+async def main(iterations: int) -> None:
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(
+        engine, autoflush=False, expire_on_commit=False
+    )
+    async with session_factory() as db:
+        db.add(
+            User(
+                uid="0" * 32,
+                email=EMAIL,
+                username="rider",
+                hashed_password="x" * 97,
+            )
+        )
+        await db.commit()
+    token = security.create_access_token(EMAIL)
+
+    for mode, (token_cache_size, user_cache_size) in MODES.items():
+        security.token_cache.maxsize = token_cache_size
+        security.principal_cache.maxsize = user_cache_size
+        security.token_cache.clear()
+        security.principal_cache.clear()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            async with session_factory() as db:
+                user = await deps.get_current_user(db, token)
+                assert user.email == EMAIL
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>18}: {elapsed / iterations * 1e6:8.1f} us/call")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations))
@@ -0,0 +1,80 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Per-request overhead of the metrics middleware.
+
+Calls an ASGI app answering a small JSON body, bare and wrapped in
+``MetricsMiddleware``, without any server or network in between: the
+difference is the cost of recording the latency, status and size of a request.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_metrics_overhead.py --requests 100000
+"""
+import argparse
+import asyncio
+import time
+
+import bootstrap  # noqa: F401  (must come first)
+from starlette.convertors import CONVERTOR_TYPES
+
+from app.core.metrics import HTTPMetrics, MetricsMiddleware
+
+
+class Route:
+    # As an APIRoute of the users router, included under /api/v1/users
+    path_format = "/{user_id}"
+    param_convertors = {"user_id": CONVERTOR_TYPES["int"]}
+
+
+async def endpoint(scope, receive, send):
+    scope["route"] = Route
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": b'{"id": 1}'})
+
+
+async def receive():
+    return {"type": "http.request", "body": b""}
+
+
+async def send(_message):
+    pass
+
+
+async def bench(app, requests: int) -> float:
+    start = time.perf_counter()
+    for i in range(requests):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": f"/api/v1/users/{i}",
+            "path_params": {"user_id": i},
+        }
+        await app(scope, receive, send)
+    return (time.perf_counter() - start) / requests
+
+
+async def main(requests: int) -> None:
+    wrapped = MetricsMiddleware(endpoint, registry=HTTPMetrics())
+    await bench(endpoint, 1000)  # warm up
+    bare = await bench(endpoint, requests)
+    await bench(wrapped, 1000)
+    instrumented = await bench(wrapped, requests)
+    print(f"        bare: {bare * 1e6:6.2f} us/request")
+    print(f"with metrics: {instrumented * 1e6:6.2f} us/request")
+    print(f"    overhead: {(instrumented - bare) * 1e6:6.2f} us/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
@@ -0,0 +1,229 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Throughput of the box and memory of each worker in pre-fork mode.
+
+For each worker count of ``--workers``, starts app.prefork serving the
+application over a seeded SQLite file standing in for MySQL (see
+bench_api.py), loads it for ``--duration`` seconds from ``--clients`` load
+generator processes, then reads the memory of each worker in
+/proc/<pid>/smaps_rollup:
+
+- RSS, the memory it maps, counting the pages it shares with the others;
+- PSS, its share of them: the sum over the workers is the memory they use;
+- USS, its private memory, what one more worker costs.
+
+The memory of the box is the PSS of the master and of the workers.
+
+The load generators run on the same box and take CPU from the workers:
+compare the runs of one box, with the same ``--clients``, only. Linux only.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_prefork.py --workers 1,2,4 --output prefork.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import bootstrap  # noqa: F401  (must come first)
+import config
+import httpx
+from bench_api import EMAIL, SCENARIOS, Database, _percentile, _scenarios, seed
+
+from app.api.deps import get_db
+from app.config import settings
+from app.core import security
+from app.prefork import PreforkServer, default_workers, preload
+
+
+def memory(pid: int) -> dict[str, float]:
+    """RSS, PSS and USS of process ``pid``, in MiB."""
+    fields = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()[1:]:
+        name, value, *_unit = line.split()
+        fields[name.rstrip(":")] = int(value) / 1024
+    return {
+        "rss_mib": round(fields["Rss"], 1),
+        "pss_mib": round(fields["Pss"], 1),
+        "uss_mib": round(fields["Private_Clean"] + fields["Private_Dirty"], 1),
+    }
+
+
+def _children(pid: int) -> list[int]:
+    children = Path(f"/proc/{pid}/task/{pid}/children").read_text()
+    return [int(child) for child in children.split()]
+
+
+def _generate(url: str, scenario: str, args: argparse.Namespace, token: str, queue):
+    """Load generator process: sends requests for ``args.duration`` seconds,
+    ``args.concurrency`` at a time, and puts its latencies and errors."""
+    build_request = _scenarios(args.users, token, f"{os.getpid()}")[scenario]
+
+    async def load() -> tuple[list[float], int]:
+        latencies: list[float] = []
+        errors = 0
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+            deadline = time.monotonic() + args.duration
+
+            async def user(n: int) -> None:
+                nonlocal errors
+                i = n
+                while time.monotonic() < deadline:
+                    method, path, kwargs = build_request(i)
+                    start = time.perf_counter()
+                    r = await client.request(method, path, **kwargs)
+                    latencies.append(time.perf_counter() - start)
+                    errors += r.status_code >= 400
+                    i += args.concurrency
+
+            await asyncio.gather(*(user(n) for n in range(args.concurrency)))
+        return latencies, errors
+
+    queue.put(asyncio.run(load()))
+
+
+def run(workers: int, app: Any, path: Path, args: argparse.Namespace) -> dict[str, Any]:
+    server = PreforkServer(app, port=0, workers=workers, log_level="warning")
+    server.sock = server.bind()
+    master = os.fork()
+    if master == 0:
+        status = 1
+        try:
+            # Each worker opens its own pool over the seeded file
+            database = Database(path, args.concurrency, args.latency_ms / 1000)
+            app.dependency_overrides[get_db] = database.get_db
+            status = server.run()
+        finally:
+            os._exit(status)
+    server.sock.close()
+    url = f"http://127.0.0.1:{server.port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if httpx.get(f"{url}/metrics").status_code == 200:
+                    break
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+            time.sleep(0.1)
+
+        token = security.create_access_token(EMAIL)
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        generators = [
+            context.Process(
+                target=_generate, args=(url, args.scenario, args, token, queue)
+            )
+            for _ in range(args.clients)
+        ]
+        for generator in generators:
+            generator.start()
+        results = [queue.get() for _ in generators]
+        for generator in generators:
+            generator.join()
+        worker_memory = [memory(pid) for pid in _children(master)]
+        master_memory = memory(master)
+    finally:
+        os.kill(master, signal.SIGTERM)
+        os.waitpid(master, 0)
+
+    latencies = sorted(latency for result, _errors in results for latency in result)
+    return {
+        "workers": workers,
+        "rps": round(len(latencies) / args.duration, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+        "errors": sum(errors for _result, errors in results),
+        "master_memory": master_memory,
+        "worker_memory": {
+            key: round(statistics.mean(m[key] for m in worker_memory), 1)
+            for key in ("rss_mib", "pss_mib", "uss_mib")
+        },
+        "box_memory_mib": round(
+            master_memory["pss_mib"] + sum(m["pss_mib"] for m in worker_memory), 1
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers",
+        default=f"1,{default_workers()}",
+        help="comma separated worker counts (default: 1 and the default count)",
+    )
+    parser.add_argument("--scenario", choices=SCENARIOS, default="get-user")
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=1.0,
+        help="emulated server round-trip per statement",
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+
+    # A single load generator logging in as one user would be throttled, and
+    # the workers must not try to reach MySQL. The application modules import
+    # the settings both as app.config and as config.
+    for app_settings in (settings, config.settings):
+        app_settings.RATE_LIMIT_ENABLED = False
+        app_settings.STARTUP_WARM_UP = False
+        app_settings.EMAIL_WORKER_ENABLED = False
+    app = preload()
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.sqlite"
+        seed(path, args.users)
+        for workers in sorted({int(n) for n in args.workers.split(",")}):
+            result = run(workers, app, path, args)
+            runs.append(result)
+            print(
+                f"{workers:>3} workers: {result['rps']:8.1f} req/s  "
+                f"p99 {result['p99_ms']:7.2f} ms  "
+                f"per worker RSS {result['worker_memory']['rss_mib']:6.1f} MiB  "
+                f"PSS {result['worker_memory']['pss_mib']:6.1f} MiB  "
+                f"USS {result['worker_memory']['uss_mib']:6.1f} MiB  "
+                f"{result['errors']} errors",
+                file=sys.stderr,
+            )
+
+    output = json.dumps(
+        {
+            "scenario": args.scenario,
+            "clients": args.clients,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "latency_ms": args.latency_ms,
+            "cpus": len(os.sched_getaffinity(0)),
+            "python": platform.python_version(),
+            "runs": runs,
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
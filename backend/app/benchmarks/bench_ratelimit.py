@@ -0,0 +1,68 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Per-attempt overhead of the login rate limiter.
+
+Times ``RateLimiter.check`` on the in-memory store, for attempts from many
+clients on many accounts (every key new, the store growing up to its bound)
+and for attempts repeated by a single client, next to the Argon2 verification
+it protects.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_ratelimit.py --attempts 100000
+"""
+import argparse
+import asyncio
+import time
+
+import bootstrap  # noqa: F401  (must come first)
+
+from app.core.hashing import check_password, hash_password
+from app.core.ratelimit import MemoryStore, RateLimiter
+
+
+def _limiter() -> RateLimiter:
+    # Limits high enough for every attempt to be admitted: the full path
+    return RateLimiter(
+        MemoryStore(),
+        ip_burst=10**9,
+        ip_per_minute=60,
+        account_burst=10**9,
+        account_per_minute=60,
+        max_failures=10,
+        failure_window=900,
+    )
+
+
+async def bench(attempts: int, distinct: bool) -> float:
+    limiter = _limiter()
+    start = time.perf_counter()
+    for i in range(attempts):
+        n = i if distinct else 0
+        ip = f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"
+        await limiter.check(ip, f"{n}@example.com")
+    return (time.perf_counter() - start) / attempts
+
+
+async def main(attempts: int) -> None:
+    await bench(1000, distinct=True)  # warm up
+    many = await bench(attempts, distinct=True)
+    one = await bench(attempts, distinct=False)
+    hashed = hash_password("password")
+    start = time.perf_counter()
+    for _ in range(10):
+        check_password(hashed, "password")
+    argon2 = (time.perf_counter() - start) / 10
+    print(f" check, distinct clients: {many * 1e6:8.2f} us/attempt")
+    print(f"  check, a single client: {one * 1e6:8.2f} us/attempt")
+    print(f"  Argon2 password check: {argon2 * 1e6:8.0f} us/attempt")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--attempts", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(main(args.attempts))
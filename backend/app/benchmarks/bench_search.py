@@ -0,0 +1,203 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Latency of the user search, and size of the trigram index, at 1M users.
+
+Seeds a SQLite file with ``--users`` users having a username, a name and a
+city, loads the search index of the process from it (crud.user
+sync_search_index), then runs ``--queries`` searches of each kind through
+crud.user.search, bypassing the result cache (the worst case):
+
+- prefix: the first 1 to 6 characters of a username, a typeahead;
+- substring: 3 to 5 characters from the middle of a name;
+- two-words: the start of a first name and of a city;
+- miss: a word no user has.
+
+Every statement pays ``--latency-ms``, the round trip to a MySQL server (see
+bench_api.py). Reports the load time and memory of the index, and the p50, p99
+and max latencies of each kind. The target is a p99 under 20 ms. Linux only.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_search.py --users 1000000
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import bootstrap  # noqa: F401  (must come first)
+from bench_api import Database, _percentile
+from sqlalchemy import create_engine, insert
+
+from app import crud
+from app.core.search import user_index
+from app.db.base_class import Base
+from app.models.user import User
+
+FIRST_NAMES = (
+    "Anne", "Jean", "Marie", "Pierre", "Jeanne", "Louis", "Camille", "Hélène",
+    "Nicolas", "Élodie", "Julien", "Chloé", "Mathieu", "Sophie", "Antoine",
+    "Léa", "Thomas", "Manon", "François", "Inès", "Hugo", "Zoé", "Rémi", "Lucie",
+)
+SYLLABLES = (
+    "ber", "mar", "du", "pont", "lau", "ren", "ti", "chel", "ro", "bin", "gar",
+    "nier", "le", "fè", "vre", "mo", "reau", "gi", "rard", "bou", "chet", "da",
+    "vid", "fon", "tai", "ne", "mer", "cier", "lam", "bert", "col", "in",
+)
+CITIES = (
+    "Paris", "Lyon", "Grenoble", "Annecy", "Chambéry", "Saint-Étienne",
+    "Marseille", "Toulouse", "Nantes", "Bordeaux", "Lille", "Rennes", "Nice",
+    "Strasbourg", "Montpellier", "Clermont-Ferrand", "Dijon", "Besançon",
+    "Valence", "Gap", "Briançon", "Albertville", "Aix-les-Bains", "Voiron",
+)
+
+
+def _user(i: int, rng: random.Random) -> dict[str, Any]:
+    first = rng.choice(FIRST_NAMES)
+    last = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+    return {
+        "uid": i.to_bytes(16, "big"),
+        "email": f"rider{i}@example.com",
+        "username": f"{first[:3].lower()}{last[:6]}{i}",
+        "hashed_password": "x" * 97,
+        "name": f"{first} {last.capitalize()}",
+        "city": rng.choice(CITIES),
+    }
+
+
+def seed(path: Path, users: int, batch: int = 10_000) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    rng = random.Random(0)
+    for offset in range(0, users, batch):
+        with engine.begin() as conn:
+            conn.execute(
+                insert(User),
+                [_user(i, rng) for i in range(offset, min(offset + batch, users))],
+            )
+    engine.dispose()
+
+
+def _rss_mib() -> float:
+    """Resident memory of the process."""
+    pages = int(Path("/proc/self/statm").read_text().split()[1])
+    return pages * resource.getpagesize() / 2**20
+
+
+def _queries(users: int, rng: random.Random) -> dict[str, Callable[[], str]]:
+    def sample() -> dict[str, Any]:
+        # Built like the seeded users, so the queries find some
+        return _user(rng.randrange(users), rng)
+
+    def prefix() -> str:
+        return sample()["username"][: rng.randint(1, 6)]
+
+    def substring() -> str:
+        name = sample()["name"].split()[1]
+        size = rng.randint(3, 5)
+        start = rng.randrange(max(1, len(name) - size + 1))
+        return name[start : start + size]
+
+    def two_words() -> str:
+        user = sample()
+        return f"{user['name'][: rng.randint(2, 4)]} {user['city'][:3]}"
+
+    def miss() -> str:
+        return "".join(rng.choice("qwxz") for _ in range(rng.randint(3, 6)))
+
+    return {
+        "prefix": prefix,
+        "substring": substring,
+        "two-words": two_words,
+        "miss": miss,
+    }
+
+
+async def run(args: argparse.Namespace, path: Path) -> dict[str, Any]:
+    database = Database(path, 1, args.latency_ms / 1000)
+    rss = _rss_mib()
+    async with database.session_factory() as db:
+        start = time.perf_counter()
+        await crud.user.sync_search_index(db)
+        load_time = time.perf_counter() - start
+        index = {
+            "load_seconds": round(load_time, 1),
+            "rss_mib": round(_rss_mib() - rss, 1),
+            **user_index.stats(),
+        }
+
+        rng = random.Random(1)
+        # No sync with the database during the measures
+        user_index.synced_at = time.monotonic() + 3600
+        kinds = {}
+        all_latencies = []
+        for kind, build in _queries(args.users, rng).items():
+            latencies, results = [], 0
+            for _ in range(args.queries):
+                query = build()
+                start = time.perf_counter()
+                rows, _cursor = await crud.user.search(
+                    db, query=query, columns=("id", "username"), limit=args.limit
+                )
+                latencies.append(time.perf_counter() - start)
+                results += len(rows)
+            latencies.sort()
+            all_latencies += latencies
+            kinds[kind] = {
+                "p50_ms": round(statistics.median(latencies) * 1000, 2),
+                "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+                "max_ms": round(latencies[-1] * 1000, 2),
+                "mean_results": round(results / args.queries, 1),
+            }
+    await database.engine.dispose()
+    all_latencies.sort()
+    return {
+        "users": args.users,
+        "latency_ms": args.latency_ms,
+        "index": index,
+        "queries": kinds,
+        "p99_ms": round(_percentile(all_latencies, 99) * 1000, 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=1.0,
+        help="emulated server round-trip per statement",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.sqlite"
+        seed(path, args.users)
+        result = asyncio.run(run(args, path))
+    index = result["index"]
+    print(
+        f"index: {index['grams']} trigrams, {index['postings']} postings, "
+        f"loaded in {index['load_seconds']} s, {index['rss_mib']} MiB"
+    )
+    for kind, stats in result["queries"].items():
+        print(
+            f"{kind:>10}: p50 {stats['p50_ms']:6.2f} ms  p99 {stats['p99_ms']:6.2f} ms"
+            f"  max {stats['max_ms']:6.2f} ms  {stats['mean_results']} results"
+        )
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
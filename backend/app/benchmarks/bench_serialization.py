@@ -0,0 +1,98 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Cost of serializing a page of users to JSON.
+
+Compares the former ``response_model`` path (one validation per user, with an
+email check and a DirectoryPath stat, then a generic JSON encoding) with the
+cached TypeAdapter serializer used for ORM instances and with the orjson
+rendering of the projected rows served by ``GET /users/``.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_serialization.py --users 10000
+"""
+import argparse
+import json
+import tempfile
+import time
+
+import bootstrap  # noqa: F401  (must come first)
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import DirectoryPath, EmailStr
+
+from app import schemas
+from app.api.api_v1.endpoints.users import USER_FIELDS
+from app.core.serialization import serialize
+from app.models.user import User
+
+
+class LegacyUser(schemas.User):
+    email: EmailStr
+    photo_path: DirectoryPath | None
+
+
+def make_users(count: int, photo_dir: str) -> list[User]:
+    users = []
+    for i in range(count):
+        user = User(
+            uid=f"{i:032x}",
+            email=f"user{i}@example.com",
+            username=f"user{i}",
+            hashed_password="x" * 97,
+            preferred_language="fr-FR",
+            access_type=1,
+        )
+        user.id = i + 1
+        user.city = "Grenoble"
+        user.photo_path = photo_dir
+        users.append(user)
+    return users
+
+
+def legacy(users: list[User]) -> bytes:
+    items = [LegacyUser.model_validate(user) for user in users]
+    return json.dumps(jsonable_encoder(items)).encode()
+
+
+def type_adapter(users: list[User]) -> bytes:
+    return serialize(list[schemas.User], users)
+
+
+def rows_orjson(rows: list[dict]) -> bytes:
+    return orjson.dumps(rows)
+
+
+def bench(fn, arg, repeat: int) -> float:
+    fn(arg)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return (time.perf_counter() - start) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as photo_dir:
+        users = make_users(args.users, photo_dir)
+        rows = [{field: getattr(u, field) for field in USER_FIELDS} for u in users]
+        assert json.loads(legacy(users)) == json.loads(type_adapter(users))
+        assert json.loads(type_adapter(users)) == json.loads(rows_orjson(rows))
+        for name, fn, arg in (
+            ("response_model (legacy)", legacy, users),
+            ("cached TypeAdapter", type_adapter, users),
+            ("projected rows + orjson", rows_orjson, rows),
+        ):
+            elapsed = bench(fn, arg, args.repeat)
+            print(f"{name:>24}: {elapsed * 1000:8.1f} ms / {args.users} users")
+
+
+if __name__ == "__main__":
+    main()
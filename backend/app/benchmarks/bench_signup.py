@@ -0,0 +1,139 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Signup throughput: check-then-insert vs a single INSERT.
+
+The "check-then-insert" mode reproduces the former ``create_user`` flow: a
+SELECT by email, a SELECT by username, the INSERT and a refresh SELECT. The
+"insert" mode relies on the unique indexes, as ``create_user`` now does.
+
+``--latency-ms`` emulates the round-trip of a MySQL server by sleeping in the
+aiosqlite worker thread for each statement. Argon2 hashing is replaced by a
+constant unless ``--hash`` is given, so that the database cost stands out.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_signup.py --signups 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import bootstrap  # noqa: F401  (must come first)
+from pydantic import SecretStr
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import crud
+from app.db.base_class import Base
+from app.schemas.user import UserCreate
+
+
+async def check_then_insert(db, user_in: UserCreate) -> None:
+    if await crud.user.get_by_email(db, email=user_in.email):
+        raise AssertionError("duplicate email")
+    if await crud.user.get_by_username(db, username=user_in.username):
+        raise AssertionError("duplicate username")
+    user = await crud.user.create(db, obj_in=user_in)
+    await db.refresh(user)
+
+
+async def insert(db, user_in: UserCreate) -> None:
+    await crud.user.create(db, obj_in=user_in)
+
+
+async def run(path: Path, mode: str, signup, args) -> None:
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=args.concurrency,
+    )
+    latency = args.latency_ms / 1000
+    statements = 0
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def add_latency(dbapi_connection, _connection_record):
+        # A single file-backed writer: keep commits cheap so that round-trips,
+        # not fsyncs, are measured
+        dbapi_connection.run_async(
+            lambda conn: conn.executescript(
+                "PRAGMA journal_mode=WAL; PRAGMA synchronous=OFF;"
+            )
+        )
+        if latency:
+            dbapi_connection.run_async(
+                lambda conn: conn.set_trace_callback(lambda _stmt: time.sleep(latency))
+            )
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count(*_args):
+        nonlocal statements
+        statements += 1
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(
+        engine, autoflush=False, expire_on_commit=False
+    )
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i: int) -> None:
+        user_in = UserCreate(
+            email=f"rider{i}@example.com",
+            username=f"rider{i}",
+            password=SecretStr("password"),
+        )
+        async with semaphore, session_factory() as db:
+            await signup(db, user_in)
+
+    statements = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.signups)))
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    # BEGIN/COMMIT are not cursor executions: only statements are counted
+    print(
+        f"{mode:>18}: {args.signups / elapsed:8.1f} signups/s  "
+        f"{statements / args.signups:4.1f} statements/signup"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--signups", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=2.0,
+        help="emulated server round-trip per statement",
+    )
+    parser.add_argument(
+        "--hash", action="store_true", help="hash passwords with Argon2"
+    )
+    args = parser.parse_args()
+
+    if not args.hash:
+        async def get_password_hash(_password: str) -> str:
+            return "x" * 97
+
+        # app.crud.user is the CRUDUser instance, patch its module
+        sys.modules["app.crud.user"].get_password_hash = get_password_hash
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.sqlite"
+        for mode, signup in (
+            ("check-then-insert", check_then_insert),
+            ("insert", insert),
+        ):
+            asyncio.run(run(path, mode, signup, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Concurrent ``GET /users/`` throughput: blocking Session vs AsyncSession.
+
+The "blocking" mode reproduces the former database layer: CRUD methods are
+awaited, but every round-trip runs a synchronous ``Session`` on the event loop.
+The "async" mode uses the ``AsyncSession`` given out by ``deps.get_db``.
+
+Both modes read the same SQLite file. ``--latency-ms`` emulates the network
+round-trip of a MySQL server by sleeping in the driver for each statement: on
+the event loop thread for the blocking driver, in the aiosqlite worker thread
+for the async one.
+
+Usage (from backend/app)::
+
+    python benchmarks/bench_users_concurrency.py --concurrency 50 --latency-ms 2
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import bootstrap  # noqa: F401  (must come first)
+import httpx
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.api.deps import get_db
+from app.config import settings
+from app.db.base_class import Base
+from app.main import create_app
+from app.models.user import User
+
+
+class BlockingSession:
+    """Awaitable facade over a synchronous Session, as the CRUD layer used to be."""
+
+    def __init__(self, session):
+        self._session = session
+
+    def add(self, instance):
+        self._session.add(instance)
+
+    async def get(self, *args, **kwargs):
+        return self._session.get(*args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return self._session.scalars(*args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return self._session.execute(*args, **kwargs)
+
+    async def commit(self):
+        self._session.commit()
+
+    async def rollback(self):
+        self._session.rollback()
+
+    async def refresh(self, instance):
+        self._session.refresh(instance)
+
+    async def delete(self, instance):
+        self._session.delete(instance)
+
+    async def close(self):
+        self._session.close()
+
+
+def seed(path: Path, users: int) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(User),
+            [
+                {
+                    "uid": f"{i:032x}",
+                    "email": f"user{i}@example.com",
+                    "username": f"user{i}",
+                    "hashed_password": "x" * 97,
+                    "preferred_language": "fr-FR",
+                    "access_type": 1,
+                    "is_active": True,
+                    "is_superuser": False,
+                }
+                for i in range(users)
+            ],
+        )
+    engine.dispose()
+
+
+def blocking_get_db(path: Path, concurrency: int, latency: float):
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=concurrency,
+    )
+
+    if latency:
+        @event.listens_for(engine, "connect")
+        def add_latency(dbapi_connection, _connection_record):
+            dbapi_connection.set_trace_callback(lambda _stmt: time.sleep(latency))
+
+    session_factory = sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async def _get_db():
+        db = BlockingSession(session_factory())
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    async def _dispose():
+        engine.dispose()
+
+    return _get_db, _dispose
+
+
+def async_get_db(path: Path, concurrency: int, latency: float):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=concurrency,
+    )
+
+    if latency:
+        @event.listens_for(engine.sync_engine, "connect")
+        def add_latency(dbapi_connection, _connection_record):
+            dbapi_connection.run_async(
+                lambda conn: conn.set_trace_callback(
+                    lambda _stmt: time.sleep(latency)
+                )
+            )
+
+    session_factory = async_sessionmaker(
+        engine, autoflush=False, expire_on_commit=False
+    )
+
+    async def _get_db():
+        async with session_factory() as db:
+            yield db
+
+    return _get_db, engine.dispose
+
+
+async def run(get_db_override, requests: int, concurrency: int, limit: int):
+    app = create_app()
+    app.dependency_overrides[get_db] = get_db_override
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    url = f"{settings.API_V1_STR}/users/"
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def one(i: int):
+            async with semaphore:
+                start = time.perf_counter()
+                r = await client.get(url, params={"skip": i % 1000, "limit": limit})
+                latencies.append(time.perf_counter() - start)
+                assert r.status_code == 200, r.text
+
+        # Warm up the pool and the serializers
+        await asyncio.gather(*(one(i) for i in range(concurrency)))
+        latencies.clear()
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+    app.dependency_overrides.clear()
+    latencies.sort()
+    return {
+        "rps": requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=2.0,
+        help="emulated server round-trip per statement",
+    )
+    args = parser.parse_args()
+    latency = args.latency_ms / 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.sqlite"
+        seed(path, args.users)
+        for mode, factory in (("blocking", blocking_get_db), ("async", async_get_db)):
+            get_db_override, dispose = factory(path, args.concurrency, latency)
+            result = asyncio.run(
+                run(get_db_override, args.requests, args.concurrency, args.limit)
+            )
+            asyncio.run(dispose())
+            print(
+                f"{mode:>8}: {result['rps']:8.1f} req/s  "
+                f"p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
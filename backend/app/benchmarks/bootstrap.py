@@ -0,0 +1,30 @@
+# Copyright (c) 2024, Eric Lemoine
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+"""Make the application importable from a benchmark script.
+
+Import this module first: it puts the backend on ``sys.path`` and provides
+placeholder settings, benchmarks never reach the configured MySQL server.
+"""
+import os
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(BACKEND_DIR), str(BACKEND_DIR / "app")]
+
+for _name, _value in {
+    "PROJECT_NAME": "Cycliti",
+    "SERVER_HOST": "http://localhost",
+    "SECRET_KEY": "benchmark-secret-key-not-for-production",
+    "MYSQL_HOST": "localhost",
+    "MYSQL_USER": "benchmark",
+    "MYSQL_PASSWORD": "benchmark",
+    "MYSQL_DB": "benchmark",
+    "FIRST_SUPERUSER_EMAIL": "admin@example.com",
+    "FIRST_SUPERUSER_USERNAME": "admin",
+    "FIRST_SUPERUSER_PASSWORD": "changeme",
+}.items():
+    os.environ.setdefault(_name, _value)
@@ -3,5 +3,5 @@
 set -e
 set -x
 
-#pytest --cov=app --cov-report=term-missing app/tests "${@}"
-pytest --cov=app --cov-report=term-missing app/tests
+# e.g. "scripts/test.sh -n auto" to run the tests on every core (pytest-xdist)
+pytest --cov=app --cov-report=term-missing app/tests "${@}"